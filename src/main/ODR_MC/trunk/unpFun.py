@@ -17,6 +17,7 @@ Later analogous classes will be added for HIRS and microwave series."""
 
 from numpy import zeros, dot, einsum, diag, sqrt
 from readHD import satSens, sInCoeff
+from unc_functions import calc_quad_form
 
 
 """ The class stores information for an AVHRR series as attributes of the class:
@@ -138,13 +139,9 @@ class avhrr(object):
         p = self.nocoefs # number of calibration coefficients
         sens = self.sensCoeff(X, a) # sensitivity coeffs for matchup obs.
         
-        # compute uncertainty from calibration coefficients
-        u2La = dot(sens[:, 0:p]**2, diag(Va)) # coeffs. variance component
-        corU = zeros((X[:,0].shape[0]))
-        for i in range(p-1):
-            for j in range(i+1,p):
-                corU[:] += 2 * sens[:,i] * sens[:,j] * Va[i,j]
-        u2La += corU # add coeffs' correlation component
+        # compute uncertainty from calibration coefficients, variance and
+        # correlation components, as row-wise quadratic form sens Va sens^T
+        u2La = calc_quad_form(sens[:, 0:p], Va)
         
         return sqrt(u2La) # return radiance uncert. from coeffs uncertainty
 
@@ -169,13 +166,9 @@ class avhrr(object):
         m = self.novars # number of harmonisation variables
         sens = self.sensCoeff(X, a) # sensitivity coeffs for matchup obs.
 
-        # compute uncertainty from calibration coefficients
-        u2La = dot(sens[:, 0:p]**2, diag(Va)) # coeffs. variance component
-        corU = zeros((X[:,0].shape[0]))
-        for i in range(p-1):
-            for j in range(i+1,p):
-                corU[:] += 2 * sens[:,i] * sens[:,j] * Va[i,j]
-        u2La += corU # add coeffs' correlation component
+        # compute uncertainty from calibration coefficients, variance and
+        # correlation components, as row-wise quadratic form sens Va sens^T
+        u2La = calc_quad_form(sens[:, 0:p], Va)
 
         # compute uncertainty from harmonisation data variables
         u2LX = einsum('ij,ij->i', sens[:, p:p+m]**2, uX**2) 
@@ -3,8 +3,9 @@ Implements the Gauss-Newton iteration algorithm for match-up data with a pre-con
 """
 
 '''___Python Modules____'''
-from numpy import zeros, append, ones, dot, outer, hstack, array, eye, inf
-from numpy.linalg import norm, solve
+from numpy import zeros, append, ones, dot, outer, hstack, array, eye, inf, column_stack, concatenate, asarray, \
+    newaxis, repeat
+from numpy.linalg import norm, solve, lstsq
 from scipy.sparse.linalg import LinearOperator
 from math import ceil
 
@@ -13,6 +14,7 @@ from pykrylov_lsmr import LSMRFramework
 from pykrylov_minres import Minres
 
 '''___Harmonisation Modules___'''
+from harm_telemetry import HarmTelemetry
 
 '''___Authorship___'''
 __author__ = ["Sam Hunt", "Peter Harris"]
@@ -23,6 +25,13 @@ __maintainer__ = "Sam Hunt"
 __email__ = "sam.hunt@npl.co.uk"
 __status__ = "Development"
 
+'''___Constants___'''
+
+# Step control
+LM_TAU = 1e-3       # Initial Levenberg-Marquardt damping parameter (relative to unit scaled variables)
+LS_C1 = 1e-4        # Line search sufficient decrease (Armijo) constant
+LS_STEPMIN = 1e-4   # Line search minimum step length
+
 
 class GNAlgo:
     """
@@ -56,16 +65,48 @@ class GNAlgo:
 
         Array containing variables and parameters
 
+        .. py:attribute:: recycle
+
+        *int*
+
+        Number of previous Gauss-Newton steps recycled to warm start LSMR solves (0 - LSMR started from zero), if
+        non-zero as many previous solutions are also reused to warm start MINRES solves in the uncertainty calculation
+
+        .. py:attribute:: recycled
+
+        *numpy.ndarray*
+
+        Basis of recycled subspace of final Gauss-Newton steps, reused in uncertainty calculation
+
+        .. py:attribute:: telemetry
+
+        *harm_telemetry.HarmTelemetry*
+
+        Record of stage timings and solver operation counts
+
     :Methods:
         .. py:method:: runGN(...):
 
             Run Gauss-Newton Algorithm to perform harmonisation
 
+        .. py:method:: runGN_batch(...):
+
+            Run chord Gauss-Newton Algorithm to perform harmonisation of a batch of perturbed datasets simultaneously
+
+        .. py:method:: solve_batch(...):
+
+            Return least-squares solutions of JP x = b for a block of right hand sides
+
         .. py:method:: calc_f(...):
 
             Return value for f, array containing the residual between the the current and original estimates of
             radiances, variables, and ks
 
+        .. py:method:: calc_f_batch(...):
+
+            Return values of f for a batch of datasets, evaluating the sensor model once per match-up series and sensor
+            for all datasets
+
         .. py:method:: get_JPx(...):
 
             Return array containing the product of JP and x for a given x
@@ -78,6 +119,10 @@ class GNAlgo:
 
             Return calculated radiance R and derivatives for given input data
 
+        .. py:method:: calc_R_batch(...):
+
+            Return calculated radiances R for a batch of datasets, from one sensor model evaluation
+
         .. py:method:: unconvert_Xs(...):
 
             Return variable data for each covariate in the original form for a given sensor and match-up, undoing the
@@ -91,27 +136,65 @@ class GNAlgo:
 
             Return value of x multiplied by preconditioner solution P (or transpose)
 
+        .. py:method:: get_jacobian_blocks(...):
+
+            Return sensor and adjustment model derivatives per match-up series and sensor at current estimates, cached
+            until estimates updated
+
+        .. py:method:: reset_jacobian(...):
+
+            Clear cached derivatives, required when current estimates are updated
+
         .. py:method:: calc_unc(...):
 
             Return array containing the covariance matrices for the retrieved parameters for each sensor, derived
             analytically
 
+        .. py:method:: calc_sensitivity(...):
+
+            Return sensitivity matrix of the parameter estimates to the converted data at the current estimates
+
+        .. py:method:: init_recycled_subspace(...):
+
+            Return subspace of initial guesses for solutions of H x = b from final GN steps if recycling
+
+        .. py:method:: solve_H(...):
+
+            Return solution of H x = b with MINRES
+
         .. py:method:: calc_Hx(...):
 
             Return the product of H (P'*J'*J*P) with a given x
 
+        .. py:method:: calc_recycle_basis(...):
+
+            Return basis of recycled subspace from previous Gauss-Newton steps
+
+        .. py:method:: calc_galerkin_guess(...):
+
+            Return initial guess for solution of H x = b by Galerkin projection onto a subspace
+
         .. py:method:: unconvert_values(...):
 
             Return variable data for each covariate in the original form for all variable data, undoing the
             reparameterisation performed in ConvertData.convert2ind()
 
+        .. py:method:: unconvert_block(...):
+
+            Return variable data of a data block in the original form, undoing the reparameterisation performed in
+            ConvertData.convert2ind()
+
+        .. py:method:: iter_residuals(...):
+
+            Generate residuals in the original form match-up series by match-up series
+
         .. py:method:: unconvert_ks(...):
 
             Return variable data for each covariate in the original for reparameterisation performed in
             ConvertData.convert2ind()
     """
 
-    def __init__(self, HData=None, S=None):
+    def __init__(self, HData=None, S=None, telemetry=None):
         """
         Initialise algorithm
 
@@ -120,6 +203,9 @@ class GNAlgo:
 
         :type S: numpy.ndarray
         :param S: Pre-conditioner solution
+
+        :type telemetry: harm_telemetry.HarmTelemetry
+        :param telemetry: (optional) telemetry object to record stage timings and solver operation counts to
         """
 
         # Initialise class
@@ -127,6 +213,17 @@ class GNAlgo:
         self.S = None
         self.xyza = None
 
+        # Cached derivatives at current estimates
+        self.Jblocks = None
+
+        # Krylov subspace recycling
+        self.recycle = 0
+        self.recycled = None
+
+        self.telemetry = telemetry
+        if telemetry is None:
+            self.telemetry = HarmTelemetry()
+
         if (HData is not None) and (S is not None):
 
             self.HData = HData
@@ -138,7 +235,8 @@ class GNAlgo:
             print "Initial Parameter Estimates:"
             print self.HData.a
 
-    def runGN(self, tol=1e-6, tolA=1e-8, tolB=1e8, tolU=1e-8, show=False):
+    def runGN(self, tol=1e-6, tolA=1e-8, tolB=1e8, tolU=1e-8, show=False, globalisation=None, mxiter=None,
+              checkpoint=None, resume=None, recycle=0, stream_residuals=False):
         """
         Run Gauss-Newton Algorithm to perform harmonisation
 
@@ -157,6 +255,32 @@ class GNAlgo:
         :type show: bool
         :param show: boolean to decide if stdout output of algorithm
 
+        :type globalisation: str
+        :param globalisation: (optional) step control strategy for the GN iterations, can have values:
+            * None (default) - full Gauss-Newton step taken every iteration
+            * "LM" - Levenberg-Marquardt, LSMR damp parameter adapted from the ratio of actual to predicted reduction
+            * "linesearch" - backtracking (Armijo) line search on the cost along the Gauss-Newton step, iterations stop
+              if no step down to the minimum step length gives sufficient decrease
+
+        :type mxiter: int
+        :param mxiter: (optional) maximum number of GN iterations (default number of variables)
+
+        :type checkpoint: harm_checkpoint.HarmCheckpoint
+        :param checkpoint: (optional) checkpoint object, if given solver state is checkpointed every
+        checkpoint.interval iterations and on convergence
+
+        :type resume: dict
+        :param resume: (optional) solver state to resume iterations from, as returned by HarmCheckpoint.load() (ignored,
+        starting from the current estimates, if its solution is not of the same match-up data)
+
+        :type recycle: int
+        :param recycle: (optional) number of previous GN steps to recycle, LSMR is warm started from the least-squares
+        solution over their span and final steps are reused in the uncertainty calculation (default 0, cold starts)
+
+        :type stream_residuals: bool
+        :param stream_residuals: (optional) if True, residuals are returned as a generator of residuals per match-up
+        series (see iter_residuals), so the full unconverted residual data is never held in memory
+
         :return:
             :a: *numpy.ndarray*
 
@@ -165,6 +289,26 @@ class GNAlgo:
             :Va: *numpy.ndarray*
 
             Covariance matrix for the parameter estimates
+
+            :F: *float*
+
+            Objective function final value
+
+            :v: *float*
+
+            Objective function degrees of freedom
+
+            :p: *float*
+
+            Chi-squared probability
+
+            :values_res: *numpy.ndarray*
+
+            Data residuals, in the original H format (generator of residuals per match-up series if stream_residuals)
+
+            :k_res: *numpy.ndarray*
+
+            Adjustment factor residuals (None if stream_residuals)
         """
 
         # Initialise parameters
@@ -176,9 +320,21 @@ class GNAlgo:
                                                                                       # each sensor
         N_var = self.HData.idx['idx'][-1]                                             # total number of variables
         niter = 0                                                                     # counter of iterations
-        mxiter = ceil(N_var)                                                          # max number of iterations of GN
+        if mxiter is None:
+            mxiter = ceil(N_var)                                                      # max number of iterations of GN
         mxiter_lsmr = ceil(N_var)                                                     # max number of iterations of LSMR
         conv = False                                                                  # convergence boolean
+        stalled = False                                                               # line search failure boolean
+        self.recycle = recycle                                                        # number of steps to recycle
+        steps = []                                                                    # recent GN steps (preconditioned)
+
+        # Step control parameters
+        lam = LM_TAU                                                                  # LM damping parameter (damp**2)
+        nu = 2.                                                                       # LM damping increase factor
+        step = 1.                                                                     # step control value for log
+
+        if globalisation not in (None, "LM", "linesearch"):
+            raise ValueError("Unknown globalisation strategy: " + str(globalisation))
 
         # Initialise J LinearOperator
         J = LinearOperator((N_var+N_mu, N_var+N_a), matvec=self.get_JPx, rmatvec=self.get_JPTx)
@@ -186,30 +342,117 @@ class GNAlgo:
         # Initialise LSMR object
         K = LSMRFramework(J)
 
+        # Restore iteration state if resuming from checkpoint (of a run of the same match-up series)
+        GNlog = []
+        lm = asarray(self.HData.idx['lm']).tolist()
+        if (resume is not None) and ((resume.get("xyza") is None) or (resume["xyza"].shape != (N_var + N_a,)) or
+                                     (resume["info"].get("lm", lm) != lm)):
+            print "Checkpoint solution of different match-up data, starting Gauss-Newton iterations from beginning..."
+            resume = None
+
+        if resume is not None:
+            self.xyza = resume["xyza"]
+            self.reset_jacobian()
+            niter = resume["niter"]
+            GNlog = resume["GNlog"]
+            lam = resume["info"].get("lam", lam)
+            nu = resume["info"].get("nu", nu)
+            conv = resume["info"].get("conv", conv)
+
+            print "Resuming from iteration " + str(niter)
+
+        # Evaluate vector f of weighted residual deviations and sum of squares of residual deviations F for initial
+        # estimates
+        f = self.calc_f(self.xyza, self.HData)
+        F0 = norm(f)**2
+        F = F0
+
         # Gauss-Newton iterations
         while (conv is False) and (niter < mxiter):
 
-            # Evaluate vector f of weighted residual deviations, sum of squares of
-            # residual deviations F and gradient g.
-
-            # Initialise for first iteration
-            if niter == 0:
-                f = self.calc_f(self.xyza, self.HData)
-                F0 = norm(f)**2
-                GNlog = []
-
             niter += 1
+            record = self.telemetry.start("GN iteration", niter)
 
             # Determine Gauss-Newton step d as solution to linear least-squares
-            # problem J*d = -f with the pre-conditioner applied.
-            K.solve(-f, damp=0, atol=tolA, btol=tolA, conlim=tolB, itnlim=mxiter_lsmr, show=show)
+            # problem J*d = -f with the pre-conditioner applied (damped by the LM parameter if required).
+            damp = 0
+            if globalisation == "LM":
+                damp = lam**0.5
+            # (warm started from recycled subspace of previous steps if required)
+            Z = self.calc_recycle_basis(steps)
+            with self.telemetry.stage("LSMR", niter):
+                itn = K.solve(-f, damp=damp, atol=tolA, btol=tolA, conlim=tolB, itnlim=mxiter_lsmr, show=show, Z=Z)[2]
+            self.telemetry.count("lsmr_iterations", itn)
             d = self.calc_Px(K.x)
 
+            if self.recycle > 0:
+                steps = (steps + [K.x.copy()])[-self.recycle:]
+
             # Update parameter estimates, as well as f, F and g
-            self.xyza += d
-            f = self.calc_f(self.xyza, self.HData)
-            F = norm(f)**2
-            g = 2 * self.get_JPTx(f)
+            accept = True
+
+            # a. full Gauss-Newton step
+            if globalisation is None:
+                self.xyza += d
+                self.reset_jacobian()
+                f = self.calc_f(self.xyza, self.HData)
+                F = norm(f)**2
+
+            # b. Levenberg-Marquardt step - accept step if cost reduced, adapt damping by gain ratio of actual reduction
+            #    to the reduction predicted by the linearised model
+            elif globalisation == "LM":
+                xyza_trial = self.xyza + d
+                f_trial = self.calc_f(xyza_trial, self.HData)
+                F_trial = norm(f_trial)**2
+
+                pred = F0 - norm(f + self.get_JPx(K.x))**2
+                rho = -1.
+                if pred > 0:
+                    rho = (F0 - F_trial) / pred
+
+                step = lam
+                if rho > 0:
+                    self.xyza = xyza_trial
+                    self.reset_jacobian()
+                    f = f_trial
+                    F = F_trial
+                    lam *= max(1./3., 1. - (2.*rho - 1.)**3)
+                    nu = 2.
+                else:
+                    accept = False
+                    F = F0
+                    d = zeros(d.shape)
+                    lam *= nu
+                    nu *= 2.
+
+            # c. line search - backtrack along Gauss-Newton step until sufficient decrease in cost
+            elif globalisation == "linesearch":
+                slope = 2 * dot(f, self.get_JPx(K.x))  # directional derivative of F along d
+
+                step = 1.
+                accept = False
+                while step >= LS_STEPMIN:
+                    f_trial = self.calc_f(self.xyza + step*d, self.HData)
+                    F_trial = norm(f_trial)**2
+
+                    if F_trial <= F0 + LS_C1*step*slope:
+                        accept = True
+                        break
+                    step *= 0.5
+
+                # accept only steps with sufficient decrease, else reject step and stop - no descent along GN step
+                if accept:
+                    d = step*d
+                    self.xyza += d
+                    self.reset_jacobian()
+                    f = f_trial
+                    F = F_trial
+                else:
+                    F = F0
+                    d = zeros(d.shape)
+                    stalled = True
+
+            g = 2 * self.calc_prod_JPx(f, transpose=True)
 
             # Test convergence
             U1 = F0 - F
@@ -222,33 +465,53 @@ class GNAlgo:
             # Update F0
             F0 = F
 
-            # Check for convergence
-            if (U1 > 0) and (U1 < tol1) and (U2 < tol2) and (U3 <= tol3):
-                conv = True
+            # Check for convergence (globalised steps are monotone so may reach U1 = 0, rejected steps are not tested)
+            if globalisation is None:
+                if (U1 > 0) and (U1 < tol1) and (U2 < tol2) and (U3 <= tol3):
+                    conv = True
+            elif accept:
+                if (U1 >= 0) and (U1 < tol1) and (U2 < tol2) and (U3 <= tol3):
+                    conv = True
 
             # Write log
-            GNlog.append([niter, U1, tol1, U2, tol2, U3, tol3])
+            GNlog.append([niter, U1, tol1, U2, tol2, U3, tol3, step])
             if show:
                 print "\n\t\t\t\tGNlog"
-                print "niter\tU1\t\ttol1\t\tU2\t\ttol2\t\tU3\t\ttol3"
+                print "niter\tU1\t\ttol1\t\tU2\t\ttol2\t\tU3\t\ttol3\t\tstep"
                 for GN in GNlog:
-                    print "{0:2d}\t{1:.2e}\t{2:.2e}\t{3:.2e}\t{4:.2e}\t{5:.2e}\t{6:.2e}"\
-                          .format(GN[0], GN[1], GN[2], GN[3], GN[4], GN[5], GN[6])
+                    print "{0:2d}\t{1:.2e}\t{2:.2e}\t{3:.2e}\t{4:.2e}\t{5:.2e}\t{6:.2e}\t{7:.2e}"\
+                          .format(GN[0], GN[1], GN[2], GN[3], GN[4], GN[5], GN[6], GN[7])
+
+            # Write checkpoint
+            if (checkpoint is not None) and checkpoint.due(niter, conv):
+                checkpoint.save("GN", niter=niter, xyza=self.xyza, GNlog=GNlog, lam=lam, nu=nu, conv=conv, lm=lm)
+
+            self.telemetry.stop(record)
+
+            if stalled:
+                print "Line search found no decrease in cost down to minimum step length - stopping iterations"
+                break
 
         # Unpack solution
         a = self.xyza[N_var:N_var + N_sensors * N_p]
+        self.recycled = self.calc_recycle_basis(steps)
 
         print "Determined Parameter Estimates:"
         print a
 
         # Uncertainty evaluation
         print 'Determining uncertainty...'
-        V = self.calc_unc(tolU, show=show)
+        with self.telemetry.stage("calc_unc"):
+            V = self.calc_unc(tolU, show=show)
 
         print 'Preparing output...'
 
-        values_res = self.unconvert_values(f[:N_var], self.HData.unc, self.HData.idx, self.HData.idx_orig)
-        k_res = self.unconvert_ks(f[N_var:], self.HData.unck, self.HData.idx)
+        if stream_residuals:
+            values_res = self.iter_residuals(f, self.HData)
+            k_res = None
+        else:
+            values_res = self.unconvert_values(f[:N_var], self.HData.unc, self.HData.idx, self.HData.idx_orig)
+            k_res = self.unconvert_ks(f[N_var:], self.HData.unck, self.HData.idx)
 
         v = N_var - N_mu - N_a
         p = 0
@@ -258,6 +521,195 @@ class GNAlgo:
 
         return a, V, F, v, p, values_res, k_res
 
+    def runGN_batch(self, HData_trials, tol=1e-6, tolA=1e-8, tolU=1e-8, show=False, mxiter=None):
+        """
+        Run chord Gauss-Newton Algorithm to perform harmonisation of a batch of perturbations of the input data (e.g. MC
+        trial datasets) simultaneously, starting from the current estimates
+
+        The estimates for each dataset are carried as a column of a matrix. The Jacobian is evaluated once, at the
+        current estimates, and shared by all datasets and iterations (chord method), so each iteration is one block
+        least-squares solve (see solve_batch) with all products with JP shared between the datasets, and one sensor
+        model evaluation per match-up series and sensor for all datasets (see calc_f_batch, the sensor model must
+        accept parameters per match-up). For datasets close to the input data, e.g. MC trials started from the best
+        estimate solution, the chord iterations converge in a few iterations.
+
+        As the chord steps use the Jacobian of the input data solution, the solution of each dataset is then tested
+        against the gradient of its own cost, with its Jacobian at its solution (as the runGN gradient convergence
+        test). Datasets failing the test, or not converged within mxiter chord iterations, are solved by full
+        Gauss-Newton iterations (runGN) from their chord solution, with their own uncertainty evaluation. Datasets
+        passing the test share the uncertainty evaluated once at the current estimates.
+
+        :type HData_trials: list:HarmData
+        :param HData_trials: Perturbed datasets, converted as the input data (same structure, different values and ks)
+
+        :type tol: float
+        :param tol: Tolerance for convergance of GN algorithm
+
+        :type tolA: float
+        :param tolA: Tolerance for convergence of block least-squares solves
+
+        :type tolU: float
+        :param tolU: tolerance for uncertainty calculation convergence (rtol in Minres)
+
+        :type show: bool
+        :param show: boolean to decide if stdout output of algorithm
+
+        :type mxiter: int
+        :param mxiter: (optional) maximum number of GN iterations (default number of variables)
+
+        :return:
+            :results: *list:tuple*
+
+            Harmonisation results per dataset, as tuple of (a, V, F, v, p, values_res, k_res), as returned by
+            runGN (V evaluated once, at the current estimates, unless solved by full Gauss-Newton iterations)
+        """
+
+        # Initialise parameters
+        N_mu = self.HData.idx['cNm'][-1]                # total match-ups (= number of ks)
+        N_a = len(self.HData.a)                         # total number of parameters for all sensors combined
+        N_var = self.HData.idx['idx'][-1]               # total number of variables
+        n_trials = len(HData_trials)                    # number of datasets in batch
+        niter = 0                                       # counter of iterations
+        if mxiter is None:
+            mxiter = ceil(N_var)                        # max number of iterations of GN
+
+        # Initialise estimates and residuals per dataset
+        xyza = column_stack([self.xyza] * n_trials)
+        f = self.calc_f_batch(xyza, HData_trials)
+        F0 = (f**2).sum(axis=0)
+        F = F0.copy()
+        active = ones(n_trials, dtype=bool)             # datasets not yet converged
+
+        GNlog = []
+        while active.any() and (niter < mxiter):
+
+            niter += 1
+            record = self.telemetry.start("GN batch iteration", niter)
+
+            # Determine chord steps for unconverged datasets as block solution of JP*d = -f
+            cols = active.nonzero()[0]
+            with self.telemetry.stage("solve_batch", niter):
+                d = self.calc_Px(self.solve_batch(-f[:, cols], tol=tolA, itnlim=ceil(N_var)))
+
+            # Update estimates and residuals
+            xyza[:, cols] += d
+            f[:, cols] = self.calc_f_batch(xyza[:, cols], [HData_trials[j] for j in cols])
+            F[cols] = (f[:, cols]**2).sum(axis=0)
+
+            # Test convergence per dataset
+            U1 = abs(F0[cols] - F[cols])
+            tol1 = tol*(1+F[cols])
+            U2 = abs(d).max(axis=0)
+            tol2 = (tol**0.5) * (1 + abs(xyza[:, cols]).max(axis=0))
+            active[cols[(U1 < tol1) & (U2 < tol2)]] = False
+
+            F0[cols] = F[cols]
+
+            # Write log
+            GNlog.append([niter, len(cols), U1.max(), U2.max()])
+            if show:
+                print "\n\t\tGN batch log"
+                print "niter\tactive\tU1\t\tU2"
+                for GN in GNlog:
+                    print "{0:2d}\t{1:d}\t{2:.2e}\t{3:.2e}".format(GN[0], GN[1], GN[2], GN[3])
+
+            self.telemetry.stop(record)
+
+        # Uncertainty evaluation (at current estimates, shared by all datasets passing gradient test)
+        print 'Determining uncertainty...'
+        with self.telemetry.stage("calc_unc"):
+            V = self.calc_unc(tolU, show=show)
+
+        # Test gradient of cost of each dataset at its solution, with the Jacobian at its solution
+        xyza0 = self.xyza
+        passed = zeros(n_trials, dtype=bool)
+        with self.telemetry.stage("check_gradient"):
+            for j in (~active).nonzero()[0]:
+                self.xyza = xyza[:, j].copy()
+                self.reset_jacobian()
+                g = 2 * self.calc_prod_JPx(f[:, j], transpose=True)
+                passed[j] = norm(g, inf) <= (tol**(1./3.))*(1+F[j])
+        self.xyza = xyza0
+        self.reset_jacobian()
+
+        print 'Preparing output...'
+
+        v = N_var - N_mu - N_a
+        p = 0
+
+        results = []
+        for j, HData in enumerate(HData_trials):
+
+            # solve datasets failing gradient test by full Gauss-Newton iterations from chord solution
+            if not passed[j]:
+                print "Chord solution of dataset " + str(j) + " not converged - running full Gauss-Newton iterations"
+                self.telemetry.count("gn_batch_fallbacks")
+
+                GN = GNAlgo(HData, self.S, telemetry=self.telemetry)
+                GN.xyza = xyza[:, j].copy()
+                results.append(GN.runGN(tol=tol, tolA=tolA, tolU=tolU, show=show, mxiter=mxiter))
+                continue
+
+            values_res = self.unconvert_values(f[:N_var, j], HData.unc, HData.idx, HData.idx_orig)
+            k_res = self.unconvert_ks(f[N_var:, j], HData.unck, HData.idx)
+            results.append((xyza[N_var:, j].copy(), V, F[j], v, p, values_res, k_res))
+
+        return results
+
+    def solve_batch(self, B, tol=1e-8, itnlim=None):
+        """
+        Return least-squares solutions of JP x = b for a block of right hand sides b (one per column), with an
+        independent CGLS recurrence per column, all sharing block products with JP and its transpose. Converged columns
+        are dropped from the block.
+
+        :type B: numpy.ndarray
+        :param B: Right hand sides, one per column
+
+        :type tol: float
+        :param tol: Tolerance for convergence, relative reduction of the normal equations residual norm
+
+        :type itnlim: int
+        :param itnlim: (optional) maximum number of iterations (default number of unknowns)
+
+        :return:
+            :X: *numpy.ndarray*
+
+            Solutions, one per column (preconditioned variables)
+        """
+
+        R = B.copy()
+        S = self.calc_prod_JPx(R, transpose=True)
+        X = zeros(S.shape)
+        P = S.copy()
+        gamma = (S**2).sum(axis=0)
+        gamma_tol = tol**2 * gamma
+        if itnlim is None:
+            itnlim = S.shape[0]
+
+        active = (gamma > gamma_tol).nonzero()[0]
+        itn = 0
+        while (len(active) > 0) and (itn < itnlim):
+
+            itn += 1
+            self.telemetry.count("matvec", len(active))
+            self.telemetry.count("rmatvec", len(active))
+
+            Q = self.calc_prod_JPx(P[:, active])
+            alpha = gamma[active] / (Q**2).sum(axis=0)
+            X[:, active] += alpha * P[:, active]
+            R[:, active] -= alpha * Q
+
+            S = self.calc_prod_JPx(R[:, active], transpose=True)
+            gamma_new = (S**2).sum(axis=0)
+            P[:, active] = S + (gamma_new / gamma[active]) * P[:, active]
+            gamma[active] = gamma_new
+
+            active = active[gamma_new > gamma_tol[active]]
+
+        self.telemetry.count("cgls_iterations", itn)
+
+        return X
+
     def calc_f(self, xyza, HData):
         """
         Return value for f, array containing the residual between the the current and original estimates of radiances,
@@ -326,6 +778,57 @@ class GNAlgo:
 
         return f
 
+    def calc_f_batch(self, xyza, HData_trials):
+        """
+        Return values of f (see calc_f) for a batch of datasets of the same structure, evaluating the sensor model once
+        per match-up series and sensor for all datasets (see calc_R_batch)
+
+        :type xyza: numpy.ndarray
+        :param xyza: array containing the current estimates of variables and parameters, one column per dataset
+
+        :type HData_trials: list:HarmData
+        :param HData_trials: Datasets, converted as the input data (same structure, different values and ks)
+
+        :return:
+            :f: *numpy.ndarray*
+
+            array of f per dataset, one column per dataset
+        """
+
+        # initialise parameters
+        idx = HData_trials[0].idx
+        mc = idx['cNm']                                                          # cumulative
+        N_mu = idx['cNm'][-1]                                                    # total match-ups (= number of ks)
+        N_var = idx['idx'][-1]                                                   # total variables
+        n_trials = len(HData_trials)                                             # number of datasets
+
+        f = zeros((N_var + N_mu, n_trials))
+
+        # 1. Calculate f for values
+        for j, HData in enumerate(HData_trials):
+            f[0:N_var, j] = xyza[0:N_var, j] - HData.values[0:N_var]
+
+        # 2. Calculate f for ks, k_est = B(R_2) - B(R_1), determined per match-up series for all datasets
+        for i, n_sensors in enumerate(idx['Im']):
+
+            n_mu = i + 1
+            # indices for data
+            istart = mc[n_mu-1]
+            iend = mc[n_mu]
+
+            # a. get radiances for sensor 1 and sensor 2 of match-up series, datasets stacked
+            Rs = [self.calc_R_batch(xyza, HData_trials, n_sensor, n_mu) for n_sensor in n_sensors]
+
+            # b. calculate k_est for match-up series, one row per dataset
+            Bs = [HData_trials[0].adjustment_model(R)[0] for R in Rs]
+            k_est = (Bs[1] - Bs[0]).reshape((n_trials, iend - istart))
+
+            # c. add difference between k_est and k (original) to f
+            for j, HData in enumerate(HData_trials):
+                f[N_var + istart:N_var + iend, j] = k_est[j] / HData.unck[i].uR - HData.ks[istart:iend]
+
+        return f
+
     def get_JPx(self, x):
         """
         Return array containing the product of JP and x for a given x
@@ -340,6 +843,7 @@ class GNAlgo:
         """
 
         # Call to function to calculate product
+        self.telemetry.count("matvec")
         JPx = self.calc_prod_JPx(x, transpose=False)
 
         return JPx
@@ -358,6 +862,7 @@ class GNAlgo:
         """
 
         # Call to function to calculate product
+        self.telemetry.count("rmatvec")
         JPTx = self.calc_prod_JPx(x, transpose=True)
 
         return JPTx
@@ -425,10 +930,58 @@ class GNAlgo:
             a = xyza[N_var + (n_sensor - 1) * N_p:N_var + n_sensor * N_p]
 
             # 3. compute radiances and derivatives
+            self.telemetry.count("sensor_model_calls")
             R, JR = sensor_model(a, Xs)
 
         return R, JR
 
+    def calc_R_batch(self, xyza, HData_trials, n_sensor, n_mu):
+        """
+        Return calculated radiances R for a batch of datasets of the same structure, with the covariates of all
+        datasets stacked and the sensor model evaluated once with parameters per match-up
+
+        :type xyza: numpy.ndarray
+        :param xyza: Array containing variables and parameters, one column per dataset
+
+        :type HData_trials: list:HarmData
+        :param HData_trials: Datasets, converted as the input data (same structure, different values and ks)
+
+        :type n_sensor: int
+        :param n_sensor: number of sensor to calculate radiances for
+
+        :type n_mu: int
+        :param n_mu: number of match-up series to calculate radiances for
+
+        :return:
+            :R: *numpy.ndarray*
+
+            Calculated radiances, of each dataset in turn
+        """
+
+        # > if reference sensor - get R data
+        if n_sensor == 0:
+            return concatenate([self.calc_R(xyza[:, j], HData.unc, HData.idx, HData.sensor_model, n_sensor, n_mu)[0]
+                                for j, HData in enumerate(HData_trials)])
+
+        # > if sensor - determine R from sensor model
+        idx = HData_trials[0].idx
+        N_var = idx['idx'][-1]                                             # total variables
+        N_sensors = len(set([i for pair in idx['Im'] for i in pair])) - 1  # total number of sensors
+        N_p = (xyza.shape[0] - N_var) / N_sensors                          # total number of parameters in model
+        Nm = idx['cNm'][n_mu] - idx['cNm'][n_mu - 1]                       # number of match-ups in match-up series
+
+        # 1. get covariate data, stacked by covariate
+        Xs_trials = [self.unconvert_Xs(xyza[:, j], HData.unc, HData.idx, n_sensor, n_mu)
+                     for j, HData in enumerate(HData_trials)]
+        Xs = [concatenate([Xs_trial[n_cov] for Xs_trial in Xs_trials]) for n_cov in xrange(len(Xs_trials[0]))]
+
+        # 2. get parameters, per match-up
+        a = repeat(xyza[N_var + (n_sensor - 1) * N_p:N_var + n_sensor * N_p, :], Nm, axis=1)
+
+        # 3. compute radiances
+        self.telemetry.count("sensor_model_calls")
+        return HData_trials[0].sensor_model(a, Xs)[0]
+
     def unconvert_Xs(self, xyza, unc, idx, n_sensor, n_mu):
         """
         Return variable data for each covariate in the original form for a given sensor and match-up, undoing the
@@ -503,7 +1056,8 @@ class GNAlgo:
                 Harmonisation data object
 
         :type x: numpy.ndarray
-        :param x: vector to multiply by JP (or JP transpose)
+        :param x: vector to multiply by JP (or JP transpose), or matrix of vectors (one per column) to multiply as a
+        block, sharing the Jacobian evaluation and memory traffic between columns
 
         :type transpose: bool
         :param transpose: Boolean to decide whether to multiply x by JP or (JP)T
@@ -511,7 +1065,7 @@ class GNAlgo:
         :return:
             :JPx: *numpy.ndarray*
 
-            Array containing the product of JP (or JP transpose) with x
+            Array containing the product of JP (or JP transpose) with x (same number of columns as x)
         """
 
         # Jacobian structured as,
@@ -569,12 +1123,18 @@ class GNAlgo:
                                                                                       # each sensor model
         N_cov = self.HData.idx['n_cov'][-1]                                           # total number of covariates
         N_mu_s = len(self.HData.idx['Im'])                                            # total number of match-up series
+        Jblocks = self.get_jacobian_blocks()                                          # derivatives at current estimates
+
+        # evaluate with x as matrix of column vectors
+        x = asarray(x)
+        shape = x.shape
+        x = x.reshape(shape[0], -1)
 
         # initialise array
         if not transpose:
-            JPx = zeros(N_var + N_mu)         # initialise JPx (length number of variables + number of ks)
+            JPx = zeros((N_var + N_mu, x.shape[1]))     # initialise JPx (length number of variables + number of ks)
         elif transpose:
-            JPx = zeros(N_var + N_a)          # initialise JPx (length number of variables + number of as)
+            JPx = zeros((N_var + N_a, x.shape[1]))      # initialise JPx (length number of variables + number of as)
 
         ################################################################################################################
         # 1. Apply preconditioner if not transpose
@@ -613,9 +1173,7 @@ class GNAlgo:
                 if j == 1:
                     s = 1
 
-                R, JR = self.calc_R(self.xyza, self.HData.unc, self.HData.idx, self.HData.sensor_model, n_sensor, n_mu)
-                                                           # evaluate radiances and derivatives
-                JB = self.HData.adjustment_model(R)[1]     # evaluate derivatives of adjustment model for each sensor
+                JR, JB = Jblocks[(n_mu, n_sensor)]         # derivatives of sensor and adjustment models
 
                 # b. build product of (unweighted) Jacobian with vector
 
@@ -631,9 +1189,9 @@ class GNAlgo:
 
                     # ii. add products of Jacobian and vector to product vector
                     if not transpose:
-                        JPx[istart:iend] = JPx[istart:iend] + s*JB*x[ib:ie]*block_unc.uR/uK
+                        JPx[istart:iend] = JPx[istart:iend] + s*(JB*block_unc.uR/uK)[:, newaxis]*x[ib:ie]
                     elif transpose:
-                        JPx[ib:ie] = JPx[ib:ie] + s*JB*x[istart:iend]*block_unc.uR/uK
+                        JPx[ib:ie] = JPx[ib:ie] + s*(JB*block_unc.uR/uK)[:, newaxis]*x[istart:iend]
 
                 # > if sensor
                 else:
@@ -653,10 +1211,11 @@ class GNAlgo:
 
                         # ~ random correlation
                         if block_unc.form == "r":
+                            c = (JB*JR[:, n_cov-1]*block_unc.uR/uK)[:, newaxis]
                             if not transpose:
-                                JPx[istart:iend] = JPx[istart:iend] + s*JB*JR[:, n_cov-1]*x[ib:ie]*block_unc.uR/uK
+                                JPx[istart:iend] = JPx[istart:iend] + s*c*x[ib:ie]
                             elif transpose:
-                                JPx[ib:ie] = JPx[ib:ie] + s*JB*JR[:, n_cov-1]*x[istart:iend]*block_unc.uR/uK
+                                JPx[ib:ie] = JPx[ib:ie] + s*c*x[istart:iend]
 
                         # ~ random+systematic correlation
                         if block_unc.form == 'rs':
@@ -668,25 +1227,25 @@ class GNAlgo:
                             im = indices.index((N_sensors, N_mu_s, n_cov))
                             isys = mcxyz[im + 1] - N_sensors + n_sensor - 1
 
+                            c = JB*JR[:, n_cov-1]/uK
                             if not transpose:
                                 # > random component
-                                JPx[istart:iend] = JPx[istart:iend] + s*JB*JR[:, n_cov-1]*x[ib:ie]*block_unc.uR/uK
+                                JPx[istart:iend] = JPx[istart:iend] + s*(c*block_unc.uR)[:, newaxis]*x[ib:ie]
                                 # > systematic component
-                                JPx[istart:iend] = JPx[istart:iend] + s*(JB*JR[:, n_cov-1])*x[isys]*block_unc.uS/uK
+                                JPx[istart:iend] = JPx[istart:iend] + s*(c*block_unc.uS)[:, newaxis]*x[isys]
                             elif transpose:
                                 # > random component
-                                JPx[ib:ie] = JPx[ib:ie] + s*JB*JR[:, n_cov-1]*x[istart:iend]*block_unc.uR/uK
+                                JPx[ib:ie] = JPx[ib:ie] + s*(c*block_unc.uR)[:, newaxis]*x[istart:iend]
                                 # > systematic component
-                                JPx[isys] = JPx[isys] + s*dot(JB*JR[:, n_cov-1]*block_unc.uS/uK, x[istart:iend])
+                                JPx[isys] = JPx[isys] + s*dot(c*block_unc.uS, x[istart:iend])
 
                         # ~ averaging correlation
                         if block_unc.form == 'ave':
+                            c = (JB*JR[:, n_cov-1]/uK)[:, newaxis]
                             if not transpose:
-                                JPx[istart:iend] = JPx[istart:iend] \
-                                                        + s*JB*JR[:, n_cov-1]*block_unc.W.dot(x[ib:ie])/uK
+                                JPx[istart:iend] = JPx[istart:iend] + s*c*block_unc.W.dot(x[ib:ie])
                             elif transpose:
-                                JPx[ib:ie] = JPx[ib:ie] \
-                                                        + s*block_unc.W.T.dot(JB*JR[:, n_cov-1]*x[istart:iend]/uK)
+                                JPx[ib:ie] = JPx[ib:ie] + s*block_unc.W.T.dot(c*x[istart:iend])
 
                     # iii. add terms for as
                     ib = N_var + (n_sensor - 1) * N_p
@@ -697,7 +1256,8 @@ class GNAlgo:
                                            + s *dot(outer(JB/uK, ones(N_p))*JR[:, N_cov:N_cov+N_p], x[ib:ie])
                     elif transpose:
                         JPx[ib:ie] = JPx[ib:ie] \
-                                     + s *dot((outer(JB, ones(N_p))*JR[:, N_cov:N_cov+N_p]).T, x[istart:iend]/uK)
+                                     + s *dot((outer(JB, ones(N_p))*JR[:, N_cov:N_cov+N_p]).T,
+                                              x[istart:iend]/uK[:, newaxis])
 
         ################################################################################################################
         # 4. Apply preconditioner transpose if transpose
@@ -706,14 +1266,14 @@ class GNAlgo:
         if transpose:
             JPx = self.calc_Px(JPx, transpose=True)
 
-        return JPx
+        return JPx.reshape((-1,) + shape[1:])
 
     def calc_Px(self, x, transpose=False):
         """
         Return value of x multiplied by preconditioner solution P (or transpose)
 
         :type x: numpy.ndarray
-        :param x: Vector to be multiplied by x
+        :param x: Vector to be multiplied by x (or matrix of vectors, one per column)
 
         :type transpose: bool
         :param transpose: Parameter to decide if to calculate Px or PT x
@@ -754,13 +1314,44 @@ class GNAlgo:
 
         # calculate product
         if not transpose:
-            Px = hstack((x[0:N_var], dot(self.S, x[N_var:N_tot])))
+            Px = concatenate((x[0:N_var], dot(self.S, x[N_var:N_tot])))
             return Px
 
         if transpose:
-            PTx = hstack((x[0:N_var], dot(self.S.T, x[N_var:N_tot])))
+            PTx = concatenate((x[0:N_var], dot(self.S.T, x[N_var:N_tot])))
             return PTx
 
+    def get_jacobian_blocks(self):
+        """
+        Return sensor and adjustment model derivatives per match-up series and sensor at current estimates, cached until
+        estimates updated
+
+        :return:
+            :Jblocks: *dict*
+
+            Dictionary of derivatives with entry per (match-up series number, sensor number) of tuple of sensor model
+            derivatives and adjustment model derivatives
+        """
+
+        if self.Jblocks is None:
+            self.Jblocks = {}
+            for i, n_sensors in enumerate(self.HData.idx['Im']):
+                n_mu = i + 1
+                for n_sensor in n_sensors:
+                    R, JR = self.calc_R(self.xyza, self.HData.unc, self.HData.idx, self.HData.sensor_model,
+                                        n_sensor, n_mu)                      # evaluate radiances and derivatives
+                    JB = self.HData.adjustment_model(R)[1]                   # evaluate derivatives of adjustment model
+                    self.Jblocks[(n_mu, n_sensor)] = (JR, JB)
+
+        return self.Jblocks
+
+    def reset_jacobian(self):
+        """
+        Clear cached derivatives, required when current estimates are updated
+        """
+
+        self.Jblocks = None
+
     def calc_unc(self, tolU=1e-8, show=False):
         """
         Return array containing the covariance matrices for the retrieved parameters for each sensor, derived
@@ -790,13 +1381,17 @@ class GNAlgo:
         # initialise MINRES object
         K = Minres(H)
 
+        # if recycling, initialise subspace for initial guesses from final GN steps, D, with products HD
+        D, HD = self.init_recycled_subspace()
+
         for n_sensor in xrange(1, N_sensors+1):
 
             for n_p1 in xrange(N_p):
                 d = zeros(N_var + N_a)
                 d[N_var + (n_sensor-1)*N_p + n_p1] = 1
-                K.solve(self.calc_Px(d, transpose=True), rtol=tolU, itnlim=500, show=show)
-                dt = K.x
+                b = self.calc_Px(d, transpose=True)
+
+                dt = self.solve_H(K, b, D, HD, tolU=tolU, show=show)
 
                 for n_p2 in xrange(N_p):
                     c = zeros(N_var + N_a)
@@ -812,6 +1407,128 @@ class GNAlgo:
 
         return V
 
+    def calc_sensitivity(self, tolU=1e-8, show=False):
+        """
+        Return sensitivity matrix of the parameter estimates to the converted data at the current estimates, G, such
+        that a perturbation e of the converted data (variables and ks, of unit standard uncertainty after
+        ConvertData.convert2ind) shifts the parameter estimates by G*e, to first order - i.e. the parameter rows of
+        the pseudo-inverse of J
+
+        G is evaluated with one MINRES solve per parameter, as the rows JP*inv(H)*P'*e_a, so any number of
+        perturbations can then be propagated by matrix products with G alone
+
+        :type tolU: float
+        :param tolU: tolerance for convergence of MINRES solves (rtol in Minres)
+
+        :type show: bool
+        :param show: boolean to decide if stdout output of algorithm
+
+        :return:
+            :G: *numpy.ndarray*
+
+            Sensitivity matrix, shape (number of parameters, number of variables + number of match-ups)
+        """
+
+        # initialise parameters
+        N_a = len(self.HData.a)                 # total number of parameters for all sensors combined
+        N_var = self.HData.idx['idx'][-1]       # total variables
+        N_mu = self.HData.idx['cNm'][-1]        # total match-ups (= number of ks)
+
+        # initialise array
+        G = zeros((N_a, N_var + N_mu))
+
+        # initialise H LinearOperator and MINRES object
+        H = LinearOperator((N_var + N_a, N_var + N_a), matvec=self.calc_Hx)
+        K = Minres(H)
+
+        D, HD = self.init_recycled_subspace()
+
+        for i in xrange(N_a):
+            d = zeros(N_var + N_a)
+            d[N_var + i] = 1
+            b = self.calc_Px(d, transpose=True)
+
+            dt = self.solve_H(K, b, D, HD, tolU=tolU, show=show)
+
+            G[i, :] = self.calc_prod_JPx(dt)
+
+        return G
+
+    def init_recycled_subspace(self):
+        """
+        Return subspace of initial guesses for solutions of H x = b from final GN steps if recycling, D, with products
+        HD
+
+        :return:
+            :D: *list:numpy.ndarray*
+
+            Subspace basis vectors (empty if not recycling)
+
+            :HD: *list:numpy.ndarray*
+
+            Products of H with subspace basis vectors
+        """
+
+        D = []
+        HD = []
+        if (self.recycle > 0) and (self.recycled is not None):
+            for j in xrange(self.recycled.shape[1]):
+                D.append(self.recycled[:, j])
+                HD.append(self.calc_Hx(self.recycled[:, j]))
+
+        return D, HD
+
+    def solve_H(self, K, b, D, HD, tolU=1e-8, show=False):
+        """
+        Return solution of H x = b with MINRES, from initial guess by Galerkin projection onto subspace of previous
+        solutions if recycling (which the solution is then added to, keeping the most recent self.recycle solutions)
+
+        :type K: pykrylov_minres.Minres
+        :param K: MINRES object for H
+
+        :type b: numpy.ndarray
+        :param b: Right hand side vector
+
+        :type D: list:numpy.ndarray
+        :param D: Subspace basis vectors, as returned by init_recycled_subspace() (modified in place)
+
+        :type HD: list:numpy.ndarray
+        :param HD: Products of H with subspace basis vectors (modified in place)
+
+        :type tolU: float
+        :param tolU: tolerance for convergence (rtol in Minres)
+
+        :type show: bool
+        :param show: boolean to decide if stdout output of algorithm
+
+        :return:
+            :x: *numpy.ndarray*
+
+            Solution
+        """
+
+        # solve for correction to initial guess from subspace of previous solutions if recycling
+        x0 = None
+        if self.recycle > 0:
+            x0 = self.calc_galerkin_guess(D, HD, b)
+
+        if x0 is None:
+            K.solve(b, rtol=tolU, itnlim=500, show=show)
+            x = K.x
+        else:
+            K.solve(b - self.calc_Hx(x0), rtol=tolU, itnlim=500, show=show)
+            x = x0 + K.x
+        self.telemetry.count("minres_iterations", K.itn)
+
+        # add solution to subspace, with H x evaluated by the operator as the solve is inexact
+        if self.recycle > 0:
+            D.append(x)
+            HD.append(self.calc_Hx(x))
+            del D[:-self.recycle]
+            del HD[:-self.recycle]
+
+        return x
+
     def calc_Hx(self, x):
         """
         Return the product of H (P'*J'*J*P) with a given x
@@ -830,6 +1547,57 @@ class GNAlgo:
 
         return Hx
 
+    def calc_recycle_basis(self, steps):
+        """
+        Return basis of recycled subspace from previous Gauss-Newton steps
+
+        :type steps: list:numpy.ndarray
+        :param steps: Previous Gauss-Newton steps (in preconditioned variables)
+
+        :return:
+            :Z: *numpy.ndarray*
+
+            Recycled subspace basis, columns normalised steps (None if no non-zero steps)
+        """
+
+        Z = [step / norm(step) for step in steps if norm(step) > 0]
+
+        if Z == []:
+            return None
+
+        return column_stack(Z)
+
+    def calc_galerkin_guess(self, D, HD, b):
+        """
+        Return initial guess for solution of H x = b by Galerkin projection onto a subspace, i.e. x0 = D c where
+        (D' H D) c = D' b
+
+        :type D: list:numpy.ndarray
+        :param D: Subspace basis vectors
+
+        :type HD: list:numpy.ndarray
+        :param HD: Products of H with subspace basis vectors
+
+        :type b: numpy.ndarray
+        :param b: Right hand side vector
+
+        :return:
+            :x0: *numpy.ndarray*
+
+            Initial guess (None if subspace empty)
+        """
+
+        if D == []:
+            return None
+
+        D = column_stack(D)
+        G = dot(D.T, column_stack(HD))
+        G = (G + G.T) / 2
+
+        c = lstsq(G, dot(D.T, b))[0]
+
+        return dot(D, c)
+
     def unconvert_values(self, values_con, unc, idx, idx_orig):
         """
         Return variable data for each covariate in the original form for all variable data, undoing the
@@ -851,40 +1619,13 @@ class GNAlgo:
         """
 
         N_cov = idx['n_cov'][-1]  # total number of covariates
-        mcxyz = idx['idx']  # cumulative variables by block
         N_mu = idx['cNm'][-1]
-        N_sensors = len(set([i for pair in idx['Im'] for i in pair])) - 1  # total number of sensors
-        N_mu_s = len(idx['Im'])  # total number of match-up series
 
         values = array([])  # initialise list for covariate data
 
         # get covariate data covariate by covariate
         for i in xrange(len(idx['n_mu'])):
-
-            # find location of data in xyza
-            ib = mcxyz[i]
-            ie = ib + int(idx['N_var'][i])
-
-            # undo conversion of data from ConvertData.convert4GN depending on correlation form
-            # and add to radiances list
-            block_unc = unc[i]
-
-            # a. random correlation - unscale and add to covariate list
-            if block_unc.form == "r":
-                values = append(values, values_con[ib:ie] * block_unc.uR)
-
-            # b. random+systematic correlation - unscale components and recombine
-            if block_unc.form == 'rs':
-                # get index of required systematic value
-                indices = [(i1, i2, i3) for i1, i2, i3 in zip(idx['n_sensor'], idx['n_mu'], idx['n_cov'])]
-                im = indices.index((N_sensors, N_mu_s, idx['n_cov'][i]))
-                isys = mcxyz[im + 1] - N_sensors + idx['n_sensor'][i] - 1
-
-                values = append(values, values_con[ib:ie] * block_unc.uR + values_con[isys] * block_unc.uS)
-
-            # c. averaging correlation - average raw counts to counts
-            if block_unc.form == 'ave':
-                values = append(values, block_unc.W.dot(values_con[ib:ie]))
+            values = append(values, self.unconvert_block(values_con, unc, idx, i))
 
         # Reformat into data arrays
         H = zeros((N_mu, 2*N_cov))
@@ -909,6 +1650,103 @@ class GNAlgo:
 
         return H
 
+    def unconvert_block(self, values_con, unc, idx, i):
+        """
+        Return variable data of a data block in the original form, undoing the reparameterisation performed in
+        ConvertData.convert2ind()
+
+        :type values_con: numpy.ndarray
+        :param values_con: Converted variable data
+
+        :type unc: list
+        :param unc: Uncertainties associated with blocks of variable data
+
+        :type idx: dict
+        :param idx: Dictionary describing structure of variable data
+
+        :type i: int
+        :param i: Block index
+
+        :return:
+            :values: *numpy.ndarray*
+
+            Block values in original form
+        """
+
+        mcxyz = idx['idx']  # cumulative variables by block
+        N_sensors = len(set([n for pair in idx['Im'] for n in pair])) - 1  # total number of sensors
+        N_mu_s = len(idx['Im'])  # total number of match-up series
+
+        # find location of data in xyza
+        ib = mcxyz[i]
+        ie = ib + int(idx['N_var'][i])
+
+        # undo conversion of data from ConvertData.convert4GN depending on correlation form
+        block_unc = unc[i]
+
+        # a. random correlation - unscale
+        if block_unc.form == "r":
+            return values_con[ib:ie] * block_unc.uR
+
+        # b. random+systematic correlation - unscale components and recombine
+        if block_unc.form == 'rs':
+            # get index of required systematic value
+            indices = [(i1, i2, i3) for i1, i2, i3 in zip(idx['n_sensor'], idx['n_mu'], idx['n_cov'])]
+            im = indices.index((N_sensors, N_mu_s, idx['n_cov'][i]))
+            isys = mcxyz[im + 1] - N_sensors + idx['n_sensor'][i] - 1
+
+            return values_con[ib:ie] * block_unc.uR + values_con[isys] * block_unc.uS
+
+        # c. averaging correlation - average raw counts to counts
+        if block_unc.form == 'ave':
+            return block_unc.W.dot(values_con[ib:ie])
+
+    def iter_residuals(self, f, HData):
+        """
+        Generate residuals in the original form match-up series by match-up series, undoing the reparameterisation
+        performed in ConvertData.convert2ind() one match-up series at a time (see unconvert_values and unconvert_ks),
+        so the full unconverted residual data is never held in memory
+
+        :type f: numpy.ndarray
+        :param f: Converted residuals, variables followed by ks
+
+        :type HData: harm_data_reader.HarmData
+        :param HData: Converted harmonisation data
+
+        :return:
+            :residuals: *generator*
+
+            Generator of tuple of (data residuals, in the original H format, adjustment factor residuals) per
+            match-up series
+        """
+
+        idx = HData.idx
+        N_var = idx['idx'][-1]
+        N_cov = idx['n_cov'][-1]
+
+        for i in xrange(len(idx['Im'])):
+            n_mu = i + 1
+            istartm = idx['cNm'][i]
+            iendm = idx['cNm'][i + 1]
+
+            H = zeros((iendm - istartm, 2*N_cov))
+
+            for k in xrange(len(idx['n_mu'])):
+                if idx['n_mu'][k] != n_mu:
+                    continue
+
+                values = self.unconvert_block(f[:N_var], HData.unc, idx, k)
+
+                # if the sensor is the first sensor in the match-up series
+                if idx['Im'][i][0] == idx['n_sensor'][k]:
+                    H[:, idx['n_cov'][k] - 1] = values
+
+                # if the sensor is the second sensor in the match-up series:
+                if idx['Im'][i][1] == idx['n_sensor'][k]:
+                    H[:, idx['n_cov'][k]+N_cov-1] = values
+
+            yield H, f[N_var + istartm:N_var + iendm] * HData.unck[i].uR
+
     def unconvert_ks(self, ks_con, unck, idx):
         """
         Return variable data for each covariate in the original form for all variable data, undoing the
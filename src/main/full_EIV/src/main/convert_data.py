@@ -25,13 +25,15 @@ class ConvertData:
         :convert2ind:
             reparameterises input data such that output data are independent quantities, required for the Gauss-Newton
             and pre-conditioner algorithm
+        :conversion_key:
+            return key identifying data block for conversion cache
         :sample4PC:
             sample data so that the only remaining correlations arise from systematic effects, required for the
             pre-conditioner algorithm
 
     """
 
-    def convert2ind(self, HData):
+    def convert2ind(self, HData, cache=None):
         """
         Return a reparameterisation of the input data such that output data are independent quantities (suitable for
         use in the pre-conditioner and Gauss-Newton algorithms)
@@ -39,6 +41,11 @@ class ConvertData:
         :param HData: HarmData
             Input harmonisation data for conversion
 
+        :param cache: dict
+            (optional) cache of converted averaging form data blocks, by block key (see conversion_key), reused where
+            available and added to where not - requires HData.series_keys, identifying the content of each match-up
+            series
+
         :return:
             :HData: HarmData
                 Reparameterised harmonisation data suitable for pre-conditioner and GN algorithm
@@ -112,6 +119,20 @@ class ConvertData:
             # 3. averaging type correlation - simulate data without averaging
             elif block_unc.form == "ave":
 
+                # reuse cached conversion of unchanged match-up series block if available
+                key = self.conversion_key(HData, i)
+                if (cache is not None) and (key is not None) and (key in cache) and \
+                        (len(cache[key][0]) == block_unc.W.shape[1]):
+                    Htemp, uRtemp = cache[key]
+
+                    new_values = append(new_values, Htemp)
+                    block_unc.uR = uRtemp.copy()
+
+                    new_len = len(Htemp)
+                    new_idx['N_var'][i] = new_len
+                    new_idx['idx'][i+1:] = [old_idx+new_len-(ie-ib) for old_idx in new_idx['idx'][i+1:]]
+                    continue
+
                 # initialise array
                 Htemp = zeros(block_unc.W.shape[1])
                 uRtemp = zeros(block_unc.W.shape[1])
@@ -178,6 +199,9 @@ class ConvertData:
                 new_values = append(new_values, Htemp)
                 block_unc.uR = uRtemp
 
+                if (cache is not None) and (key is not None):
+                    cache[key] = (Htemp, uRtemp.copy())
+
                 # update N_var of HData.idx to count new variables
                 new_len = len(Htemp)
                 new_idx['N_var'][i] = new_len
@@ -196,6 +220,31 @@ class ConvertData:
 
         return HData
 
+    def conversion_key(self, HData, i):
+        """
+        Return key identifying data block for conversion cache, from the key of its match-up series content and its
+        sensor name and covariate
+
+        :param HData: HarmData
+            Input harmonisation data, with attribute series_keys of key per match-up series
+
+        :param i: int
+            Data block number
+
+        :return:
+            :key: str
+                Data block key (None if match-up series keys not available)
+        """
+
+        series_keys = getattr(HData, "series_keys", None)
+        if series_keys is None:
+            return None
+
+        # (sensor identified by name, sensor numbers depend on the match-up series present)
+        n_mu = HData.idx['n_mu'][i]
+        sensor = HData.idx['sensors'][HData.idx['n_sensor'][i]]
+        return "|".join((series_keys[n_mu-1], str(sensor), str(HData.idx['n_cov'][i])))
+
     def sample4PC(self, HData, sf):
         """
         Return sample of data for which the only data correlations arise from systematic effects
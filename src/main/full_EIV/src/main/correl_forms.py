@@ -5,7 +5,8 @@ Created on Day Month Date  Year Hour:Minute:Second
 """
 
 '''___Python Modules____'''
-from numpy import zeros, ones, arange, trim_zeros
+from hashlib import md5
+from numpy import zeros, ones, arange, trim_zeros, ascontiguousarray, absolute, diff, where, rint, asarray
 from scipy.sparse import csr_matrix
 
 
@@ -42,7 +43,7 @@ class CorrelForm:
 
     """
 
-    def __init__(self, form, data_tuple):
+    def __init__(self, form, data_tuple, W_cache=None):
         """
         Take user input covariate uncertainty correlation form and data and apply as attributes of the class
 
@@ -68,6 +69,9 @@ class CorrelForm:
                 :corrData: numpy.ndarray
                     match-up time data
 
+        :param W_cache: dict
+            (optional) cache of averaging operator matrices by content of their input data, "ave" form W matrices are
+            reused from it where built from the same data (e.g. by another channel) and added to it where not
         """
 
         # set form attribute
@@ -83,7 +87,18 @@ class CorrelForm:
 
         elif form == 'ave':
             self.uR = data_tuple[0]
-            self.W = self.calc_W(data_tuple[0], data_tuple[1], data_tuple[2])
+
+            if W_cache is None:
+                self.W = self.calc_W(data_tuple[0], data_tuple[1], data_tuple[2])
+
+            else:
+                digest = md5(ascontiguousarray(data_tuple[0]).tobytes())
+                digest.update(ascontiguousarray(data_tuple[1]).tobytes())
+                digest.update(repr(data_tuple[2]))
+                key = ("W", digest.hexdigest())
+                if key not in W_cache:
+                    W_cache[key] = self.calc_W(data_tuple[0], data_tuple[1], data_tuple[2])
+                self.W = W_cache[key]
 
     def calc_W(self, u, times, corrData):
         """
@@ -171,6 +186,32 @@ class CorrelForm:
         else:
             return 1. - (diff / width)
 
+
+def calc_W_cols(times, n_w, width):
+    """
+    Return number of columns of averaging W matrix of match-up series (see CorrelForm.calc_W), assuming full width
+    averaging windows, without building the matrix (e.g. to plan a harmonisation run)
+
+    :type times: numpy.ndarray
+    :param times: match-up times
+
+    :type n_w: int
+    :param n_w: averaging window width
+
+    :type width: float
+    :param width: time width of averaging window
+
+    :return:
+        :W_cols: *int*
+
+        number of W matrix columns
+    """
+
+    dt = absolute(diff(asarray(times, dtype=float)))
+    corr = where(dt > width, 0., 1. - dt / width)
+
+    return int(n_w + rint(n_w * (1 - corr)).sum())
+
 if __name__ == "__main__":
 
     def main():
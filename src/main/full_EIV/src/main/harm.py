@@ -5,16 +5,21 @@ Main Operator of NPL Harmonsation Implementation
 '''___Python Modules___'''
 import os.path
 from os import makedirs
-from sys import argv
+from optparse import OptionParser
 
 '''___Third Party Modules___'''
-from numpy import array_equal
+from numpy import array_equal, array, unique, load, savez, ascontiguousarray
+from hashlib import md5
+from numpy.random import RandomState
 
 '''___Harmonisation Modules___'''
 from config_functions import *
-from harm_data_writer import HarmOutput
-from harm_data_errors import gen_errors
+from harm_data_writer import HarmOutput, RES_DTYPE
+from harm_data_errors import gen_errors, trial_rng
 from harm_algo_EIV import HarmAlgo
+from harm_checkpoint import HarmCheckpoint
+from harm_telemetry import HarmTelemetry
+from harm_plan import HarmPlan, read_calibration
 
 '''___Authorship___'''
 __author__ = ["Sam Hunt", "Peter Harris"]
@@ -35,6 +40,23 @@ TOLA = 1e-8     # Gauss-Newton algorithm LSMR tolerance tolA
 TOLB = 1e8      # Gauss-Newton algorithm LSMR tolerance tolB
 TOLU = 1e-8     # Gauss-Newton algorithm Minres rtol
 
+# Gauss-Newton step control
+GLOBALISATION = None    # Gauss-Newton globalisation strategy (None - full steps, "LM" - Levenberg-Marquardt,
+                        # "linesearch" - backtracking line search), overridden by --globalisation
+MXITER = None           # Maximum number of Gauss-Newton iterations (None - number of variables)
+RECYCLE = 0             # Number of previous Gauss-Newton steps recycled to warm start Krylov solves (0 - cold starts)
+
+# Checkpointing
+CHECKPOINT_INTERVAL = 1     # Number of Gauss-Newton iterations between checkpoints (0 - checkpoint only on convergence)
+CHECKPOINT_KEEP = 2         # Number of most recent checkpoints retained
+
+# Monte Carlo
+MC_SEED = 0         # MC master seed, errors for each trial drawn from stream derived from master seed and trial number
+WARM_START = True   # Start MC trials from best estimate run solution (final checkpoint), skipping pre-conditioner stage
+
+# Incremental re-harmonisation
+CONVERSION_CACHE_NAME = "conversion_cache.npz"  # name of cache of converted match-up data, within output directory
+
 
 class HarmOp:
     """
@@ -128,16 +150,54 @@ class HarmOp:
 
             path to store harmonisation residual files
 
+        .. py:attribute:: n_trial
+
+            *int*
+
+            MC trial number
+
+        .. py:attribute:: mc_seed
+
+            *int*
+
+            MC master seed
+
     :Methods:
         .. py:method:: run(...):
 
             This function runs the harmonisation of satellite instrument calibration parameters for group of sensors
             with a reference sensor from the match-up data located in the input directory
 
+        .. py:method:: series_keys(...):
+
+            Return keys identifying the content of the converted data of each match-up series
+
+        .. py:method:: read_previous(...):
+
+            Return previous harmonisation parameters and conversion cache for incremental re-harmonisation
+
+        .. py:method:: write_conversion_cache(...):
+
+            Write cache of converted match-up data blocks to output directory
+
+        .. py:method:: write_output(...):
+
+            Write harmonisation output to file, adding metadata of the software, job and match-up data
+
+        .. py:method:: read_data(...):
+
+            Return harmonisation match-up data from the input directory, adjusted to the best estimates of the data
+            values if an MC trial
+
+        .. py:method:: read_warm_start(...):
+
+            Return solver state of best estimate harmonisation run from its final checkpoint, to warm start MC trials
+
     """
 
     def __init__(self, dataset_paths=None, parameter_path=None, output_dir=None, sensor_model=None,
-                 adjustment_model=None, software_cfg=None, data_reader=None, hout_path=None, hres_paths=None):
+                 adjustment_model=None, software_cfg=None, data_reader=None, hout_path=None, hres_paths=None,
+                 n_trial=None, mc_seed=MC_SEED):
         """
         Initialise harmonisation algorithm class
 
@@ -168,6 +228,12 @@ class HarmOp:
 
         :type hres_paths: str
         :param hres_paths: path of harmonisation residual files
+
+        :type n_trial: int
+        :param n_trial: MC trial number, selects the random number stream errors are drawn from
+
+        :type mc_seed: int
+        :param mc_seed: MC master seed
         """
 
         self.dataset_paths = None
@@ -183,6 +249,8 @@ class HarmOp:
         self.HarmData = None
         self.hout_path = None
         self.hres_paths = None
+        self.n_trial = n_trial
+        self.mc_seed = mc_seed
 
         if dataset_paths is not None:
             self.dataset_paths = dataset_paths
@@ -218,7 +286,9 @@ class HarmOp:
             self.hout_path = hout_path
             self.hres_paths = hres_paths
 
-    def run(self, tolPC=TOLPC, tol=TOL, tolA=TOLA, tolB=TOLB, tolU=TOLU, show=False):
+    def run(self, tolPC=TOLPC, tol=TOL, tolA=TOLA, tolB=TOLB, tolU=TOLU, show=False, globalisation=GLOBALISATION,
+            mxiter=MXITER, resume=False, recycle=RECYCLE, warm_start=WARM_START, HData=None, warm_state=None,
+            previous_dir=None, res_dtype=RES_DTYPE, reuse_conversions=False):
         """
         This function runs the harmonisation of satellite instrument calibration parameters for group of sensors with a
         reference sensor from the match-up data located in the input directory.
@@ -226,6 +296,44 @@ class HarmOp:
         It first reads the match-up data, computes a pre-conditioned solution with a sample of the data and then runs
         a Gauss-Newton iteration algorithm to perform the harmonisation.
 
+        :type globalisation: str
+        :param globalisation: Gauss-Newton step control strategy - None, "LM" or "linesearch" (see GNAlgo.runGN)
+
+        :type mxiter: int
+        :param mxiter: maximum number of Gauss-Newton iterations
+
+        :type resume: bool
+        :param resume: if True, continue from the newest valid checkpoint in the output directory (if any)
+
+        :type recycle: int
+        :param recycle: number of previous Gauss-Newton steps recycled to warm start Krylov solves
+
+        :type warm_start: bool
+        :param warm_start: if True and an MC trial, reuse the pre-conditioner solution of the best estimate run and
+        start the Gauss-Newton iterations from its solution (if its final checkpoint is available)
+
+        :type HData: harm_data_reader.HarmData
+        :param HData: (optional) harmonisation match-up data, as returned by read_data(), if given data is not re-read
+        (e.g. for MC trials run in-process, see harm_mc.py). Modified in place.
+
+        :type warm_state: dict
+        :param warm_state: (optional) best estimate run solver state, as returned by read_warm_start(), if given it is
+        not re-read
+
+        :type previous_dir: str
+        :param previous_dir: (optional) output directory of a previous harmonisation of (some of) the match-up series,
+        for incremental re-harmonisation - conversions of unchanged match-up series are reused from its conversion
+        cache and the harmonisation is started from its parameters (ignored for MC trials)
+
+        :type reuse_conversions: bool
+        :param reuse_conversions: if True, conversions of unchanged match-up series are reused from the conversion cache
+        of a previous run to the output directory (ignored for MC trials, implied by previous_dir) - by default data is
+        converted afresh unless previous_dir is given
+
+        :type res_dtype: str
+        :param res_dtype: storage type of written residuals, 'f8' or 'f4' (residuals of a best estimate run are added
+        back to the data values of its MC trials, so 'f4' residuals perturb the trial inputs by their rounding)
+
         :globals:
             :self.dataDir: *str*
 
@@ -245,58 +353,103 @@ class HarmOp:
         # Initialise
 
         # 1. Directories
-        dataset_paths = self.dataset_paths
-        parameter_path = self.parameter_path
         output_dir = self.output_dir
 
-        # 2. Functions
-        sensor_model = self.sensor_model
-        adjustment_model = self.adjustment_model
-
-        # 3. Software Info
+        # 2. Software Info
         software = self.software
         software_version = self.software_version
         software_tag = self.software_tag
         job_id = self.job_id
         matchup_dataset = self.matchup_dataset
 
-        # 4. Residual Data
+        # 3. Residual Data
         hout_path = self.hout_path
         hres_paths = self.hres_paths
 
         # Default to save residual data
         res = True
 
+        # 4. Telemetry - run report of stage timings and solver operation counts
+        T = HarmTelemetry(software=software, software_version=software_version, software_tag=software_tag,
+                          job_id=job_id, matchup_dataset=matchup_dataset, mc_trial=hout_path is not None)
+
+        # 5. Checkpointing - checkpoints stored in output directory
+        checkpoint = HarmCheckpoint(pjoin(output_dir, "checkpoint"), keep=CHECKPOINT_KEEP,
+                                    interval=CHECKPOINT_INTERVAL)
+
+        state = None
+        if resume:
+            state = checkpoint.load()
+            if state is None:
+                print("No valid checkpoint found, starting from beginning...")
+
         ################################################################################################################
         # 1.	Read Harmonisation Matchup Data
         ################################################################################################################
 
-        print("Opening Data...")
-        HData = self.HarmData(dataset_paths, parameter_path, sensor_model, adjustment_model)
+        if HData is None:
+            print("Opening Data...")
+            with T.stage("read"):
+                HData = self.read_data()
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # MC Trial Test Routine
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         #
-        # Generate errors for the data if MC trials
+        # Generate errors for the data if MC trials (data already adjusted to best estimates in read_data())
         if (hout_path is not None) and (hres_paths is not None):
 
             print("Adding Errors for MC Trial...")
             # # saving residuals not required for MC trial results
             # res = False
 
-            # a. add residuals of previous run to find best estimates of data values
-            with HarmOutput(hout_path, hres_paths) as HOut:
-                HData.values[:, :] += HOut.H_res[:, :]
-                HData.ks[:] += HOut.k_res[:]
+            # adjust best estimates with errors, drawn from trial random number stream (restoring stream state if
+            # resuming, so the same errors are regenerated)
+            rng = RandomState()
+            if self.n_trial is not None:
+                rng = trial_rng(self.mc_seed, self.n_trial)
 
-                if array_equal(HData.idx['Ia'], HOut.parameter_sensors):
-                    HData.a[:] = HOut.parameter[:]
-                else:
-                    raise Exception("Parameter mismatch: Ordering of match-up data and residual parameters different")
+            if (state is not None) and (state["rng_state"] is not None):
+                rng.set_state(state["rng_state"])
+            checkpoint.rng_state = rng.get_state()
+
+            with T.stage("gen_errors"):
+                HData = gen_errors(HData, rng)
+
+            # start from best estimate solution if warm starting
+            if warm_start and (warm_state is None):
+                warm_state = self.read_warm_start()
+
+        if not warm_start:
+            warm_state = None
+        #
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-            # b. adjust best estimates with errors
-            HData = gen_errors(HData)
+        # Conversion cache, from previous run of match-up series (or previous run to this output directory if opted
+        # in) if not MC trial, starting from previous parameters if incremental re-harmonisation. The cache is written
+        # on every run, for later incremental re-harmonisation
+        cache = None
+        reused = []
+        if hout_path is None:
+            HData.series_keys = self.series_keys(HData)
+            cache = {}
+            keys_previous = []
+
+            if previous_dir is not None:
+                print("Starting from previous harmonisation...")
+                a_previous, Ia_previous, cache, keys_previous = self.read_previous(previous_dir)
+
+                if a_previous is not None:
+                    for sensor in unique(HData.idx['Ia']):
+                        if (HData.idx['Ia'] == sensor).sum() == (Ia_previous == sensor).sum():
+                            HData.a[HData.idx['Ia'] == sensor] = a_previous[Ia_previous == sensor]
+            elif reuse_conversions:
+                cache, keys_previous = self.read_previous(output_dir)[2:]
+
+            reused = [path for path, key in zip(self.dataset_paths, HData.series_keys) if key in keys_previous]
+            if (previous_dir is not None) or reuse_conversions:
+                print("Reusing conversions of " + str(len(reused)) + " of " + str(len(self.dataset_paths)) +
+                      " match-up series")
         #
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -304,11 +457,16 @@ class HarmOp:
         # 2.	Perform harmonisation
         ################################################################################################################
 
-        Harmonisation = HarmAlgo(HData)
+        Harmonisation = HarmAlgo(HData, telemetry=T)
 
+        # (residuals generated per match-up series as written, so the full unconverted residual data is never held)
         HOut = HarmOutput()
+        HOut.res_dtype = res_dtype
         HOut.parameter, HOut.parameter_covariance_matrix, HOut.cost, \
-        HOut.cost_dof, HOut.cost_p_value, HOut.H_res, HOut.k_res = Harmonisation.run()
+            HOut.cost_dof, HOut.cost_p_value, HOut.residuals, HOut.k_res = \
+            Harmonisation.run(tolPC=tolPC, tol=tol, tolA=tolA, tolB=tolB, tolU=tolU, show=show,
+                              globalisation=globalisation, mxiter=mxiter, checkpoint=checkpoint, resume=state,
+                              recycle=recycle, warm_start=warm_state, conversion_cache=cache, stream_residuals=True)
 
         print "Final Solution:"
         print HOut.parameter
@@ -320,19 +478,232 @@ class HarmOp:
 
         print 'Writing data to file...'
 
+        # State match-up series reused from previous harmonisation if incremental
+        if previous_dir is not None:
+            HOut.additional_attributes = {"previous_harmonisation": previous_dir,
+                                          "reused_series": ", ".join([os.path.basename(path) for path in reused]),
+                                          "rebuilt_series": ", ".join([os.path.basename(path)
+                                                                       for path in self.dataset_paths
+                                                                       if path not in reused])}
+
+        with T.stage("write"):
+            self.write_output(HOut, HData, output_dir, res=res)
+            if cache is not None:
+                self.write_conversion_cache(output_dir, cache, HData.series_keys)
+
+        # Write run report next to harmonisation output file
+        T.save(pjoin(output_dir, "_".join(("harm", software, software_version, software_tag, job_id,
+                                           HOut.matchup_dataset, "telemetry"))))
+
+    def series_keys(self, HData):
+        """
+        Return keys identifying the content of each match-up series, from its file name and a digest of the data its
+        conversion reads - the data values, uncertainties and averaging operators of each of its data blocks - so a
+        match-up series file rewritten with different data never reuses a cached conversion
+
+        :type HData: harm_data_reader.HarmData
+        :param HData: Harmonisation match-up data, as read (i.e. not converted)
+
+        :return:
+            :keys: *list:str*
+
+            Match-up series keys, ordered as dataset_paths
+        """
+
+        digests = [md5() for n_mu in HData.idx['Im']]
+        for i, n_mu in enumerate(HData.idx['n_mu']):
+            digest = digests[n_mu - 1]
+            block_unc = HData.unc[i]
+
+            digest.update(block_unc.form)
+            digest.update(ascontiguousarray(HData.values[HData.idx['idx'][i]:HData.idx['idx'][i+1]]).tobytes())
+            digest.update(ascontiguousarray(block_unc.uR).tobytes())
+
+            if block_unc.form == "rs":
+                digest.update(repr(block_unc.uS))
+
+            if block_unc.form == "ave":
+                W = block_unc.W.tocsr()
+                for w in (W.data, W.indices, W.indptr):
+                    digest.update(ascontiguousarray(w).tobytes())
+
+        return [":".join((os.path.basename(path), digest.hexdigest()))
+                for path, digest in zip(self.dataset_paths, digests)]
+
+    def read_previous(self, previous_dir):
+        """
+        Return parameters and conversion cache of previous harmonisation, for incremental re-harmonisation
+
+        :type previous_dir: str
+        :param previous_dir: Output directory of previous harmonisation
+
+        :return:
+            :a: *numpy.ndarray*
+
+            Previous harmonisation parameters (None if no output file)
+
+            :Ia: *numpy.ndarray*
+
+            Previous harmonisation parameter sensor names (None if no output file)
+
+            :cache: *dict*
+
+            Cache of converted match-up data blocks, by block key (see ConvertData.convert2ind)
+
+            :keys: *list:str*
+
+            Keys of match-up series of previous harmonisation (empty if no conversion cache)
+        """
+
+        a = None
+        Ia = None
+        cache = {}
+        keys = []
+
+        # previous parameters
+        if os.path.isdir(previous_dir):
+            previous_hout_path = get_harm_paths(previous_dir)[0]
+            if previous_hout_path is not None:
+                with HarmOutput(previous_hout_path) as HOut:
+                    a = HOut.parameter
+                    Ia = HOut.parameter_sensors
+
+        # previous conversion cache
+        cache_path = pjoin(previous_dir, CONVERSION_CACHE_NAME)
+        if os.path.isfile(cache_path):
+            data = load(cache_path)
+            keys = [str(key) for key in data["series"]]
+            for i, key in enumerate(data["blocks"]):
+                cache[str(key)] = (data["H_" + str(i)], data["uR_" + str(i)])
+            data.close()
+
+        return a, Ia, cache, keys
+
+    def write_conversion_cache(self, output_dir, cache, series_keys):
+        """
+        Write cache of converted match-up data blocks to output directory, for the current match-up series only
+
+        :type output_dir: str
+        :param output_dir: Output directory
+
+        :type cache: dict
+        :param cache: Cache of converted match-up data blocks, by block key (see ConvertData.convert2ind)
+
+        :type series_keys: list:str
+        :param series_keys: Keys of current match-up series
+        """
+
+        blocks = [key for key in sorted(cache.keys()) if key.split("|")[0] in series_keys]
+
+        arrays = {"series": array(series_keys, dtype=str), "blocks": array(blocks, dtype=str)}
+        for i, key in enumerate(blocks):
+            arrays["H_" + str(i)] = cache[key][0]
+            arrays["uR_" + str(i)] = cache[key][1]
+
+        cache_path = pjoin(output_dir, CONVERSION_CACHE_NAME)
+        with open(cache_path + ".tmp", "wb") as f:
+            savez(f, **arrays)
+        os.rename(cache_path + ".tmp", cache_path)
+
+    def write_output(self, HOut, HData, output_dir, res=True):
+        """
+        Write harmonisation output to file, adding metadata of the software, job and match-up data
+
+        :type HOut: harm_data_writer.HarmOutput
+        :param HOut: Harmonisation output, with parameter and residual data set
+
+        :type HData: harm_data_reader.HarmData
+        :param HData: Harmonisation match-up data harmonised
+
+        :type output_dir: str
+        :param output_dir: directory to write files to
+
+        :type res: bool
+        :param res: Switch to turn off writing harmonisation output residual file
+        """
+
         # Get metadata
         HOut.parameter_sensors = HData.idx["Ia"]
         HOut.lm = HData.idx['lm']
-        HOut.software = software
-        HOut.software_version = software_version
-        HOut.software_tag = software_tag
-        HOut.job_id = job_id
+        HOut.software = self.software
+        HOut.software_version = self.software_version
+        HOut.software_tag = self.software_tag
+        HOut.job_id = self.job_id
         startDate = str(HData.times[0].year) + '{:02d}'.format(HData.times[0].month) + str(HData.times[0].day)
         endDate = str(HData.times[-1].year) + '{:02d}'.format(HData.times[-1].month) + str(HData.times[-1].day)
-        HOut.matchup_dataset = "_".join((matchup_dataset, startDate, endDate))
+        HOut.matchup_dataset = "_".join((self.matchup_dataset, startDate, endDate))
 
         HOut.save(output_dir, res=res)
 
+    def read_data(self, shared=None):
+        """
+        Return harmonisation match-up data from the input directory. If an MC trial, the data values are adjusted to
+        their best estimates by adding the residuals of the best estimate harmonisation run.
+
+        :type shared: dict
+        :param shared: (optional) data shared between harmonisations of the same match-up data (e.g. per channel, see
+        harm_multi.py), match-up file variables and W matrices common to them are read, built and held once (see
+        harm_data_reader.HarmData.read_series_variables)
+
+        :return:
+            :HData: *harm_data_reader.HarmData*
+
+            Harmonisation match-up data
+        """
+
+        HData = self.HarmData(self.dataset_paths, self.parameter_path, self.sensor_model, self.adjustment_model,
+                              shared=shared)
+
+        # add residuals of previous run to find best estimates of data values if MC trial
+        if (self.hout_path is not None) and (self.hres_paths is not None):
+            with HarmOutput(self.hout_path, self.hres_paths, lazy=True) as HOut:
+
+                # residuals added series by series, as read, rather than first concatenated in memory
+                HRes = HOut.residual_data
+                for i in xrange(len(HRes.paths)):
+                    istart = HRes.idx[i]
+                    iend = HRes.idx[i+1]
+                    if HRes.n_col is not None:
+                        HData.values[istart:iend, :] += HRes.series(i, "H_res", cache=False)
+                    HData.ks[istart:iend] += HRes.series(i, "k_res", cache=False)
+
+                if array_equal(HData.idx['Ia'], HOut.parameter_sensors):
+                    HData.a[:] = HOut.parameter[:]
+                else:
+                    raise Exception("Parameter mismatch: Ordering of match-up data and residual parameters different")
+
+        return HData
+
+    def read_warm_start(self):
+        """
+        Return solver state of best estimate harmonisation run from its final checkpoint, stored in the checkpoint
+        directory alongside the best estimate harmonisation output file.
+
+        :return:
+            :state: *dict*
+
+            Best estimate run solver state, as returned by HarmCheckpoint.load(), None if no valid checkpoint of a
+            converged best estimate run found
+        """
+
+        if self.hout_path is None:
+            return None
+
+        checkpoint_dir = pjoin(os.path.dirname(self.hout_path), "checkpoint")
+        if not os.path.isdir(checkpoint_dir):
+            print("No best estimate checkpoint found, starting MC trial from beginning...")
+            return None
+
+        state = HarmCheckpoint(checkpoint_dir).load()
+        if state is None:
+            print("No valid best estimate checkpoint found, starting MC trial from beginning...")
+
+        elif not state["info"].get("conv", False):
+            print("Best estimate run not converged, starting MC trial from beginning...")
+            state = None
+
+        return state
+
 if __name__ == "__main__":
 
     def main():
@@ -342,17 +713,40 @@ if __name__ == "__main__":
         ################################################################################################################
 
         # 1. Get configuration filename
-        if len(argv) == 2:
+        usage = "usage: %prog [options] job-cfg [hout-dir n-trial]"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--resume", action="store_true", dest="resume", default=False,
+                          help="continue from newest valid checkpoint in output directory")
+        parser.add_option("--seed", type="int", dest="seed", default=MC_SEED, help="MC master seed")
+        parser.add_option("--cold-start", action="store_false", dest="warm_start", default=WARM_START,
+                          help="run MC trial from beginning, not from best estimate run solution")
+        parser.add_option("--previous", dest="previous_dir", default=None,
+                          help="output directory of previous harmonisation to incrementally re-harmonise from")
+        parser.add_option("--reuse-conversions", action="store_true", dest="reuse_conversions", default=False,
+                          help="reuse conversions of unchanged match-up series cached by previous run to output "
+                               "directory")
+        parser.add_option("--plan", action="store_true", dest="plan", default=False,
+                          help="report predicted memory and time requirements of job without running it")
+        parser.add_option("--float32-residuals", action="store_const", dest="res_dtype", const='f4',
+                          default=RES_DTYPE, help="write residuals as float32, halving residual file size")
+        parser.add_option("--globalisation", dest="globalisation", default=GLOBALISATION, choices=["LM", "linesearch"],
+                          help="Gauss-Newton step control, LM or linesearch (default full Gauss-Newton steps)")
+        (options, args) = parser.parse_args()
+
+        if len(args) == 1:
             # else have usage:
-            # argv[1] - path of job config file
-            job_cfg_fname = os.path.abspath(argv[1])
+            # args[0] - path of job config file
+            job_cfg_fname = os.path.abspath(args[0])
             hout_dir = None
             n_trial = None
 
-        elif len(argv) == 4:
-            job_cfg_fname = os.path.abspath(argv[1])
-            hout_dir = os.path.abspath(argv[2])
-            n_trial = int(argv[3])
+        elif len(args) == 3:
+            job_cfg_fname = os.path.abspath(args[0])
+            hout_dir = os.path.abspath(args[1])
+            n_trial = int(args[2])
+
+        else:
+            parser.error("Incorrect number of input arguments")
 
         # 2. Read configuration data
         conf = {}   # dictionary to store data
@@ -372,6 +766,13 @@ if __name__ == "__main__":
         sensor_functions = import_file(sensor_functions_path)
         harm_data_reader = import_file(data_reader_path)
 
+        # Report plan only if planning
+        if options.plan:
+            plan = HarmPlan(calibration=read_calibration(), recycle=RECYCLE)
+            plan.from_files(dataset_paths, parameter_path, harm_data_reader.HarmData)
+            print plan.report()
+            return 0
+
         # 5. Get harmonisation output files paths if Monte Carlo run
         hout_path = None
         hres_paths = None
@@ -402,10 +803,15 @@ if __name__ == "__main__":
                    software_cfg=conf,
                    data_reader=harm_data_reader.HarmData,
                    hout_path=hout_path,
-                   hres_paths=hres_paths)
+                   hres_paths=hres_paths,
+                   n_trial=n_trial,
+                   mc_seed=options.seed)
 
         # Run algorithm
-        H.run(tolPC=TOLPC, tol=TOL, tolA=TOLA, tolB=TOLB, tolU=TOLU, show=True)
+        H.run(tolPC=TOLPC, tol=TOL, tolA=TOLA, tolB=TOLB, tolU=TOLU, show=True, globalisation=options.globalisation,
+              mxiter=MXITER, resume=options.resume, recycle=RECYCLE, warm_start=options.warm_start,
+              previous_dir=options.previous_dir, res_dtype=options.res_dtype,
+              reuse_conversions=options.reuse_conversions)
 
         return 0
 
@@ -10,6 +10,7 @@ Contains the functionality to run the NPL Full EIV harmonisation method.
 import convert_data
 from pc_algo import PCAlgo
 from GN_algo import GNAlgo
+from harm_telemetry import HarmTelemetry
 
 '''___Authorship___'''
 __author__ = ["Sam Hunt", "Peter Harris"]
@@ -47,30 +48,98 @@ class HarmAlgo:
 
         Object containing functionality to convert *harm_data_reader.HarmData* objects
 
+        ..py:attribute:: telemetry:
+
+        *harm_telemetry.HarmTelemetry*
+
+        Record of stage timings and solver operation counts
+
     :Methods:
         .. py:method:: run(...):
 
             Return harmonised parameters and diagnostic data for input harmonisaton match-up data
+
+        .. py:method:: run_batch(...):
+
+            Return harmonised parameters and diagnostic data for a batch of perturbations of the input match-up data
+
+        .. py:method:: linearise(...):
+
+            Return harmonised parameters of a previous solution and their sensitivity to the converted match-up data
     """
 
-    def __init__(self, HData):
+    def __init__(self, HData, telemetry=None):
         """
         Initialise HarmAlgo class
 
         :type HData: harm_data_reader.HarmData
         :param HData: Input harmonisation data object containing match-up data to be harmonised
+
+        :type telemetry: harm_telemetry.HarmTelemetry
+        :param telemetry: (optional) telemetry object to record stage timings and solver operation counts to
         """
 
         # Initialise class
         self.convert_data = convert_data.ConvertData()
         self.HData = HData
 
-    def run(self):
+        self.telemetry = telemetry
+        if telemetry is None:
+            self.telemetry = HarmTelemetry()
+
+    def run(self, tolPC=1e-6, tol=1e-6, tolA=1e-8, tolB=1e8, tolU=1e-8, show=True, globalisation=None, mxiter=None,
+            checkpoint=None, resume=None, recycle=0, warm_start=None, conversion_cache=None, stream_residuals=False):
         """
         Return harmonised parameters and diagnostic data for input harmonisaton match-up data
 
-        :type HData: harm_data_writer.HarmData
-        :param HData: Input harmonisation match-up data object
+        :type tolPC: float
+        :param tolPC: Tolerance for convergance of preconditioner algorithm
+
+        :type tol: float
+        :param tol: Tolerance for convergance of GN algorithm
+
+        :type tolA: float
+        :param tolA: tolerance tolA for LSMR in GN algorithm
+
+        :type tolB: float
+        :param tolB: tolerance tolB for LSMR in GN algorithm
+
+        :type tolU: float
+        :param tolU: tolerance for uncertainty calculation convergence (rtol in Minres)
+
+        :type show: bool
+        :param show: boolean to decide if stdout output of algorithm
+
+        :type globalisation: str
+        :param globalisation: (optional) step control strategy for the GN iterations - None, "LM" or "linesearch" (see
+        GNAlgo.runGN)
+
+        :type mxiter: int
+        :param mxiter: (optional) maximum number of GN iterations
+
+        :type checkpoint: harm_checkpoint.HarmCheckpoint
+        :param checkpoint: (optional) checkpoint object, if given the pre-conditioner solution and Gauss-Newton
+        iterations are checkpointed
+
+        :type resume: dict
+        :param resume: (optional) solver state to resume from, as returned by HarmCheckpoint.load()
+
+        :type recycle: int
+        :param recycle: (optional) number of previous GN steps recycled to warm start Krylov solves (see GNAlgo.runGN)
+
+        :type warm_start: dict
+        :param warm_start: (optional) solver state of a previous harmonisation of the same match-up data (e.g. the best
+        estimate run for MC trials), as returned by HarmCheckpoint.load(). If given (and not resuming), the
+        pre-conditioner stage is skipped, reusing its pre-conditioner solution, and the GN iterations start from its
+        variable and parameter estimates
+
+        :type conversion_cache: dict
+        :param conversion_cache: (optional) cache of converted data blocks of unchanged match-up series, reused and
+        updated by the conversion of the input data (see ConvertData.convert2ind)
+
+        :type stream_residuals: bool
+        :param stream_residuals: (optional) if True, H_res is returned as a generator of residuals per match-up series
+        and K_res as None (see GNAlgo.iter_residuals)
 
         :return:
             :a: *numpy.ndarray*
@@ -96,6 +165,14 @@ class HarmAlgo:
             :p: *float*
 
             Chi-squared probability
+
+            :H_res: *numpy.ndarray*
+
+            Data residuals (generator of data and k residuals per match-up series if stream_residuals)
+
+            :K_res: *numpy.ndarray*
+
+            k residuals (None if stream_residuals)
         """
 
         ################################################################################################################
@@ -103,24 +180,53 @@ class HarmAlgo:
         ################################################################################################################
 
         HData = self.HData
+        T = self.telemetry
 
         # Flatten values into required 1d form
-        HData.values = HData.flatten_values(HData.values, HData.idx)
+        with T.stage("flatten"):
+            HData.values = HData.flatten_values(HData.values, HData.idx)
 
         ################################################################################################################
         # 2.	Compute Approximate Solution to find Pre-conditioner to Full Problem
         ################################################################################################################
 
-        print("Determine approximate solution to find pre-conditioner to full problem...")
+        # Pre-conditioner solution from checkpoint if resuming (and of the same number of parameters)
+        state = resume
+        if (state is not None) and ((state.get("a_PC") is None) or (state["a_PC"].shape != HData.a.shape)):
+            print("Checkpoint of different match-up data, starting from beginning...")
+            state = None
+
+        if state is not None:
+            print("Resuming from checkpoint...")
+
+            a_PC, S = state["a_PC"], state["S"]
+
+        elif warm_start is not None:
+            print("Warm starting from previous solution...")
+
+            a_PC, S = warm_start["a_PC"], warm_start["S"]
 
-        # a. sample data for preconditioning
-        HData_sample = self.convert_data.sample4PC(HData, sf=1)
+        else:
+            print("Determine approximate solution to find pre-conditioner to full problem...")
+
+            # a. sample data for preconditioning
+            with T.stage("sample4PC"):
+                HData_sample = self.convert_data.sample4PC(HData, sf=1)
+
+            # b. determine preconditioner solution
+            with T.stage("runPC"):
+                PC = PCAlgo(HData_sample)
+                a_PC, S = PC.runPC(tol=tolPC)
 
-        # b. determine preconditioner solution
-        PC = PCAlgo(HData_sample)
-        a_PC, S = PC.runPC(tol=1e-6)
         HData.a = a_PC  # set PC output parameters as current parameter estimates
 
+        # c. checkpoint preconditioner solution
+        if checkpoint is not None:
+            checkpoint.S = S
+            checkpoint.a_PC = a_PC
+            if state is None:
+                checkpoint.save("PC")
+
         ################################################################################################################
         # 3.	Compute Full Solution using Gauss-Newton Algorithm
         ################################################################################################################
@@ -128,14 +234,149 @@ class HarmAlgo:
         print("Computing full solution...")
 
         # a. reparameterise input data such that output data are independent quantities
-        HData = self.convert_data.convert2ind(HData)
+        with T.stage("convert2ind"):
+            HData = self.convert_data.convert2ind(HData, cache=conversion_cache)
 
         # b. run GN algorithm on modified data
-        GN = GNAlgo(HData, S)
-        a, V, F, v, p, H_res, K_res = GN.runGN(show=True)
+        GN = GNAlgo(HData, S, telemetry=T)
+        if (state is None) or (state["stage"] != "GN"):
+            state = None
+
+        # (starting from previous solution if warm starting, where consistent with this data)
+        if (state is None) and (warm_start is not None) and (warm_start.get("xyza") is not None):
+            if warm_start["xyza"].shape == GN.xyza.shape:
+                GN.xyza = warm_start["xyza"].copy()
+            else:
+                print("Warm start solution size mismatch, starting from pre-conditioner solution...")
+
+        with T.stage("runGN"):
+            a, V, F, v, p, H_res, K_res = GN.runGN(tol=tol, tolA=tolA, tolB=tolB, tolU=tolU, show=show,
+                                                   globalisation=globalisation, mxiter=mxiter,
+                                                   checkpoint=checkpoint, resume=state,
+                                                   recycle=recycle, stream_residuals=stream_residuals)
 
         return a, V, F, v, p, H_res, K_res
 
+    def run_batch(self, HData_trials, warm_start, tol=1e-6, tolA=1e-8, tolU=1e-8, show=True, mxiter=None):
+        """
+        Return harmonised parameters and diagnostic data for a batch of perturbations of the input match-up data (e.g.
+        MC trial datasets), solved simultaneously by chord Gauss-Newton iterations from a previous solution of the input
+        match-up data (see GNAlgo.runGN_batch)
+
+        :type HData_trials: list:harm_data_reader.HarmData
+        :param HData_trials: Perturbed match-up datasets, of the same structure as the input match-up data
+
+        :type warm_start: dict
+        :param warm_start: solver state of converged harmonisation of the input match-up data, as returned by
+        HarmCheckpoint.load()
+
+        :type tol: float
+        :param tol: Tolerance for convergance of GN algorithm
+
+        :type tolA: float
+        :param tolA: Tolerance for convergence of block least-squares solves in GN algorithm
+
+        :type tolU: float
+        :param tolU: tolerance for uncertainty calculation convergence (rtol in Minres)
+
+        :type show: bool
+        :param show: boolean to decide if stdout output of algorithm
+
+        :type mxiter: int
+        :param mxiter: (optional) maximum number of GN iterations
+
+        :return:
+            :results: *list:tuple*
+
+            Harmonisation results per perturbed dataset, as tuple of (a, V, F, v, p, H_res, K_res), as returned by run
+        """
+
+        T = self.telemetry
+
+        if (warm_start is None) or (warm_start.get("xyza") is None):
+            raise ValueError("Batch harmonisation requires the solution of a previous harmonisation run")
+
+        # Convert input data and perturbed datasets
+        with T.stage("convert2ind"):
+            HData = self.HData
+            HData.values = HData.flatten_values(HData.values, HData.idx)
+            HData = self.convert_data.convert2ind(HData)
+
+            HData_trials_con = []
+            for HData_trial in HData_trials:
+                HData_trial.values = HData_trial.flatten_values(HData_trial.values, HData_trial.idx)
+                HData_trials_con.append(self.convert_data.convert2ind(HData_trial))
+
+        # Run chord GN iterations from previous solution, with Jacobian at previous solution
+        GN = GNAlgo(HData, warm_start["S"], telemetry=T)
+
+        if warm_start["xyza"].shape != GN.xyza.shape:
+            raise ValueError("Solution size mismatch: Previous harmonisation run of different match-up data")
+
+        GN.xyza = warm_start["xyza"].copy()
+        GN.reset_jacobian()
+
+        with T.stage("runGN_batch"):
+            results = GN.runGN_batch(HData_trials_con, tol=tol, tolA=tolA, tolU=tolU, show=show, mxiter=mxiter)
+
+        return results
+
+    def linearise(self, state, tolU=1e-8, show=False):
+        """
+        Return harmonised parameters of a previous solution of the input match-up data and the sensitivity matrix of
+        the parameters to the converted match-up data at that solution (see GNAlgo.calc_sensitivity), for first order
+        propagation of data perturbations, e.g. linearised MC. The match-up data is converted in place, self.HData is
+        then the converted data G applies to.
+
+        :type state: dict
+        :param state: solver state of converged harmonisation of the match-up data, as returned by
+        HarmCheckpoint.load()
+
+        :type tolU: float
+        :param tolU: tolerance for convergence of sensitivity calculation (rtol in Minres)
+
+        :type show: bool
+        :param show: boolean to decide if stdout output of algorithm
+
+        :return:
+            :a: *numpy.ndarray*
+
+            Harmonised parameters
+
+            :G: *numpy.ndarray*
+
+            Sensitivity matrix, shape (number of parameters, number of converted variables + number of match-ups)
+        """
+
+        HData = self.HData
+        T = self.telemetry
+
+        if (state is None) or (state.get("xyza") is None):
+            raise ValueError("Linearisation requires the solution of a previous harmonisation run")
+
+        with T.stage("flatten"):
+            HData.values = HData.flatten_values(HData.values, HData.idx)
+
+        with T.stage("convert2ind"):
+            HData = self.convert_data.convert2ind(HData)
+        self.HData = HData
+
+        GN = GNAlgo(HData, state["S"], telemetry=T)
+
+        if state["xyza"].shape != GN.xyza.shape:
+            raise ValueError("Solution size mismatch: Previous harmonisation run of different match-up data")
+
+        GN.xyza = state["xyza"].copy()
+        GN.reset_jacobian()
+
+        N_var = HData.idx['idx'][-1]
+        a = GN.xyza[N_var:]
+
+        with T.stage("calc_sensitivity"):
+            G = GN.calc_sensitivity(tolU=tolU, show=show)
+
+        return a, G
+
 if __name__ == "__main__":
     pass
 
@@ -0,0 +1,259 @@
+"""
+Synthetic harmonisation benchmark, to measure solver performance (e.g. LSMR iteration count) on generated match-up data
+with random, random+systematic and averaging correlation forms, without requiring match-up data files
+
+Runs the harmonisation and tabulates LSMR/MINRES iterations, matrix-vector products and timings, to compare solver
+changes against on a fixed problem.
+
+Usage:
+python harm_benchmark.py [--n-sensors N] [--n-matchups N] [--seed N] [--report-dir path/to/dir]
+
+Created on Wed Oct 14  2026 10:00:00
+"""
+
+'''___Python Modules___'''
+from os.path import join as pjoin
+from copy import deepcopy
+from optparse import OptionParser
+
+'''___Third Party Modules___'''
+from numpy import zeros, ones, arange, array, asarray
+from numpy.random import RandomState
+
+'''___Harmonisation Modules___'''
+from harm_data_reader import HarmData
+from correl_forms import CorrelForm
+from harm_algo_EIV import HarmAlgo
+from harm_telemetry import HarmTelemetry
+from sensor_functions_AVHRR_3 import sensor_model, adjustment_model
+
+'''___Constants___'''
+
+# Synthetic match-up data definition
+N_COV = 4           # number of covariates in sensor model (Cs, Cict, Ce, Rict - see sensor_functions_AVHRR_3)
+N_W = 5             # width of averaging window for averaged covariates (raw scanlines)
+DT = 10.0           # time between match-ups
+CORR_DATA = 25.0    # time width of averaging window
+
+# Covariate true value generation (mean, standard deviation) and uncertainties
+CS = (40.0, 1.0)        # space counts - averaged, raw scanline uncertainty 1.0
+CICT = (400.0, 2.0)     # ICT counts - averaged, raw scanline uncertainty 2.0
+CE_RANGE = (100., 380.)  # Earth counts - random+systematic
+UR_CS = 1.0
+UR_CICT = 2.0
+UR_CE = 0.5
+US_CE = 0.2
+RICT = (100.0, 0.5)     # ICT radiance - random
+UR_RICT = 0.05
+UR_REF = 0.1            # reference sensor radiance uncertainty
+UK = 0.05               # match-up adjustment factor uncertainty
+
+# Calibration parameters true value generation (standard deviation of each parameter)
+A_SD = (0.5, 0.01, 1e-6)
+
+
+def generate_synthetic_data(n_sensors=3, n_matchups=1000, seed=0):
+    """
+    Return synthetic harmonisation match-up data for a chain of match-up series, reference-sensor 1, sensor 1-sensor 2,
+    ..., with the AVHRR sensor model of sensor_functions_AVHRR_3 and covariates of each correlation form:
+
+    * C_S, C_ICT - averaging correlation ("ave")
+    * C_E - random+systematic correlation ("rs")
+    * R_ICT - random correlation ("r")
+
+    :type n_sensors: int
+    :param n_sensors: number of sensors (excluding reference sensor)
+
+    :type n_matchups: int
+    :param n_matchups: number of match-ups per match-up series
+
+    :type seed: int
+    :param seed: random number generator seed
+
+    :return:
+        :HData: *harm_data_reader.HarmData*
+
+        Synthetic harmonisation data
+
+        :a_true: *numpy.ndarray*
+
+        True calibration parameters
+    """
+
+    rng = RandomState(seed)
+    m = N_COV
+
+    ################################################################################################################
+    # 1. Build idx dictionary which describes required data structure
+    ################################################################################################################
+
+    sensors = [-1] + range(1, n_sensors + 1)
+    Im = [[i, i + 1] for i in xrange(n_sensors)]
+    Nm = [n_matchups] * n_sensors
+    cNm = [n_matchups * i for i in xrange(n_sensors + 1)]
+    lm = array([[sensors[pair[0]], sensors[pair[1]], n_matchups] for pair in Im])
+
+    s_list = [num for pair in Im for num in pair if num != 0]
+    n_sensor = [0] + s_list * m
+
+    sensor_mus = [1] + [i + 1 for i in xrange(1, n_sensors) for j in xrange(2)]
+    n_mu = [1] + sensor_mus * m
+
+    n_cov = [1]
+    for cov in range(1, m + 1):
+        n_cov += [cov] * (2 * n_sensors - 1)
+
+    N_var = [Nm[n - 1] for n in n_mu]
+    idxs = [0]
+    for N in N_var:
+        idxs.append(idxs[-1] + N)
+
+    idx = {"Nm": Nm,
+           "cNm": cNm,
+           "Im": Im,
+           "lm": lm,
+           "sensors": sensors,
+           "n_sensor": n_sensor,
+           "n_mu": n_mu,
+           "n_cov": n_cov,
+           "N_var": N_var,
+           "idx": idxs,
+           "Ia": asarray([sensors[s] for s in xrange(1, n_sensors + 1) for n_p in xrange(len(A_SD))])}
+
+    ################################################################################################################
+    # 2. Generate true values and observations
+    ################################################################################################################
+
+    a_true = array([rng.normal(0.0, sd) for s in xrange(n_sensors) for sd in A_SD])
+    n_p = len(A_SD)
+
+    times = zeros(cNm[-1])
+    values = zeros((cNm[-1], 2 * m))
+    ks = zeros(cNm[-1])
+    unc_data = {}   # (n_sensor, n_mu, n_cov) -> CorrelForm
+
+    sys_errors = rng.normal(0.0, US_CE, n_sensors + 1)  # systematic error of C_E per sensor
+
+    for i, pair in enumerate(Im):
+        istart = cNm[i]
+        iend = cNm[i + 1]
+        times[istart:iend] = arange(n_matchups) * DT
+
+        Rs = []
+        for j, s in enumerate(pair):
+            col = j * m
+
+            if s == 0:
+                Rs.append(None)
+                continue
+
+            # true covariates
+            X = [rng.normal(CS[0], CS[1], n_matchups),
+                 rng.normal(CICT[0], CICT[1], n_matchups),
+                 rng.uniform(CE_RANGE[0], CE_RANGE[1], n_matchups),
+                 rng.normal(RICT[0], RICT[1], n_matchups)]
+            Rs.append(sensor_model(a_true[(s - 1) * n_p:s * n_p], X)[0])
+
+            # observed covariates
+            for n_c, u_raw in zip((1, 2), (UR_CS, UR_CICT)):
+                unc = CorrelForm("ave", (ones((n_matchups, N_W)) * u_raw, times[istart:iend], CORR_DATA))
+                values[istart:iend, col + n_c - 1] = X[n_c - 1] + unc.W.dot(rng.normal(0.0, 1.0, unc.W.shape[1]))
+                unc_data[(s, i + 1, n_c)] = unc
+
+            values[istart:iend, col + 2] = X[2] + rng.normal(0.0, UR_CE, n_matchups) + sys_errors[s]
+            unc_data[(s, i + 1, 3)] = CorrelForm("rs", (ones(n_matchups) * UR_CE, US_CE))
+
+            values[istart:iend, col + 3] = X[3] + rng.normal(0.0, UR_RICT, n_matchups)
+            unc_data[(s, i + 1, 4)] = CorrelForm("r", ones(n_matchups) * UR_RICT)
+
+        # reference sensor radiance, defined so the true adjustment factor is zero
+        if pair[0] == 0:
+            Rs[0] = Rs[1]
+            values[istart:iend, 0] = Rs[0] + rng.normal(0.0, UR_REF, n_matchups)
+            unc_data[(0, i + 1, 1)] = CorrelForm("r", ones(n_matchups) * UR_REF)
+
+        ks[istart:iend] = Rs[1] - Rs[0] + rng.normal(0.0, UK, n_matchups)
+
+    ################################################################################################################
+    # 3. Compile harmonisation data object
+    ################################################################################################################
+
+    HData = HarmData()
+    HData.values = values
+    HData.unc = [unc_data[(s, mu, cov)] for s, mu, cov in zip(n_sensor, n_mu, n_cov)]
+    HData.ks = ks
+    HData.unck = [CorrelForm("r", ones(n_matchups) * UK) for i in xrange(n_sensors)]
+    HData.a = a_true + array([rng.normal(0.0, 0.1 * sd) for s in xrange(n_sensors) for sd in A_SD])
+    HData.idx = idx
+    HData.idx_orig = deepcopy(idx)
+    HData.sensor_model = sensor_model
+    HData.adjustment_model = adjustment_model
+    HData.times = HData.seconds2date(times)
+
+    return HData, a_true
+
+
+def run_benchmark(HData, **kwargs):
+    """
+    Return telemetry and solution of harmonisation of copy of input data
+
+    :type HData: harm_data_reader.HarmData
+    :param HData: Harmonisation data (not modified)
+
+    :param kwargs: Additional arguments to HarmAlgo.run
+
+    :return:
+        :T: *harm_telemetry.HarmTelemetry*
+
+        Telemetry of run
+
+        :a: *numpy.ndarray*
+
+        Harmonised parameters
+    """
+
+    T = HarmTelemetry(benchmark="synthetic")
+    Harmonisation = HarmAlgo(deepcopy(HData), telemetry=T)
+
+    with T.stage("total"):
+        a = Harmonisation.run(show=False, **kwargs)[0]
+
+    return T, a
+
+if __name__ == "__main__":
+
+    def main():
+
+        usage = "usage: %prog [options]"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--n-sensors", type="int", dest="n_sensors", default=3, help="number of sensors")
+        parser.add_option("--n-matchups", type="int", dest="n_matchups", default=1000,
+                          help="number of match-ups per match-up series")
+        parser.add_option("--seed", type="int", dest="seed", default=0, help="random number generator seed")
+        parser.add_option("--report-dir", dest="report_dir", default=None,
+                          help="directory to write telemetry run reports to")
+        (options, args) = parser.parse_args()
+
+        HData, a_true = generate_synthetic_data(options.n_sensors, options.n_matchups, options.seed)
+
+        T, a = run_benchmark(HData)
+
+        if options.report_dir is not None:
+            T.save(pjoin(options.report_dir, "harm_benchmark_telemetry"))
+
+        summary = T.summary()
+        print "\n\t\t\tSynthetic Benchmark"
+        print "LSMR itn\tMINRES itn\tmatvecs\t\trunGN (s)\ttotal (s)"
+        print "{0:d}\t\t{1:d}\t\t{2:d}\t\t{3:.2f}\t\t{4:.2f}"\
+              .format(T.counters.get("lsmr_iterations", 0), T.counters.get("minres_iterations", 0),
+                      T.counters.get("matvec", 0) + T.counters.get("rmatvec", 0),
+                      summary["runGN"]["wall"], summary["total"]["wall"])
+
+        print "\nTrue Parameters:"
+        print a_true
+        print "Determined Parameters:"
+        print a
+
+        return 0
+
+    main()
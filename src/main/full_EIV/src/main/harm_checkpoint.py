@@ -0,0 +1,355 @@
+"""
+Atomic checkpointing of the harmonisation solver state, to allow long runs to be resumed
+
+Created on Mon Oct 12  2026 10:00:00
+"""
+
+'''___Python Modules___'''
+import os
+import json
+from os import makedirs, listdir, rename, fsync
+from os.path import join as pjoin
+from os.path import isdir
+from shutil import rmtree
+
+'''___Third Party Modules___'''
+from numpy import load, asarray, array
+from numpy.lib.format import open_memmap
+
+'''___Constants___'''
+
+CKPT_PREFIX = "ckpt_"             # prefix of checkpoint directory names
+MANIFEST_NAME = "manifest.json"   # name of checkpoint manifest file (written last, marks checkpoint valid)
+
+
+class HarmCheckpoint:
+    """
+    Class to write and read checkpoints of the state of a harmonisation run, such that a run interrupted (e.g. by batch
+    node pre-emption or walltime) may be resumed from the newest valid checkpoint.
+
+    Each checkpoint is a directory of raw ``.npy`` arrays, written through memory maps and fsync'd, plus a manifest. The
+    checkpoint is first written to a temporary directory which is renamed into place once complete, so a checkpoint
+    directory either exists complete or not at all.
+
+    Sample Code:
+
+    .. code-block:: python
+
+        C = HarmCheckpoint("some/directory/checkpoint")
+        C.S = S
+        C.a_PC = a_PC
+        C.save("GN", niter=niter, xyza=xyza, GNlog=GNlog)
+
+        state = C.load()
+
+    :Attributes:
+        .. py:attribute:: directory
+
+        *str*
+
+        Directory to store checkpoints in
+
+        .. py:attribute:: keep
+
+        *int*
+
+        Number of most recent checkpoints to retain
+
+        .. py:attribute:: interval
+
+        *int*
+
+        Number of Gauss-Newton iterations between checkpoints
+
+        .. py:attribute:: S
+
+        *numpy.ndarray*
+
+        Pre-conditioner solution, included in every checkpoint once set
+
+        .. py:attribute:: a_PC
+
+        *numpy.ndarray*
+
+        Pre-conditioner parameter estimates, included in every checkpoint once set
+
+        .. py:attribute:: rng_state
+
+        *tuple*
+
+        State of the numpy random number generator before MC trial errors were generated, included in every
+        checkpoint once set
+
+    :Methods:
+        .. py:method:: save(...):
+
+            Write new checkpoint of solver state
+
+        .. py:method:: load(...):
+
+            Return solver state from newest valid checkpoint
+
+        .. py:method:: due(...):
+
+            Return True if a checkpoint is due at given Gauss-Newton iteration
+    """
+
+    def __init__(self, directory, keep=2, interval=1):
+        """
+        Initialise checkpoint object
+
+        :type directory: str
+        :param directory: Directory to store checkpoints in
+
+        :type keep: int
+        :param keep: Number of most recent checkpoints to retain (default 2)
+
+        :type interval: int
+        :param interval: Number of Gauss-Newton iterations between checkpoints (default 1, i.e. every iteration)
+        """
+
+        self.directory = directory
+        self.keep = keep
+        self.interval = interval
+
+        # State saved with every checkpoint
+        self.S = None
+        self.a_PC = None
+        self.rng_state = None
+
+        try:
+            makedirs(directory)
+        except OSError:
+            pass
+
+    def due(self, niter, conv=False):
+        """
+        Return True if a checkpoint is due at given Gauss-Newton iteration
+
+        :type niter: int
+        :param niter: Gauss-Newton iteration counter
+
+        :type conv: bool
+        :param conv: Gauss-Newton convergence boolean (a checkpoint is always due on convergence)
+
+        :return:
+            :due: *bool*
+
+            Checkpoint due boolean
+        """
+
+        return conv or (self.interval > 0 and niter % self.interval == 0)
+
+    def save(self, stage, niter=0, xyza=None, GNlog=None, **info):
+        """
+        Write new checkpoint of solver state
+
+        :type stage: str
+        :param stage: Stage of harmonisation reached, "PC" (pre-conditioner determined) or "GN" (Gauss-Newton
+        iteration complete)
+
+        :type niter: int
+        :param niter: Gauss-Newton iteration counter
+
+        :type xyza: numpy.ndarray
+        :param xyza: Current variable and parameter estimates (converted form)
+
+        :type GNlog: list
+        :param GNlog: Gauss-Newton convergence log
+
+        :param info: Additional scalar solver state to store in the checkpoint manifest (e.g. LM damping parameter)
+
+        :return:
+            :path: *str*
+
+            Path of written checkpoint directory
+        """
+
+        # Arrays to write
+        arrays = {"S": self.S, "a_PC": self.a_PC, "xyza": xyza}
+        if GNlog is not None:
+            arrays["GNlog"] = asarray(GNlog, dtype=float)
+        if self.rng_state is not None:
+            arrays["rng_keys"] = self.rng_state[1]
+
+        # Manifest
+        manifest = {"stage": stage, "niter": niter, "arrays": {}, "info": info}
+        if self.rng_state is not None:
+            manifest["rng"] = [self.rng_state[0], int(self.rng_state[2]), int(self.rng_state[3]),
+                               float(self.rng_state[4])]
+
+        # Write to temporary directory
+        seq = self._next_seq()
+        path = pjoin(self.directory, CKPT_PREFIX + "{:06d}".format(seq))
+        path_tmp = pjoin(self.directory, "." + CKPT_PREFIX + "{:06d}".format(seq) + ".tmp")
+
+        if isdir(path_tmp):
+            rmtree(path_tmp)
+        makedirs(path_tmp)
+
+        for name, arr in arrays.items():
+            if arr is None:
+                continue
+            arr = asarray(arr)
+            self._write_array(pjoin(path_tmp, name + ".npy"), arr)
+            manifest["arrays"][name] = list(arr.shape)
+
+        self._write_file(pjoin(path_tmp, MANIFEST_NAME), json.dumps(manifest))
+        self._fsync_dir(path_tmp)
+
+        # Move complete checkpoint into place
+        rename(path_tmp, path)
+        self._fsync_dir(self.directory)
+
+        # Remove old checkpoints
+        for old in self._list()[:-self.keep]:
+            rmtree(pjoin(self.directory, old), ignore_errors=True)
+
+        return path
+
+    def load(self):
+        """
+        Return solver state from newest valid checkpoint
+
+        :return:
+            :state: *dict*
+
+            Dictionary of solver state with entries "stage", "niter", "info" and one per stored array ("S", "a_PC",
+            "xyza", "GNlog", "rng_state"), None if no valid checkpoint found
+        """
+
+        for name in reversed(self._list()):
+            try:
+                return self._read(pjoin(self.directory, name))
+            except (IOError, OSError, ValueError, KeyError):
+                # incomplete or corrupt checkpoint, try next newest
+                continue
+
+        return None
+
+    def _read(self, path):
+        """
+        Return solver state from checkpoint directory
+
+        :type path: str
+        :param path: Path of checkpoint directory
+
+        :return:
+            :state: *dict*
+
+            Dictionary of solver state
+        """
+
+        with open(pjoin(path, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+
+        state = {"stage": manifest["stage"], "niter": manifest["niter"], "info": manifest["info"]}
+        for name, shape in manifest["arrays"].items():
+            arr = array(load(pjoin(path, name + ".npy"), mmap_mode="r"))
+            if list(arr.shape) != shape:
+                raise ValueError("Checkpoint array shape mismatch: " + name)
+            state[name] = arr
+
+        state["rng_state"] = None
+        if "rng" in manifest:
+            rng = manifest["rng"]
+            state["rng_state"] = (str(rng[0]), state.pop("rng_keys").astype("uint32"), rng[1], rng[2], rng[3])
+
+        if "GNlog" in state:
+            state["GNlog"] = [[int(row[0])] + list(row[1:]) for row in state["GNlog"]]
+
+        return state
+
+    def _list(self):
+        """
+        Return sorted list of names of checkpoint directories
+
+        :return:
+            :names: *list:str*
+
+            Checkpoint directory names, oldest first
+        """
+
+        return sorted([name for name in listdir(self.directory)
+                       if name.startswith(CKPT_PREFIX) and isdir(pjoin(self.directory, name))])
+
+    def _next_seq(self):
+        """
+        Return sequence number of next checkpoint
+
+        :return:
+            :seq: *int*
+
+            Checkpoint sequence number
+        """
+
+        names = self._list()
+        if names == []:
+            return 0
+        return int(names[-1][len(CKPT_PREFIX):]) + 1
+
+    def _write_array(self, path, arr):
+        """
+        Write array to .npy file through a memory map and flush to disk
+
+        :type path: str
+        :param path: Path of .npy file
+
+        :type arr: numpy.ndarray
+        :param arr: Array to write
+        """
+
+        mm = open_memmap(path, mode="w+", dtype=arr.dtype, shape=arr.shape)
+        if arr.size > 0:
+            mm[...] = arr
+        mm.flush()
+        del mm
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_file(self, path, text):
+        """
+        Write text file and flush to disk
+
+        :type path: str
+        :param path: Path of file
+
+        :type text: str
+        :param text: File contents
+        """
+
+        with open(path, "w") as f:
+            f.write(text)
+            f.flush()
+            fsync(f.fileno())
+
+    def _fsync_dir(self, path):
+        """
+        Flush directory entry updates to disk
+
+        :type path: str
+        :param path: Path of directory
+        """
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+if __name__ == "__main__":
+
+    def main():
+        return 0
+
+    main()
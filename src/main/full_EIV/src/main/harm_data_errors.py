@@ -5,52 +5,193 @@ Created on Tues April 18  2017 11:00:00
 """
 
 '''___Python Modules___'''
-from numpy import zeros
-from numpy.random import normal
+from numpy.random import RandomState
 
+'''___Constants___'''
 
-def gen_errors(HData):
+ERROR_ROWS = 10000      # number of match-ups of errors drawn per chunk by gen_converted_errors
+
+
+def trial_rng(master_seed, n_trial):
+    """
+    Return random number generator stream for an MC trial, derived from a master seed and the trial number, such that
+    the same trial always draws the same errors, whichever process runs it and in whichever order
+
+    :type master_seed: int
+    :param master_seed: MC run master seed
+
+    :type n_trial: int
+    :param n_trial: MC trial number
+
+    :return:
+        :rng: *numpy.random.RandomState*
+
+        Random number generator for MC trial
+    """
+
+    return RandomState([master_seed, n_trial])
+
+
+def gen_errors(HData, rng=None):
     """
     Return input HData object with values and ks adjusted by errors respecting its uncertainty structure
 
+    Errors are drawn in a fixed order, so the perturbed data depends only on the state of rng:
+
+    1. one standard normal draw per systematic slot (sensor, covariate), shared by all match-up series of that sensor
+    2. standard normal draws for all match-ups of all columns of the data matrix
+    3. per averaged data block, standard normal draws for the raw data of the block
+    4. standard normal draws for all ks
+
     :param HData: harm_data_reader.HarmData
         input harmonisation match-up data object
 
+    :param rng: numpy.random.RandomState
+        (optional) random number generator stream, e.g. from trial_rng(...), if None a randomly seeded generator is used
+
     :return:
         :HData: harm_data_reader.HarmData
             Input HData object with values and ks adjusted with errors respecting its uncertainty structure
     """
 
+    if rng is None:
+        rng = RandomState()
+
+    N_mu = HData.idx['cNm'][-1]                     # total number of match-ups
+    N_sensors = len(HData.idx['sensors'])           # total number of sensors (including reference)
+    m = HData.values.shape[1]/2                     # number of covariates
+
+    # Draw errors
+    z_sys = rng.standard_normal((N_sensors, m))     # per systematic slot
+    z = rng.standard_normal((N_mu, 2*m))            # per data matrix element
+    z_ave = [rng.standard_normal(block_unc.W.shape[1]) if block_unc.form == 'ave' else None
+             for block_unc in HData.unc]            # per averaged block raw data
+    z_k = rng.standard_normal(N_mu)                 # per k
+
+    # Add errors to data block by block
     for i, (block_unc, cov, mu) in enumerate(zip(HData.unc, HData.idx['n_cov'], HData.idx['n_mu'])):
 
+        n_sensor = HData.idx['n_sensor'][i]
+
         # indices defining first and last positions in data matrix
         istart = HData.idx['cNm'][mu - 1]
         iend = HData.idx['cNm'][mu]
 
         # index defining column in data matrix
-        if HData.idx['Im'][mu - 1][0] == HData.idx['n_sensor'][i]:  # if the sensor is the first sensor in the match-up series
+        if HData.idx['Im'][mu - 1][0] == n_sensor:  # if the sensor is the first sensor in the match-up series
             col = cov - 1
-        if HData.idx['Im'][mu - 1][1] == HData.idx['n_sensor'][i]:  # if the sensor is the second sensor in the match-up series
-            col = cov + HData.values.shape[1]/2 - 1
+        if HData.idx['Im'][mu - 1][1] == n_sensor:  # if the sensor is the second sensor in the match-up series
+            col = cov + m - 1
 
         if block_unc.form == 'r':
-            HData.values[istart:iend, col] = normal(loc=HData.values[istart:iend, col], scale=block_unc.uR)
+            HData.values[istart:iend, col] += block_unc.uR * z[istart:iend, col]
 
         elif block_unc.form == 'rs':
-            # todo - write harmonisation
-            print 'shouldn''t be here'
+            HData.values[istart:iend, col] += block_unc.uR * z[istart:iend, col] + block_unc.uS * z_sys[n_sensor, cov-1]
 
         elif block_unc.form == 'ave':
-            HData.values[istart:iend, col] += block_unc.W.dot(normal(loc=zeros(block_unc.W.indices[-1] + 1)))
+            HData.values[istart:iend, col] += block_unc.W.dot(z_ave[i])
 
     for i in xrange(len(HData.idx['Im'])):
         istart = HData.idx['cNm'][i]
         iend = HData.idx['cNm'][i + 1]
 
-        HData.ks[istart:iend] = normal(loc=HData.ks[istart:iend], scale=HData.unck[i].uR)
+        HData.ks[istart:iend] += HData.unck[i].uR * z_k[istart:iend]
 
     return HData
 
+
+def gen_converted_errors(HData, rng, rows=ERROR_ROWS):
+    """
+    Generate the errors gen_errors draws from a random number generator stream, as errors of the converted data (see
+    ConvertData.convert2ind) - variables followed by ks, of unit standard uncertainty - piece by piece, so the full
+    error vector is never held in memory. To first order, perturbing the converted data by these errors perturbs the
+    original data as gen_errors does with the same stream, e.g. for linearised MC trials comparable to full MC trials.
+
+    Draws are made in the same order as gen_errors, with the draws for the data matrix and ks made in chunks of
+    match-ups:
+
+    * systematic slot draws map to the systematic variables of "rs" blocks
+    * data matrix draws map to the variables of "r" and "rs" blocks (draws for columns of "ave" blocks are unused, as
+      in gen_errors)
+    * averaged block draws map to the raw data variables of "ave" blocks
+    * k draws map to the ks
+
+    :param HData: harm_data_reader.HarmData
+        converted harmonisation match-up data object (e.g. HarmAlgo.HData after HarmAlgo.linearise)
+
+    :param rng: numpy.random.RandomState
+        random number generator stream, e.g. from trial_rng(...)
+
+    :param rows: int
+        number of match-ups of data matrix and k draws per chunk
+
+    :return:
+        :errors: generator
+            Generator of tuple of (index of first converted data element, errors of consecutive converted data
+            elements), in the same sequence of pieces for any stream
+    """
+
+    idx = HData.idx
+    N_var = idx['idx'][-1]                          # total number of converted variables
+    N_mu = idx['cNm'][-1]                           # total number of match-ups
+    N_sensors = len(idx['sensors'])                 # total number of sensors (including reference)
+    m = idx['n_cov'][-1]                            # number of covariates
+
+    N_sensors_sys = len(set([n for pair in idx['Im'] for n in pair])) - 1   # number of systematic slots per covariate
+    N_mu_s = len(idx['Im'])                                                 # total number of match-up series
+    indices = zip(idx['n_sensor'], idx['n_mu'], idx['n_cov'])
+
+    # Match-ups and data matrix column of each block
+    blocks = []
+    for i, (cov, mu) in enumerate(zip(idx['n_cov'], idx['n_mu'])):
+        n_sensor = idx['n_sensor'][i]
+
+        if idx['Im'][mu - 1][0] == n_sensor:  # if the sensor is the first sensor in the match-up series
+            col = cov - 1
+        if idx['Im'][mu - 1][1] == n_sensor:  # if the sensor is the second sensor in the match-up series
+            col = cov + m - 1
+
+        blocks.append((idx['cNm'][mu - 1], idx['cNm'][mu], col))
+
+    # 1. systematic slots, each once
+    z_sys = rng.standard_normal((N_sensors, m))
+    done = set()
+    for i, block_unc in enumerate(HData.unc):
+        if block_unc.form == 'rs':
+            n_sensor = idx['n_sensor'][i]
+            cov = idx['n_cov'][i]
+            isys = idx['idx'][indices.index((N_sensors_sys, N_mu_s, cov)) + 1] - N_sensors_sys + n_sensor - 1
+
+            if isys not in done:
+                done.add(isys)
+                yield isys, z_sys[n_sensor, cov-1:cov]
+
+    # 2. data matrix, chunk by chunk of match-ups
+    for r0 in xrange(0, N_mu, rows):
+        r1 = min(r0 + rows, N_mu)
+        z = rng.standard_normal((r1 - r0, 2*m))
+
+        for i, block_unc in enumerate(HData.unc):
+            if block_unc.form not in ('r', 'rs'):
+                continue
+
+            istart, iend, col = blocks[i]
+            lo = max(r0, istart)
+            hi = min(r1, iend)
+            if lo < hi:
+                yield idx['idx'][i] + lo - istart, z[lo-r0:hi-r0, col]
+
+    # 3. averaged blocks raw data
+    for i, block_unc in enumerate(HData.unc):
+        if block_unc.form == 'ave':
+            yield idx['idx'][i], rng.standard_normal(block_unc.W.shape[1])
+
+    # 4. ks, chunk by chunk of match-ups
+    for r0 in xrange(0, N_mu, rows):
+        r1 = min(r0 + rows, N_mu)
+        yield N_var + r0, rng.standard_normal(r1 - r0)
+
 if __name__ == "__main__":
 
     def main():
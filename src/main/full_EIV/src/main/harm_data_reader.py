@@ -6,12 +6,14 @@ Created on Mon Jan 9  2017 17:00:00
 """
 
 '''___Python Modules___'''
-from numpy import array, zeros, loadtxt, append, delete, isnan, vstack, arange, asarray
+from numpy import array, zeros, loadtxt, append, delete, isnan, vstack, arange, asarray, concatenate, hstack, \
+    ascontiguousarray
+from hashlib import md5
 from datetime import datetime
 from netCDF4 import Dataset
 from copy import deepcopy
 from sys import exit
-from os.path import join as pjoin
+from os.path import join as pjoin, realpath
 
 '''___Harmonisation Modules___'''
 from correl_forms import CorrelForm
@@ -35,14 +37,25 @@ class HarmData:
         :idx: dict:list
             dictionary of data indices listed by data block, following are provided: n_sensor, n_mu, n_cov, N_var
             and idx (see open_PH method for description of structure)
+        :shared: dict
+            data shared between harmonisation data objects opened from the same match-up data (e.g. per channel),
+            match-up file variables and W matrices by key - only set while data is opened, so the harmonisation data
+            object references the shared arrays it uses but does not keep the rest of the shared data alive
     """
 
-    def __init__(self, path=None, path_parameters=None, sensor_model=None, adjustment_model=None, flatten=True):
+    def __init__(self, path=None, path_parameters=None, sensor_model=None, adjustment_model=None, flatten=True,
+                 shared=None):
         """
         Initialise harmonisation data object, opening data from directory if specified
 
         :param directory: str
             directory of harmonisation data to be opened
+
+        :param shared: dict
+            (optional) data shared between harmonisation data objects, read match-up file variables and built W
+            matrices are reused from it and added to it, so data common to several harmonisations (e.g. covariates
+            shared between channels) is read and built once and held once - harmonisation data objects reference the
+            shared arrays rather than copying them, so shared arrays must not be modified in place
         """
 
         # initialise attributes
@@ -54,6 +67,7 @@ class HarmData:
         self.idx = {}
         self.sensor_model = None
         self.adjustment_model = None
+        self.shared = shared
 
         # open data
         if path is not None:
@@ -65,7 +79,7 @@ class HarmData:
                         self.values, self.unc, self.ks, self.unck,\
                             self.a, self.idx, times = self.open_data(path, path_parameters)
 
-                        self.times = self.seconds2date(times)
+                        self.times = self.shared_dates(times)
 
                         # save separate copy of original indices for future reference
                         self.idx_orig = deepcopy(self.idx)
@@ -77,6 +91,9 @@ class HarmData:
             else:
                 exit('Missing Parameter - parameter_path missing from HarmData')
 
+        # shared data only required while opening data
+        self.shared = None
+
     def open_data(self, paths, path_parameters):
         """
         Function to open shortened version simulated AVHRR data produced by Jon Mittaz for harmonisation
@@ -349,6 +366,216 @@ class HarmData:
 
         return Darray, unc, ks, unck, a, idx, times
 
+    def read_variables(self, path, names):
+        """
+        Return variables (or global attributes) of match-up series file, reused from shared data if already read
+
+        :param path: str
+            path of match-up series file
+        :param names: list:str
+            names of variables (or global attributes)
+
+        :return:
+            :variables: dict
+                variable data by name
+        """
+
+        shared = self.shared
+        if shared is None:
+            shared = {}
+
+        keys = [(realpath(path), name) for name in names]
+        missing = [key for key in keys if key not in shared]
+
+        if missing != []:
+            rootgrp = Dataset(path, 'r')
+            for key in missing:
+                if key[1] in rootgrp.variables:
+                    shared[key] = rootgrp.variables[key[1]][:]
+                else:
+                    shared[key] = rootgrp.getncattr(key[1])
+            rootgrp.close()
+
+        return dict([(name, shared[key]) for name, key in zip(names, keys)])
+
+    def read_series_variables(self, paths, names, bad_mus=None):
+        """
+        Return variables of match-up series files concatenated over the files, optionally with rows of invalid
+        match-ups removed, reused from shared data if already assembled for the same files and invalid match-ups (e.g.
+        by another channel) - all harmonisation data objects then reference the same arrays, which must not be modified
+
+        :param paths: list:str
+            paths of match-up series files, in order of match-up series
+        :param names: list:str
+            names of variables
+        :param bad_mus: list:int
+            (optional) indices of invalid match-ups to remove (see find_bad_mus)
+
+        :return:
+            :variables: dict
+                variable data by name, 2D variables zero padded to the widest file
+        """
+
+        shared = self.shared
+        if shared is None:
+            shared = {}
+
+        drop = None
+        if (bad_mus is not None) and (len(bad_mus) > 0):
+            drop = md5(ascontiguousarray(bad_mus, dtype=int).tobytes()).hexdigest()
+
+        series = tuple([realpath(path) for path in paths])
+        keys = [("series", series, name, drop) for name in names]
+        missing = [key for key in keys if key not in shared]
+
+        if missing != []:
+            data = dict([(key, []) for key in missing])
+            for path in paths:
+                rootgrp = Dataset(path, 'r')
+                for key in missing:
+                    data[key].append(asarray(rootgrp.variables[key[2]][:], dtype=float))
+                rootgrp.close()
+
+            for key in missing:
+                arrays = data.pop(key)
+
+                # pad 2D variables (e.g. scanline uncertainties of averaging windows) to widest file
+                if arrays[0].ndim == 2:
+                    width = max([a.shape[1] for a in arrays])
+                    arrays = [a if a.shape[1] == width else hstack((a, zeros((a.shape[0], width - a.shape[1]))))
+                              for a in arrays]
+
+                variable = arrays[0] if len(arrays) == 1 else concatenate(arrays)
+                if drop is not None:
+                    variable = delete(variable, bad_mus, axis=0)
+                shared[key] = variable
+
+        return dict([(name, shared[key]) for name, key in zip(names, keys)])
+
+    def shared_dates(self, times):
+        """
+        Return match-up times in datetime format (see seconds2date), reused from shared data if already converted for
+        the same times
+
+        :param times: numpy.ndarray: float
+            array of matchup times in seconds since 1970
+
+        :return:
+            :dates: numpy.ndarray: datetime.datetime
+                array of matchup times in datetime format
+        """
+
+        if self.shared is None:
+            return self.seconds2date(times)
+
+        key = ("dates", md5(ascontiguousarray(times, dtype=float).tobytes()).hexdigest())
+        if key not in self.shared:
+            self.shared[key] = self.seconds2date(times)
+
+        return self.shared[key]
+
+    def read_metadata(self, paths, cols=None, ave_variables=None, max_len=None):
+        """
+        Return description of the data structure open_data builds from match-up series files, from file metadata, the
+        first row of systematic uncertainties and, if averaged covariates, match-up times only - without reading the
+        match-up data (e.g. to plan a harmonisation run, see harm_plan.HarmPlan.from_files)
+
+        :param paths: list
+            list containing the paths of the harmonisation match-up data in netCDF file
+
+        :param cols: list
+            (optional) match-up file data matrix columns open_data selects (default all columns)
+
+        :param ave_variables: dict
+            (optional) scanline uncertainty variable of averaged covariates by data matrix column
+
+        :param max_len: int
+            (optional) number of match-ups open_data reads per match-up series (default all match-ups)
+
+        :return:
+            :metadata: dict
+                dictionary with entries "lm" (match-up series description), "m" (number of covariates in sensor
+                model), "sensors" (sensor name by sensor number), "uS" (first row of systematic uncertainties per
+                match-up series) and, if ave_variables, "n_w" (averaging window width by data matrix column per
+                match-up series) and "times" (match-up times per match-up series), see metadata_block_form
+        """
+
+        lm = zeros((len(paths), 3))
+        ms = []
+        uS = []
+        n_w = []
+        times = []
+        for i, path in enumerate(paths):
+            rootgrp = Dataset(path, 'r')
+            lm[i, :] = rootgrp.variables['lm'][:][0]
+            if max_len is not None:
+                lm[i, 2] = max_len
+            ms.append(rootgrp.variables['H'].shape[1] / 2)
+            uS.append(rootgrp.variables['Us'][0, :] if cols is None else rootgrp.variables['Us'][0, cols])
+
+            if ave_variables is not None:
+                n_w.append(dict((col, rootgrp.variables[name].shape[1]) for col, name in ave_variables.items()))
+                times.append(rootgrp.variables['time_matchup'][:max_len])
+
+            rootgrp.close()
+
+        lm = lm.astype(int)
+
+        # check all sensor models require same number of covariates
+        if len(set(ms)) != 1:
+            exit('Sensor Model Mismatch - sensor_model per match-up series much take the same number of variables')
+        m = ms[0] if cols is None else len(cols)/2
+
+        # sensor names by sensor number, numbered in order of appearance (as open_data)
+        sensors = []
+        for info in lm:
+            for sensor in info[:2]:
+                if sensor not in sensors:
+                    sensors.append(sensor)
+
+        metadata = {"lm": lm, "m": m, "sensors": sensors, "uS": uS}
+        if ave_variables is not None:
+            metadata["n_w"] = n_w
+            metadata["times"] = times
+
+        return metadata
+
+    def metadata_block_form(self, metadata, n_mu, n_sensor, col):
+        """
+        Return correlation form open_data assigns to data block, from match-up series metadata
+
+        :param metadata: dict
+            match-up series metadata, as returned by read_metadata
+
+        :param n_mu: int
+            match-up series number of block
+
+        :param n_sensor: int
+            sensor number of block
+
+        :param col: int
+            data matrix column of block
+
+        :return:
+            :form: str
+                correlation form
+            :n_w: int
+                averaging window width (0 if not averaging form)
+            :W_cols: int
+                number of averaging W matrix columns (0 if not averaging form)
+        """
+
+        # > if reference sensor - correlation form random
+        if n_sensor == 0:
+            return "r", 0, 0
+
+        # > random effect - if systematic component is zero
+        elif metadata["uS"][n_mu - 1][col] == 0:
+            return "r", 0, 0
+
+        # > systematic effect
+        return "rs", 0, 0
+
     def flatten_values(self, values, idx):
         """
         Return 1d form of 2d match-up data array and descriptive dictionary of indices
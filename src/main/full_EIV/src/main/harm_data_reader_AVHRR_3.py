@@ -12,7 +12,14 @@ from copy import deepcopy
 
 '''___Harmonisation Modules___'''
 from harm_data_reader import HarmData as HarmData_template
-from correl_forms import CorrelForm
+from correl_forms import CorrelForm, calc_W_cols
+
+'''___Constants___'''
+
+SEL_COV = [0, 1, 2, 3, 5, 6, 7, 8]     # match-up file data matrix columns read, i.e. ignore temperature columns
+AVE_VARIABLES = {0: "ref_cal_Sp_Ur", 4: "cal_Sp_Ur",
+                 1: "ref_cal_BB_Ur", 5: "cal_BB_Ur"}    # averaged covariate scanline uncertainties, by data column
+CORR_DATA = 25.0                        # time width of averaging window
 
 
 class HarmData(HarmData_template):
@@ -87,7 +94,7 @@ class HarmData(HarmData_template):
         # Each covariate (+ks) in each match-up has its own uncertainty values and type, create a list to contain this
         # information for the consecuative blocks in the values data array.
 
-        sel_cov = [0, 1, 2, 3, 5, 6, 7, 8]  # i.e. ignore temperature columns
+        sel_cov = SEL_COV  # i.e. ignore temperature columns
 
         ################################################################################################################
         # 1. Build idx dictionary which describes required data structure
@@ -213,13 +220,16 @@ class HarmData(HarmData_template):
         # initialise arrays
         ks = zeros(cNm[-1])
         uKarray = zeros(cNm[-1])
-        times = zeros(cNm[-1])
-        times_ref = zeros(cNm[-1])
-        corr_data = array([])
         Darray = zeros((cNm[-1], 2 * m))
         uRarray = zeros((cNm[-1], 2 * m))
         uSarray = zeros((cNm[-1], 2 * m))
 
+        # match-up times, shared between channels (referenced, not copied)
+        shared = self.read_series_variables(paths, ['time_matchup', 'ref_time_matchup', 'corrData'])
+        times = shared['time_matchup']
+        times_ref = shared['ref_time_matchup']
+        corr_data = shared['corrData']
+
         for i, dir in enumerate(paths):
             rootgrp = Dataset(dir, 'r')
 
@@ -229,9 +239,6 @@ class HarmData(HarmData_template):
             # initialise data arrays for first match-up series file
             ks[istart:iend] = rootgrp.variables['K'][:]
             uKarray[istart:iend] = (rootgrp.variables['Kr'][:]**2 + rootgrp.variables['Ks'][:]**2)**0.5
-            times[istart:iend] = rootgrp.variables['time_matchup'][:]
-            times_ref[istart:iend] = rootgrp.variables['ref_time_matchup'][:]
-            corr_data = append(corr_data, rootgrp.variables['corrData'][:])
 
             # per covariate per match-up data
             Darray[istart:iend, :] = rootgrp.variables['H'][:, sel_cov]
@@ -260,36 +267,14 @@ class HarmData(HarmData_template):
         a = a.flatten()
 
         ######################### AHVRR SPECIFIC CODE ##################################################################
-        n_ws = []
-
-        # Open data match-up series file by match-up series file
-        for i, dir in enumerate(paths):
-            rootgrp = Dataset(dir, 'r')
-            n_ws.append(rootgrp.getncattr('Calibraton_Average_No_Scanline'))
-            rootgrp.close()
-        n_w = max(n_ws)
-
-        cal_uRarray = zeros((cNm[-1], n_w))
-        ref_cal_uRarray = zeros((cNm[-1], n_w))
-        space_uRarray = zeros((cNm[-1], n_w))
-        ref_space_uRarray = zeros((cNm[-1], n_w))
-
-        for i, dir in enumerate(paths):
-            rootgrp = Dataset(dir, 'r')
-            istart = cNm[i]
-            iend = cNm[i + 1]
-
-            cal_uRarray[istart:iend] = rootgrp.variables['cal_BB_Ur'][:, :]
-            ref_cal_uRarray[istart:iend] = rootgrp.variables['ref_cal_BB_Ur'][:, :]
-            space_uRarray[istart:iend] = rootgrp.variables['cal_Sp_Ur'][:, :]
-            ref_space_uRarray[istart:iend] = rootgrp.variables['ref_cal_Sp_Ur'][:, :]
-
-            rootgrp.close()
-
-        cal_uRarray = delete(cal_uRarray, bad_mus, axis=0)
-        ref_cal_uRarray = delete(ref_cal_uRarray, bad_mus, axis=0)
-        space_uRarray = delete(space_uRarray, bad_mus, axis=0)
-        ref_space_uRarray = delete(ref_space_uRarray, bad_mus, axis=0)
+        # scanline uncertainties of averaged covariates (padded to widest averaging window), shared between channels
+        # with the same invalid match-ups (referenced, not copied)
+        shared = self.read_series_variables(paths, ['cal_BB_Ur', 'ref_cal_BB_Ur', 'cal_Sp_Ur', 'ref_cal_Sp_Ur'],
+                                            bad_mus=bad_mus)
+        cal_uRarray = shared['cal_BB_Ur']
+        ref_cal_uRarray = shared['ref_cal_BB_Ur']
+        space_uRarray = shared['cal_Sp_Ur']
+        ref_space_uRarray = shared['ref_cal_Sp_Ur']
         ################################################################################################################
 
         ################################################################################################################
@@ -339,8 +324,8 @@ class HarmData(HarmData_template):
                 elif col_idx == 5:
                     uR_w = cal_uRarray[istartm:iendm]
 
-                corr_data = 25.0
-                unc[i] = CorrelForm("ave", (uR_w, times[istartm: iendm], corr_data))
+                corr_data = CORR_DATA
+                unc[i] = CorrelForm("ave", (uR_w, times[istartm: iendm], corr_data), W_cache=self.shared)
             ############################################################################################################
 
             # > random effect - if systematic component is zero
@@ -362,6 +347,65 @@ class HarmData(HarmData_template):
 
         return Darray, unc, ks, unck, a, idx, times
 
+    def read_metadata(self, paths, cols=SEL_COV, ave_variables=AVE_VARIABLES, max_len=None):
+        """
+        Return description of the data structure open_data builds from match-up series files, from file metadata only
+        (see harm_data_reader.HarmData.read_metadata), by default with the data matrix columns, averaged covariates
+        and number of match-ups open_data reads
+
+        :return:
+            :metadata: dict
+                match-up series metadata, see harm_data_reader.HarmData.read_metadata
+        """
+
+        return HarmData_template.read_metadata(self, paths, cols=cols, ave_variables=ave_variables, max_len=max_len)
+
+    def metadata_block_form(self, metadata, n_mu, n_sensor, col):
+        """
+        Return correlation form open_data assigns to data block, from match-up series metadata (see
+        harm_data_reader.HarmData.metadata_block_form)
+
+        :param metadata: dict
+            match-up series metadata, as returned by read_metadata
+
+        :param n_mu: int
+            match-up series number of block
+
+        :param n_sensor: int
+            sensor number of block
+
+        :param col: int
+            data matrix column of block
+
+        :return:
+            :form: str
+                correlation form
+            :n_w: int
+                averaging window width (0 if not averaging form)
+            :W_cols: int
+                number of averaging W matrix columns (0 if not averaging form)
+        """
+
+        # > if reference sensor - correlation form random
+        if metadata["sensors"][n_sensor] == -1:
+            return "r", 0, 0
+
+        # > no A3 - correlation form random (location hard coded)
+        elif col in (3, 7):
+            return "r", 0, 0
+
+        # > if C_Space/C_ICT - averaging correlation (location hard coded)
+        elif col in AVE_VARIABLES:
+            n_w = metadata["n_w"][n_mu - 1][col]
+            return "ave", n_w, calc_W_cols(metadata["times"][n_mu - 1], n_w, CORR_DATA)
+
+        # > random effect - if systematic component is zero
+        elif metadata["uS"][n_mu - 1][col] == 0:
+            return "r", 0, 0
+
+        # > systematic effect
+        return "rs", 0, 0
+
 
 if __name__ == "__main__":
 
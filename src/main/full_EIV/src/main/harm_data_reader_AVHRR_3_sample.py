@@ -12,7 +12,15 @@ from copy import deepcopy
 
 '''___Harmonisation Modules___'''
 from harm_data_reader import HarmData as HarmData_template
-from correl_forms import CorrelForm
+from correl_forms import CorrelForm, calc_W_cols
+
+'''___Constants___'''
+
+SEL_COV = [0, 1, 2, 3, 5, 6, 7, 8]     # match-up file data matrix columns read, i.e. ignore temperature columns
+AVE_VARIABLES = {0: "ref_cal_Sp_Ur", 4: "cal_Sp_Ur",
+                 1: "ref_cal_BB_Ur", 5: "cal_BB_Ur"}    # averaged covariate scanline uncertainties, by data column
+CORR_DATA = 25.0                        # time width of averaging window
+MAX_LEN = 1000                          # match-ups read per match-up series
 
 
 class HarmData(HarmData_template):
@@ -87,8 +95,8 @@ class HarmData(HarmData_template):
         # Each covariate (+ks) in each match-up has its own uncertainty values and type, create a list to contain this
         # information for the consecuative blocks in the values data array.
 
-        max_len = 1000  # i.e. all match-ups
-        sel_cov = [0, 1, 2, 3, 5, 6, 7, 8] # i.e. ignore temperature columns
+        max_len = MAX_LEN  # i.e. all match-ups
+        sel_cov = SEL_COV  # i.e. ignore temperature columns
 
         ################################################################################################################
         # 1. Build idx dictionary which describes required data structure
@@ -341,7 +349,7 @@ class HarmData(HarmData_template):
                 elif col_idx == 5:
                     uR_w = cal_uRarray[istartm:iendm]
 
-                corr_data = 25.0
+                corr_data = CORR_DATA
                 unc[i] = CorrelForm("ave", (uR_w, times[istartm: iendm], corr_data))
             ############################################################################################################
 
@@ -364,6 +372,65 @@ class HarmData(HarmData_template):
 
         return Darray, unc, ks, unck, a, idx, times
 
+    def read_metadata(self, paths, cols=SEL_COV, ave_variables=AVE_VARIABLES, max_len=MAX_LEN):
+        """
+        Return description of the data structure open_data builds from match-up series files, from file metadata only
+        (see harm_data_reader.HarmData.read_metadata), by default with the data matrix columns, averaged covariates
+        and number of match-ups open_data reads
+
+        :return:
+            :metadata: dict
+                match-up series metadata, see harm_data_reader.HarmData.read_metadata
+        """
+
+        return HarmData_template.read_metadata(self, paths, cols=cols, ave_variables=ave_variables, max_len=max_len)
+
+    def metadata_block_form(self, metadata, n_mu, n_sensor, col):
+        """
+        Return correlation form open_data assigns to data block, from match-up series metadata (see
+        harm_data_reader.HarmData.metadata_block_form)
+
+        :param metadata: dict
+            match-up series metadata, as returned by read_metadata
+
+        :param n_mu: int
+            match-up series number of block
+
+        :param n_sensor: int
+            sensor number of block
+
+        :param col: int
+            data matrix column of block
+
+        :return:
+            :form: str
+                correlation form
+            :n_w: int
+                averaging window width (0 if not averaging form)
+            :W_cols: int
+                number of averaging W matrix columns (0 if not averaging form)
+        """
+
+        # > if reference sensor - correlation form random
+        if n_sensor == 0:
+            return "r", 0, 0
+
+        # > no A3 - correlation form random (location hard coded)
+        elif col in (3, 7):
+            return "r", 0, 0
+
+        # > if C_Space/C_ICT - averaging correlation (location hard coded)
+        elif col in AVE_VARIABLES:
+            n_w = metadata["n_w"][n_mu - 1][col]
+            return "ave", n_w, calc_W_cols(metadata["times"][n_mu - 1], n_w, CORR_DATA)
+
+        # > random effect - if systematic component is zero
+        elif metadata["uS"][n_mu - 1][col] == 0:
+            return "r", 0, 0
+
+        # > systematic effect
+        return "rs", 0, 0
+
 
 if __name__ == "__main__":
 
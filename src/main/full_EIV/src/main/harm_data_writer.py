@@ -8,7 +8,42 @@ Created on Wed April 12  2017 17:00:00
 '''___Python Modules___'''
 from netCDF4 import Dataset
 from os.path import join as pjoin
-from numpy import zeros
+from numpy import zeros, asarray, concatenate
+from collections import OrderedDict
+from multiprocessing import Pool, current_process, cpu_count
+
+'''___Constants___'''
+
+# Residual file writing defaults - on residuals of a synthetic 2 x 6000 match-up harmonisation, zlib level 1 with the
+# shuffle filter wrote ~16x faster than level 9 for files 3% larger, and files 24% smaller than without compression
+COMPLEVEL = 1           # zlib compression level (0 for no compression)
+SHUFFLE = True          # apply HDF5 shuffle filter before compression
+CHUNK_MATCHUPS = 65536  # match-ups per chunk, for reads of time ranges of match-up series
+RES_DTYPE = 'f8'        # residual storage type ('f4' halves file size, but residuals are added back to data values
+                        # to reconstruct best estimates for MC trials, so full precision is kept by default)
+PROCESSES = None        # number of worker processes writing residual files (default number of CPUs, at most one per
+                        # match-up series)
+CACHE_CHUNKS = 16       # decoded residual chunks held by lazy residual reader (see HarmResiduals)
+
+# Residual product variables, as harm_FO_residuals_dataset.cdl - (name, storage type, attributes)
+RESIDUAL_PRODUCT_VARIABLES = [
+    ("t", 'f8', {"description": "The time of measurement for sensor i", "units": "seconds since 1970-1-1 0:0:0"}),
+    ("measurand_i", 'f4', {"description": "The measurand (e.g. radiance) of sensor i"}),
+    ("measurand_j", 'f4', {"description": "The measurand (e.g. radiance) of sensor j"}),
+    ("measurand_i_uncertainty_q", 'f4', {"description": "The uncertainty of the measurand of sensor i due to the "
+                                                        "uncertainty of sensor state variables"}),
+    ("measurand_j_uncertainty_q", 'f4', {"description": "The uncertainty of the measurand of sensor j due to the "
+                                                        "uncertainty of sensor state variables"}),
+    ("measurand_i_uncertainty_x", 'f4', {"description": "The uncertainty of the measurand of sensor i due to the "
+                                                        "uncertainty of calibration parameters"}),
+    ("measurand_j_uncertainty_x", 'f4', {"description": "The uncertainty of the measurand of sensor j due to the "
+                                                        "uncertainty of calibration parameters"}),
+    ("k_res_uncertainty_l", 'f4', {"description": "The uncertainty of the harmonisation residual due to the "
+                                                  "uncertainty of the measurand difference"}),
+    ("k_res_uncertainty_h", 'f4', {"description": "The uncertainty of the harmonisation residual due to the "
+                                                  "uncertainty of the measurand adjustment"}),
+    ("k_res_normalised", 'f4', {"description": "k_res_normalised"})]
+
 
 class HarmOutput:
     """
@@ -44,9 +79,23 @@ class HarmOutput:
     # Write with save method
     HOut.save("some/directory")
 
+    > Writing options
+
+    HOut.complevel = 1          # zlib compression level
+    HOut.shuffle = True         # shuffle filter
+    HOut.chunk_matchups = 65536 # match-ups per residual variable chunk
+    HOut.res_dtype = 'f4'       # residual storage type (default 'f8')
+    HOut.processes = 4          # number of worker processes writing residual files
+
+    > Lazy reading of residuals
+
+    HOut = HarmOutput("some/path/harm.nc", ["harm_res_S1_S2.nc", "harm_res_S2_S3.nc", ...], lazy=True)
+    k_res_2 = HOut.residual_data.series(1)    # residuals read on demand (see HarmResiduals)
+    HOut.materialise_residuals()              # read all residuals into HOut.k_res and HOut.H_res
+
     """
 
-    def __init__(self, harmonisation_output_file_path=None, harmonisation_residual_file_paths=None):
+    def __init__(self, harmonisation_output_file_path=None, harmonisation_residual_file_paths=None, lazy=False):
         """
         Initialise HarmOut object to store harmonisation output data
 
@@ -56,6 +105,10 @@ class HarmOutput:
         :type harmonisation_residual_file_paths: list:str
         :param harmonisation_residual_file_paths: list of path of harmonisation residual file paths
 
+        :type lazy: bool
+        :param lazy: switch to open residual files for lazy reading (see HarmResiduals), instead of reading all
+        residuals into memory - k_res and H_res are then only set by materialise_residuals
+
         :Attributes:
             :parameter: numpy.ndarray
                 Harmonisation parameters
@@ -110,11 +163,34 @@ class HarmOutput:
             :H_res: numpy.ndarray
                 data residual if available
 
+            :residual_data: HarmResiduals
+                residual files opened for lazy reading, if opened with lazy option
+
+            :residuals: generator
+                generator of data and k residuals per match-up series, written as generated in place of H_res and
+                k_res if available (see GNAlgo.iter_residuals)
+
             :additional_attributes: *dict*
 
             *(optional)* Dictionary of additional attributes to give to harmonisation product file for diagnostic
             purposes
 
+            :complevel: int
+                zlib compression level of written variables (0 for no compression)
+
+            :shuffle: bool
+                switch to apply HDF5 shuffle filter before compression
+
+            :chunk_matchups: int
+                match-ups per chunk of written residual variables
+
+            :res_dtype: str
+                storage type of written residual variables, 'f4' or 'f8'
+
+            :processes: int
+                number of worker processes writing residual files concurrently (default number of CPUs, 1 to write
+                in this process)
+
         """
 
         # harmonisation results
@@ -131,6 +207,8 @@ class HarmOutput:
         self.lm = None
         self.k_res = None
         self.H_res = None
+        self.residual_data = None
+        self.residuals = None
 
         # software naming
         self.software = None
@@ -144,13 +222,29 @@ class HarmOutput:
         # addition test attributes
         self.additional_attributes = None
 
+        # writing options
+        self.complevel = COMPLEVEL
+        self.shuffle = SHUFFLE
+        self.chunk_matchups = CHUNK_MATCHUPS
+        self.res_dtype = RES_DTYPE
+        self.processes = PROCESSES
+
         if harmonisation_output_file_path is not None:
             self.parameter, self.parameter_sensors, self.parameter_covariance_matrix, \
             self.cost, self.cost_dof, self.cost_p_value, \
             self.software, self.software_version, self.software_tag, self.job_id,\
             self.matchup_dataset = self.open_harmonisation_output_file(harmonisation_output_file_path)
 
-        if harmonisation_residual_file_paths is not None:
+        if (harmonisation_residual_file_paths is not None) and lazy:
+            self.residual_data = HarmResiduals(harmonisation_residual_file_paths)
+            self.lm = self.residual_data.lm
+            self.software = self.residual_data.software
+            self.software_version = self.residual_data.software_version
+            self.software_tag = self.residual_data.software_tag
+            self.job_id = self.residual_data.job_id
+            self.matchup_dataset = self.residual_data.matchup_dataset
+
+        elif harmonisation_residual_file_paths is not None:
             self.lm, self.k_res, self.H_res, \
             self.software, self.software_version, self.software_tag, self.job_id, \
             self.matchup_dataset = self.open_harmonisation_residual_files(harmonisation_residual_file_paths)
@@ -283,82 +377,25 @@ class HarmOutput:
                 MCN - Monte Carlo trial number (filled with ___ if not a MC dataset)
         """
 
-        # first get required descriptive data
-        lm = zeros((len(harmonisation_residual_file_paths), 3))
-        for i, harmonisation_residual_file_path in enumerate(harmonisation_residual_file_paths):
-
-            # open file
-            rootgrp = Dataset(harmonisation_residual_file_path, "r")
-
-            # get attributes from first file
-            if i == 0:
-                software = rootgrp.software
-                software_version = rootgrp.software_version
-                software_tag = rootgrp.software_tag
-                job_id = rootgrp.job_id
-                matchup_dataset = rootgrp.matchup_dataset
-
-                # check if H_res data available and get dimensions
-                data_res = False
-                if 'H_res' in rootgrp.variables.keys():
-                    data_res = True
-                    n_col = rootgrp.variables['H_res'].shape[1]
+        residuals = HarmResiduals(harmonisation_residual_file_paths)
+        k_res, H_res = residuals.materialise()
+        residuals.close()
 
-            # build lm array from data file
-            sensor_i_name = rootgrp.sensor_i_name
-            sensor_j_name = rootgrp.sensor_j_name
+        lm = residuals.lm
+        software = residuals.software
+        software_version = residuals.software_version
+        software_tag = residuals.software_tag
+        job_id = residuals.job_id
+        matchup_dataset = residuals.matchup_dataset
 
-            # Hacky solution to turning parameter_sensors into numbers from FastOpt
-            # This really will need changing
-            if software == "FO":
-                if matchup_dataset[:5] == "AVHRR":
-
-                    if sensor_i_name == "m02":
-                        sensor_i_name = -1
-                    else:
-                        sensor_i_name = int(sensor_i_name[1:])
-
-                    sensor_j_name = sensor_j_name[1:]
-                else:
-                    print "Sensor name problem"
-
-            lm[i, 0] = sensor_i_name
-            lm[i, 1] = sensor_j_name
-            lm[i, 2] = rootgrp.variables['k_res'].shape[0]
-
-            rootgrp.close()
-
-        # initialise data arrays
-        total = 0
-        idx = [0]
-        for n in lm[:, 2]:
-            total += int(n)
-            idx.append(total)
-        n_mu = idx[-1]
-
-        k_res = zeros(n_mu)
-        if data_res:
-            H_res = zeros((n_mu, n_col))
-
-        for i, harmonisation_residual_file_path in enumerate(harmonisation_residual_file_paths):
-
-            istart = idx[i]
-            iend = idx[i+1]
-
-            # open netCDF file
-            rootgrp = Dataset(harmonisation_residual_file_path, "r")
-
-            # get variable data
-            k_res[istart:iend] = rootgrp.variables['k_res'][:]
-            if data_res:
-                H_res[istart:iend, :] = rootgrp.variables['H_res'][:, :]
-            else:
-                H_res = None
+        return lm, k_res, H_res, software, software_version, software_tag, job_id, matchup_dataset
 
-            # close netCDF file
-            rootgrp.close()
+    def materialise_residuals(self):
+        """
+        Read all residuals of residual files opened for lazy reading into k_res and H_res attributes
+        """
 
-        return lm, k_res, H_res, software, software_version, software_tag, job_id, matchup_dataset
+        self.k_res, self.H_res = self.residual_data.materialise()
 
     def save(self, directory, res=True):
         """
@@ -376,17 +413,22 @@ class HarmOutput:
                                              self.parameter, self.parameter_sensors, self.parameter_covariance_matrix,
                                              self.cost, self.cost_dof, self.cost_p_value,
                                              self.software, self.software_version, self.software_tag, self.job_id,
-                                             self.matchup_dataset, self.additional_attributes)
+                                             self.matchup_dataset, self.additional_attributes,
+                                             complevel=self.complevel, shuffle=self.shuffle)
         if res:
             self.write_harmonisation_residual_files(directory,
                                                     self.software, self.software_version, self.software_tag, self.job_id,
-                                                    self.matchup_dataset, self.lm, self.k_res, self.H_res,)
+                                                    self.matchup_dataset, self.lm, self.k_res, self.H_res,
+                                                    complevel=self.complevel, shuffle=self.shuffle,
+                                                    chunk_matchups=self.chunk_matchups, dtype=self.res_dtype,
+                                                    processes=self.processes, residuals=self.residuals)
 
     def write_harmonisation_output_file(self, directory,
                                               parameter, parameter_sensors, parameter_covariance_matrix,
                                               cost, cost_dof, cost_p_value,
                                               software, software_version, software_tag, job_id,
-                                              matchup_dataset, additional_attributes=None):
+                                              matchup_dataset, additional_attributes=None, complevel=COMPLEVEL,
+                                              shuffle=SHUFFLE):
         """
         Write harmonisation output file as defined in "Harmonisation Output File Format Definition" document
 
@@ -437,6 +479,12 @@ class HarmOutput:
 
         :type additional_attributes: dict
         :param additional_attributes: Dictionary of additional attributes to give to harmonisation product file for diagnostic purposes
+
+        :type complevel: int
+        :param complevel: zlib compression level (0 for no compression)
+
+        :type shuffle: bool
+        :param shuffle: Switch to apply HDF5 shuffle filter before compression
         """
 
         # define file path
@@ -465,15 +513,19 @@ class HarmOutput:
         # create variables
 
         # > harmonised parameter variable, a
-        parameter_var = rootgrp.createVariable('parameter', 'f8', ('n',), zlib=True, complevel=9)
+        parameter_var = rootgrp.createVariable('parameter', 'f8', ('n',), zlib=complevel > 0, complevel=complevel,
+                                               shuffle=shuffle)
         parameter_var.description = "Harmonisation parameters"
 
         # > harmonised parameter covariance matrix, V
-        parameter_covariance_matrix_var = rootgrp.createVariable('parameter_covariance_matrix', 'f8', ('n', 'n',), zlib=True, complevel=9)
+        parameter_covariance_matrix_var = rootgrp.createVariable('parameter_covariance_matrix', 'f8', ('n', 'n',),
+                                                                 zlib=complevel > 0, complevel=complevel,
+                                                                 shuffle=shuffle)
         parameter_covariance_matrix_var.description = 'Harmonisation parameter covariance matrix'
 
         # harmonisation parameter sensor name variable, Ia
-        parameter_sensors_var = rootgrp.createVariable('parameter_sensors', 'f8', ('n',), zlib=True, complevel=9)
+        parameter_sensors_var = rootgrp.createVariable('parameter_sensors', 'f8', ('n',), zlib=complevel > 0,
+                                                       complevel=complevel, shuffle=shuffle)
         parameter_sensors_var.description = "Sensors associated with harmonisation parameters"
 
         # store data
@@ -488,9 +540,13 @@ class HarmOutput:
 
     def write_harmonisation_residual_files(self, directory,
                                            software, software_version, software_tag, job_id, matchup_dataset,
-                                           lm, k_res, H_res=None):
+                                           lm, k_res, H_res=None, complevel=COMPLEVEL, shuffle=SHUFFLE,
+                                           chunk_matchups=CHUNK_MATCHUPS, dtype=RES_DTYPE, processes=PROCESSES,
+                                           residuals=None):
         """
-        Write harmonisation set of residual files as defined in "Harmonisation Output File Format Definition" document
+        Write harmonisation set of residual files as defined in "Harmonisation Output File Format Definition" document,
+        one file per match-up series, written concurrently by a pool of worker processes. Residuals may be given as a
+        generator of residuals per match-up series, each file is then written as its residuals are generated
 
         :param lm: numpy.ndarray
             match-up series description
@@ -527,6 +583,26 @@ class HarmOutput:
             CORREL - correlation structures present in data
             MCN - Monte Carlo trial number (filled with ___ if not a MC dataset)
 
+        :param complevel: int
+            zlib compression level (0 for no compression)
+
+        :param shuffle: bool
+            Switch to apply HDF5 shuffle filter before compression
+
+        :param chunk_matchups: int
+            Match-ups per chunk of residual variables
+
+        :param dtype: str
+            Storage type of residual variables, 'f4' or 'f8'
+
+        :param processes: int
+            Number of worker processes (default number of CPUs, 1 to write in this process). Written in this process
+            if itself a pool worker (e.g. MC trials, see harm_mc.py), as pool workers cannot have child processes
+
+        :param residuals: generator
+            (optional) Generator of tuple of (data residuals, k residuals) per match-up series, in order of lm, in
+            place of k_res and H_res (see GNAlgo.iter_residuals)
+
         """
 
         total = 0
@@ -534,60 +610,62 @@ class HarmOutput:
         for n in lm[:, 2]:
             total += n
             idx.append(total)
-        n_mu = idx[-1]
-
-        # Write file for each match-up series
-        for i, pair in enumerate(lm):
-
-            # Get required data from lm variable
-            sensor_i = pair[0]
-            sensor_j = pair[1]
-            n_mu = pair[2]
-
-            istart = idx[i]
-            iend = idx[i+1]
-
-            # define file path
-            fname = "_".join(("harm", software, software_version, software_tag, job_id,
-                              matchup_dataset, "res", str(sensor_i), str(sensor_j))) + ".nc"
-            path = pjoin(directory, fname)
-
-            # open netCDF file
-            rootgrp = Dataset(path, 'w')
-
-            # set attributes
-            rootgrp.software = software
-            rootgrp.software_version = software_version
-            rootgrp.software_tag = software_tag
-            rootgrp.job_id = job_id
-            rootgrp.matchup_dataset = matchup_dataset
-            rootgrp.sensor_i_name = sensor_i
-            rootgrp.sensor_j_name = sensor_j
-
-            # create dimensions
-            m = rootgrp.createDimension('m', n_mu)
-            if H_res is not None:
-                n_col = rootgrp.createDimension('n_col', H_res.shape[1])
 
-            # create variables
-
-            # > Harmonisation match-up adjustment factor residuals
-            k_res_var = rootgrp.createVariable('k_res', 'f8', ('m',), zlib=True, complevel=9)
-            k_res_var.description = "k residuals"
-
-            if H_res is not None:
-                # > Harmonisation match-up date residuals
-                H_res_var = rootgrp.createVariable('H_res', 'f8', ('m', 'n_col',), zlib=True, complevel=9)
-                H_res_var.description = "Data residuals"
-
-            # store data
-
-            k_res_var[:] = k_res[istart:iend]
-            if H_res is not None:
-                H_res_var[:, :] = H_res[istart:iend, :]
-
-            # close netCDF file
-            rootgrp.close()
+        # Residuals per match-up series, sliced from residual data if not generated
+        if residuals is None:
+            residuals = ((None if H_res is None else H_res[idx[i]:idx[i+1], :], k_res[idx[i]:idx[i+1]])
+                         for i in xrange(len(lm)))
+
+        # Write file for each match-up series as its residuals are available, with at most two files per worker
+        # process pending (no more worker processes than match-up series)
+        pool = None
+        if (processes != 1) and (len(lm) > 1) and not current_process().daemon:
+            if processes is None:
+                processes = cpu_count()
+            processes = min(processes, len(lm))
+            pool = Pool(processes=processes)
+        pending = []
+
+        try:
+            for pair, (H_res_series, k_res_series) in zip(lm, residuals):
+
+                # Get required data from lm variable
+                sensor_i = pair[0]
+                sensor_j = pair[1]
+
+                # define file path
+                fname = "_".join(("harm", software, software_version, software_tag, job_id,
+                                  matchup_dataset, "res", str(sensor_i), str(sensor_j))) + ".nc"
+                path = pjoin(directory, fname)
+
+                attributes = {"software": software,
+                              "software_version": software_version,
+                              "software_tag": software_tag,
+                              "job_id": job_id,
+                              "matchup_dataset": matchup_dataset,
+                              "sensor_i_name": sensor_i,
+                              "sensor_j_name": sensor_j}
+
+                task = (path, attributes, k_res_series, H_res_series, complevel, shuffle, chunk_matchups, dtype)
+
+                if pool is None:
+                    write_residual_file(task)
+                    continue
+
+                pending.append(pool.apply_async(write_residual_file, (task,)))
+                if len(pending) >= 2 * processes:
+                    pending.pop(0).get()
+
+            for result in pending:
+                result.get()
+
+            if pool is not None:
+                pool.close()
+
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
         return 0
 
@@ -598,12 +676,436 @@ class HarmOutput:
         self.close()
 
     def close(self):
+        if getattr(self, "residual_data", None) is not None:
+            self.residual_data.close()
+
         attrs = vars(self).keys()
         for attr in attrs:
             delattr(self, attr)
 
         self.closed = True
 
+
+class HarmResiduals:
+    """
+    Class for lazy access to the data of harmonisation residual files, reading the residuals of match-up series from
+    file on demand rather than concatenating all match-up series in memory
+
+    Sample Code:
+
+    > Opening data
+
+    HRes = HarmResiduals(["harm_res_S1_S2.nc", "harm_res_S2_S3.nc", ...])
+
+    > Reading data
+
+    k_res_2 = HRes.series(1)                            # k residuals of second match-up series
+    H_res_2_0 = HRes.series(1, "H_res", col=0)          # first data residual column of second match-up series
+    H_res_0 = HRes.column(0)                            # first data residual column of all match-up series
+    k_res, H_res = HRes.materialise()                   # all residual data in memory
+
+    HRes.close()
+
+    :Attributes:
+        .. py:attribute:: paths
+
+            *list:str*
+
+            Paths of harmonisation residual files, one per match-up series
+
+        .. py:attribute:: lm
+
+            *numpy.ndarray*
+
+            match-up series description
+
+        .. py:attribute:: idx
+
+            *list:int*
+
+            Index of first match-up of each match-up series in full residual arrays (with total number of match-ups
+            appended)
+
+        .. py:attribute:: n_col
+
+            *int*
+
+            Number of data residual columns (None if data residuals not available)
+
+        .. py:attribute:: cache_chunks
+
+            *int*
+
+            Maximum number of decoded chunks of residual data held in least recently used cache
+
+        + software, software_version, software_tag, job_id and matchup_dataset attributes (see HarmOutput)
+
+    :Methods:
+        .. py:method:: series(...):
+
+            Return residual data of match-up series
+
+        .. py:method:: column(...):
+
+            Return data residual column of all match-up series
+
+        .. py:method:: materialise(...):
+
+            Return full residual arrays of all match-up series
+
+        .. py:method:: read_chunk(...):
+
+            Return chunk of residual data of match-up series, decoded from file or from cache
+
+        .. py:method:: close(...):
+
+            Close residual files and clear cache
+    """
+
+    def __init__(self, harmonisation_residual_file_paths, cache_chunks=CACHE_CHUNKS):
+        """
+        Initialise lazy residual data object, reading only descriptive data of residual files
+
+        :type harmonisation_residual_file_paths: list:str
+        :param harmonisation_residual_file_paths: list of harmonisation residual file paths
+
+        :type cache_chunks: int
+        :param cache_chunks: Maximum number of decoded chunks of residual data held in least recently used cache
+        """
+
+        self.paths = list(harmonisation_residual_file_paths)
+        self.cache_chunks = cache_chunks
+
+        self.cache = OrderedDict()                  # decoded chunks, by (series, variable, chunk), oldest first
+        self.rootgrps = [None] * len(self.paths)    # residual files, opened on first read
+        self.chunk_sizes = [0] * len(self.paths)    # match-ups per chunk of each residual file
+
+        # first get required descriptive data
+        lm = zeros((len(self.paths), 3))
+        for i, harmonisation_residual_file_path in enumerate(self.paths):
+
+            # open file
+            rootgrp = Dataset(harmonisation_residual_file_path, "r")
+
+            # get attributes from first file
+            if i == 0:
+                software = rootgrp.software
+                software_version = rootgrp.software_version
+                software_tag = rootgrp.software_tag
+                job_id = rootgrp.job_id
+                matchup_dataset = rootgrp.matchup_dataset
+
+                # check if H_res data available and get dimensions
+                n_col = None
+                if 'H_res' in rootgrp.variables.keys():
+                    n_col = rootgrp.variables['H_res'].shape[1]
+
+            # build lm array from data file
+            sensor_i_name = rootgrp.sensor_i_name
+            sensor_j_name = rootgrp.sensor_j_name
+
+            # Hacky solution to turning parameter_sensors into numbers from FastOpt
+            # This really will need changing
+            if software == "FO":
+                if matchup_dataset[:5] == "AVHRR":
+
+                    if sensor_i_name == "m02":
+                        sensor_i_name = -1
+                    else:
+                        sensor_i_name = int(sensor_i_name[1:])
+
+                    sensor_j_name = sensor_j_name[1:]
+                else:
+                    print "Sensor name problem"
+
+            lm[i, 0] = sensor_i_name
+            lm[i, 1] = sensor_j_name
+            lm[i, 2] = rootgrp.variables['k_res'].shape[0]
+
+            # read in chunks of file chunking, if chunked
+            chunking = rootgrp.variables['k_res'].chunking()
+            self.chunk_sizes[i] = CHUNK_MATCHUPS if chunking == 'contiguous' else chunking[0]
+
+            rootgrp.close()
+
+        self.lm = lm
+        self.n_col = n_col
+        self.software = software
+        self.software_version = software_version
+        self.software_tag = software_tag
+        self.job_id = job_id
+        self.matchup_dataset = matchup_dataset
+
+        self.idx = [0]
+        for n in lm[:, 2]:
+            self.idx.append(self.idx[-1] + int(n))
+
+    def read_chunk(self, i, name, c, cache=True):
+        """
+        Return chunk of residual data of match-up series, decoded from file or from cache
+
+        :type i: int
+        :param i: match-up series index
+
+        :type name: str
+        :param name: residual variable name, "k_res" or "H_res"
+
+        :type c: int
+        :param c: chunk index
+
+        :type cache: bool
+        :param cache: switch to store chunk in cache if read from file
+
+        :return:
+            :data: *numpy.ndarray*
+
+            Residual data of chunk
+        """
+
+        key = (i, name, c)
+
+        # move cache hits to most recently used
+        if key in self.cache:
+            data = self.cache.pop(key)
+            self.cache[key] = data
+            return data
+
+        if self.rootgrps[i] is None:
+            self.rootgrps[i] = Dataset(self.paths[i], "r")
+
+        chunk_size = self.chunk_sizes[i]
+        data = asarray(self.rootgrps[i].variables[name][c*chunk_size:(c+1)*chunk_size])
+
+        if cache and (self.cache_chunks > 0):
+            self.cache[key] = data
+            while len(self.cache) > self.cache_chunks:
+                self.cache.popitem(last=False)
+
+        return data
+
+    def series(self, i, name="k_res", col=None, istart=0, iend=None, cache=True):
+        """
+        Return residual data of match-up series
+
+        :type i: int
+        :param i: match-up series index
+
+        :type name: str
+        :param name: residual variable name, "k_res" or "H_res"
+
+        :type col: int
+        :param col: (optional) data residual column, if name is "H_res" (default all columns)
+
+        :type istart: int
+        :param istart: (optional) index of first match-up in match-up series (default 0)
+
+        :type iend: int
+        :param iend: (optional) index after last match-up in match-up series (default end of match-up series)
+
+        :type cache: bool
+        :param cache: switch to store decoded chunks in cache, e.g. False for data read once
+
+        :return:
+            :data: *numpy.ndarray*
+
+            Residual data of match-up series
+        """
+
+        if (name == "H_res") and (self.n_col is None):
+            return None
+
+        if iend is None:
+            iend = self.idx[i+1] - self.idx[i]
+
+        chunk_size = self.chunk_sizes[i]
+        blocks = []
+        for c in xrange(istart / chunk_size, (iend - 1) / chunk_size + 1):
+            data = self.read_chunk(i, name, c, cache=cache)
+            data = data[max(istart - c*chunk_size, 0):iend - c*chunk_size]
+            if col is not None:
+                data = data[:, col]
+            blocks.append(data)
+
+        if blocks == []:
+            return zeros((0,) if (col is not None) or (name == "k_res") else (0, self.n_col))
+
+        return concatenate(blocks)
+
+    def column(self, col, cache=True):
+        """
+        Return data residual column of all match-up series
+
+        :type col: int
+        :param col: data residual column
+
+        :type cache: bool
+        :param cache: switch to store decoded chunks in cache
+
+        :return:
+            :H_res_col: *numpy.ndarray*
+
+            Data residual column (None if data residuals not available)
+        """
+
+        if self.n_col is None:
+            return None
+
+        return concatenate([self.series(i, "H_res", col=col, cache=cache) for i in xrange(len(self.paths))])
+
+    def materialise(self):
+        """
+        Return full residual arrays of all match-up series, as stored in memory by HarmOutput
+
+        :return:
+            :k_res: *numpy.ndarray*
+
+            k residuals
+
+            :H_res: *numpy.ndarray*
+
+            data residual if available (else None)
+        """
+
+        k_res = zeros(self.idx[-1])
+        H_res = None
+        if self.n_col is not None:
+            H_res = zeros((self.idx[-1], self.n_col))
+
+        for i in xrange(len(self.paths)):
+            istart = self.idx[i]
+            iend = self.idx[i+1]
+
+            # whole series read directly, bypassing cache
+            rootgrp = self.rootgrps[i] if self.rootgrps[i] is not None else Dataset(self.paths[i], "r")
+
+            k_res[istart:iend] = rootgrp.variables['k_res'][:]
+            if H_res is not None:
+                H_res[istart:iend, :] = rootgrp.variables['H_res'][:, :]
+
+            if self.rootgrps[i] is None:
+                rootgrp.close()
+
+        return k_res, H_res
+
+    def close(self):
+        """
+        Close residual files and clear cache
+        """
+
+        for i, rootgrp in enumerate(self.rootgrps):
+            if rootgrp is not None:
+                rootgrp.close()
+                self.rootgrps[i] = None
+
+        self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_residual_file(task):
+    """
+    Write harmonisation residual file of match-up series (see HarmOutput.write_harmonisation_residual_files)
+
+    :type task: tuple
+    :param task: file path, dictionary of file attributes, k residuals and data residuals (or None) of match-up series,
+    zlib compression level, shuffle filter switch, match-ups per chunk and residual storage type
+    """
+
+    path, attributes, k_res, H_res, complevel, shuffle, chunk_matchups, dtype = task
+    n_mu = len(k_res)
+    chunk = max(1, min(chunk_matchups, n_mu))
+
+    # open netCDF file
+    rootgrp = Dataset(path, 'w')
+
+    # set attributes
+    rootgrp.setncatts(attributes)
+
+    # create dimensions
+    m = rootgrp.createDimension('m', n_mu)
+    if H_res is not None:
+        n_col = rootgrp.createDimension('n_col', H_res.shape[1])
+
+    # create variables
+
+    # > Harmonisation match-up adjustment factor residuals
+    k_res_var = rootgrp.createVariable('k_res', dtype, ('m',), zlib=complevel > 0, complevel=complevel,
+                                       shuffle=shuffle, chunksizes=(chunk,))
+    k_res_var.description = "k residuals"
+
+    if H_res is not None:
+        # > Harmonisation match-up date residuals
+        H_res_var = rootgrp.createVariable('H_res', dtype, ('m', 'n_col',), zlib=complevel > 0, complevel=complevel,
+                                           shuffle=shuffle, chunksizes=(chunk, H_res.shape[1]))
+        H_res_var.description = "Data residuals"
+
+    # store data
+    k_res_var[:] = k_res
+    if H_res is not None:
+        H_res_var[:, :] = H_res
+
+    # close netCDF file
+    rootgrp.close()
+
+def append_residual_product(path, calc_fields, chunk_matchups=CHUNK_MATCHUPS, complevel=COMPLEVEL, shuffle=SHUFFLE):
+    """
+    Append residual product variables (see RESIDUAL_PRODUCT_VARIABLES) to harmonisation residual file of match-up
+    series, computed and written chunk by chunk of match-ups so only one chunk of the product is held in memory
+
+    :type path: str
+    :param path: path of harmonisation residual file
+
+    :type calc_fields: func
+    :param calc_fields: function of (istart, iend, H_res, k_res) of a chunk of match-ups of the series, with the chunk
+    residuals read from the file (H_res None if not in file), returning dictionary of residual product variable data
+    of the chunk by name
+
+    :type chunk_matchups: int
+    :param chunk_matchups: match-ups per chunk, also the chunk size of the written variables
+
+    :type complevel: int
+    :param complevel: zlib compression level (0 for no compression)
+
+    :type shuffle: bool
+    :param shuffle: switch to apply HDF5 shuffle filter before compression
+    """
+
+    rootgrp = Dataset(path, 'a')
+
+    n_mu = len(rootgrp.dimensions['m'])
+    chunk = max(1, min(chunk_matchups, n_mu))
+
+    # create variables (or reuse if rewriting)
+    variables = {}
+    for name, dtype, attributes in RESIDUAL_PRODUCT_VARIABLES:
+        if name in rootgrp.variables:
+            variables[name] = rootgrp.variables[name]
+            continue
+
+        variables[name] = rootgrp.createVariable(name, dtype, ('m',), zlib=complevel > 0, complevel=complevel,
+                                                 shuffle=shuffle, chunksizes=(chunk,))
+        variables[name].setncatts(attributes)
+
+    # compute and store data chunk by chunk
+    for istart in xrange(0, n_mu, chunk):
+        iend = min(istart + chunk, n_mu)
+
+        H_res = None
+        if 'H_res' in rootgrp.variables:
+            H_res = rootgrp.variables['H_res'][istart:iend, :]
+        k_res = rootgrp.variables['k_res'][istart:iend]
+
+        fields = calc_fields(istart, iend, H_res, k_res)
+        for name in fields.keys():
+            variables[name][istart:iend] = fields[name]
+
+    # close netCDF file
+    rootgrp.close()
+
 if __name__ == "__main__":
 
     def main():
@@ -0,0 +1,561 @@
+"""
+In-process parallel Monte Carlo trial executor for the harmonisation.
+
+Match-up data is read (and best estimate residuals added) once, then MC trials are run over a local process pool. The
+read-only data (e.g. W matrices) is shared with the worker processes through fork copy-on-write, only the arrays each
+trial perturbs are copied. Each trial writes its output to mc/NNN in the job output directory, as if run by
+harm.py job.cfg hout_dir n_trial. Once all trials are complete, their parameters are reduced to a partial statistics
+file in mc/partials, merged by harm_out_combine.py with those of any other nodes. Unless --cold-start, the final
+checkpoint of the best estimate run is also read once and shared, so each trial skips the pre-conditioner stage and
+starts its Gauss-Newton iterations from the best estimate solution.
+
+With --batch N (and warm starting), trials are solved N at a time in each worker process by chord Gauss-Newton
+iterations about the best estimate solution, sharing its Jacobian and block products with it between the trials of the
+batch (see GNAlgo.runGN_batch). Trials whose chord solution fails the gradient test of their own cost are solved by
+full Gauss-Newton iterations.
+
+With --adaptive, trials are run in batches until the parameter standard uncertainties and correlation coefficients are
+determined to the required precision (estimated by batch means), or n_trials is reached, then combined with the
+achieved precision recorded in the combined output file.
+
+With --linear, trials are instead propagated to first order about the best estimate solution (linearised MC). The
+sensitivity of the parameters to the match-up data is evaluated once at the best estimate solution from its final
+checkpoint, then each batch of trials is a single matrix product of the sensitivity matrix with the trial data
+perturbations. Trial parameters and their statistics are written to mc_linear in the job output directory.
+
+Usage:
+python harm_mc.py [--processes N] [--first N] [--seed N] [--resume] [--cold-start] [--batch N] job.cfg hout_dir n_trials
+python harm_mc.py --adaptive [--batch-size N] [--u-digits N] [--corr-tol X] [options] job.cfg hout_dir n_trials
+python harm_mc.py --linear [--batch-size N] [--first N] [--seed N] job.cfg hout_dir n_trials
+"""
+
+'''___Python Modules___'''
+import os.path
+from sys import exit
+from os import makedirs
+from copy import copy, deepcopy
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from traceback import format_exc
+from itertools import izip
+
+'''___Third Party Modules___'''
+from numpy import zeros, column_stack, cov, mean, std, save
+
+'''___Harmonisation Modules___'''
+from config_functions import *
+from harm_algo_EIV import HarmAlgo
+from harm_data_errors import gen_errors, gen_converted_errors, trial_rng
+from harm_data_writer import HarmOutput
+from harm_telemetry import HarmTelemetry
+from harm_out_combine import HarmOutputCombine, reduce_trials_parallel, PARTIAL_DIR
+from harm_mc_stats import mc_precision
+from harm import HarmOp, TOLPC, TOL, TOLA, TOLB, TOLU, GLOBALISATION, MXITER, RECYCLE, MC_SEED, \
+    WARM_START
+
+'''___Constants___'''
+
+MC_DIR = "mc"               # name of MC trial output directory, within job output directory
+TRIAL_FMT = '{:03d}'        # format of MC trial output directory names
+LINEAR_DIR = "mc_linear"    # name of linearised MC output directory, within job output directory
+LINEAR_BATCH = 1000         # number of linearised MC trials propagated simultaneously
+
+# Adaptive MC
+ADAPTIVE_BATCH = 20     # number of MC trials per batch
+MIN_BATCHES = 4         # minimum number of batches before testing precision
+U_DIGITS = 2            # number of significant digits required of parameter standard uncertainties
+CORR_TOL = 0.05         # tolerance required of parameter correlation coefficients
+
+# Data shared with worker processes, set in parent process before pool is forked
+_HOP = None     # harm.HarmOp object for best estimate MC run
+_HDATA = None   # harmonisation match-up data, adjusted to best estimates
+_RESUME = False
+_WARM_STATE = None  # best estimate run solver state to warm start trials from
+
+
+def copy_data(HData):
+    """
+    Return copy of harmonisation data for an MC trial, copying only those attributes modified by a harmonisation run
+    (data values, ks, parameters, indices and uncertainty objects) and sharing the rest (e.g. W matrices)
+
+    :type HData: harm_data_reader.HarmData
+    :param HData: Harmonisation data
+
+    :return:
+        :HData_trial: *harm_data_reader.HarmData*
+
+        Copy of harmonisation data for MC trial
+    """
+
+    HData_trial = copy(HData)
+    HData_trial.values = HData.values.copy()
+    HData_trial.ks = HData.ks.copy()
+    HData_trial.a = HData.a.copy()
+    HData_trial.idx = deepcopy(HData.idx)
+    HData_trial.unc = [copy(block_unc) for block_unc in HData.unc]
+    HData_trial.unck = [copy(block_unc) for block_unc in HData.unck]
+
+    return HData_trial
+
+
+def run_trial(n_trial):
+    """
+    Run MC trial in worker process, writing output to MC trial output directory
+
+    :type n_trial: int
+    :param n_trial: MC trial number
+
+    :return:
+        :n_trial: *int*
+
+        MC trial number
+
+        :error: *str*
+
+        Traceback of error if trial failed, else None
+    """
+
+    try:
+        H = copy(_HOP)
+        H.output_dir = pjoin(_HOP.output_dir, MC_DIR, TRIAL_FMT.format(n_trial))
+        H.n_trial = n_trial     # errors drawn from trial random number stream, independent of worker and order
+
+        try:
+            makedirs(H.output_dir)
+        except OSError:
+            pass
+
+        H.run(tolPC=TOLPC, tol=TOL, tolA=TOLA, tolB=TOLB, tolU=TOLU, show=False, globalisation=GLOBALISATION,
+              mxiter=MXITER, resume=_RESUME, recycle=RECYCLE,
+              warm_start=_WARM_STATE is not None, HData=copy_data(_HDATA), warm_state=_WARM_STATE)
+
+    except Exception:
+        return n_trial, format_exc()
+
+    return n_trial, None
+
+
+def run_trials(trials):
+    """
+    Run MC trials one at a time in worker process (see run_trial)
+
+    :type trials: list:int
+    :param trials: MC trial numbers
+
+    :return:
+        :results: *list:tuple*
+
+        MC trial number and traceback of error if trial failed (else None) per trial
+    """
+
+    return [run_trial(n_trial) for n_trial in trials]
+
+
+def run_trial_batch(trials):
+    """
+    Run batch of MC trials simultaneously in worker process, by chord Gauss-Newton iterations from the best estimate
+    solution (see HarmAlgo.run_batch), writing output to MC trial output directories
+
+    :type trials: list:int
+    :param trials: MC trial numbers
+
+    :return:
+        :results: *list:tuple*
+
+        MC trial number and traceback of error if trial failed (else None) per trial
+    """
+
+    try:
+        # Generate trial datasets, errors drawn from trial random number streams
+        HData_trials = [gen_errors(copy_data(_HDATA), trial_rng(_HOP.mc_seed, n_trial)) for n_trial in trials]
+
+        # Solve trials simultaneously
+        results = HarmAlgo(copy_data(_HDATA)).run_batch(HData_trials, _WARM_STATE, tol=TOL, tolA=TOLA, tolU=TOLU,
+                                                         show=False, mxiter=MXITER)
+
+        # Write trial outputs
+        for n_trial, HData_trial, result in zip(trials, HData_trials, results):
+            output_dir = pjoin(_HOP.output_dir, MC_DIR, TRIAL_FMT.format(n_trial))
+            try:
+                makedirs(output_dir)
+            except OSError:
+                pass
+
+            HOut = HarmOutput()
+            HOut.parameter, HOut.parameter_covariance_matrix, HOut.cost, \
+                HOut.cost_dof, HOut.cost_p_value, HOut.H_res, HOut.k_res = result
+            _HOP.write_output(HOut, HData_trial, output_dir)
+
+    except Exception:
+        error = format_exc()
+        return [(n_trial, error) for n_trial in trials]
+
+    return [(n_trial, None) for n_trial in trials]
+
+
+def run_mc(H, trials, processes=None, resume=False, warm_start=WARM_START, batch=1):
+    """
+    Run MC trials over a local process pool
+
+    :type H: harm.HarmOp
+    :param H: Harmonisation operator for MC trials, with output_dir the job output directory (trial outputs are written
+    to output_dir/mc/NNN)
+
+    :type trials: list:int
+    :param trials: MC trial numbers to run
+
+    :type processes: int
+    :param processes: Number of worker processes (default number of CPUs)
+
+    :type resume: bool
+    :param resume: if True, trials continue from the newest valid checkpoint in their output directory (if any)
+
+    :type warm_start: bool
+    :param warm_start: if True, trials start from the best estimate run solution (if its final checkpoint is available)
+
+    :type batch: int
+    :param batch: Number of trials solved simultaneously per worker task, if greater than 1 trials are run by
+    run_trial_batch (requires warm start, trials are not checkpointed)
+
+    :return:
+        :failed: *dict*
+
+        Dictionary of tracebacks of failed trials, by trial number
+
+        :stats: *harm_mc_stats.MCStats*
+
+        Parameter statistics of completed trials (None if no trials completed)
+    """
+
+    global _HOP, _HDATA, _RESUME, _WARM_STATE
+
+    if processes is None:
+        processes = cpu_count()
+
+    # Read data once, shared with workers on fork (and kept for further calls with same operator)
+    if (_HOP is not H) or (_HDATA is None):
+        print("Opening Data...")
+        _HOP = H
+        _HDATA = H.read_data()
+
+        _WARM_STATE = None
+        if warm_start:
+            _WARM_STATE = H.read_warm_start()
+
+    _RESUME = resume
+
+    # Worker tasks, batches of trials if solving simultaneously
+    worker = run_trials
+    tasks = [[n_trial] for n_trial in trials]
+    if batch > 1:
+        if _WARM_STATE is None:
+            print("Batched trials require best estimate solution to warm start from, running trials individually...")
+        else:
+            worker = run_trial_batch
+            tasks = [trials[i:i + batch] for i in xrange(0, len(trials), batch)]
+
+    print("Running " + str(len(trials)) + " MC trials on " + str(processes) + " processes...")
+
+    failed = {}
+    pool = Pool(processes=processes)
+    try:
+        for results in pool.imap_unordered(worker, tasks):
+            for n_trial, error in results:
+                if error is None:
+                    print("MC trial " + str(n_trial) + " complete")
+                else:
+                    print("MC trial " + str(n_trial) + " failed:\n" + error)
+                    failed[n_trial] = error
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # Reduce completed trials to partial parameter statistics, to be merged by HarmOutputCombine (which reduces
+    # residuals itself, in chunks of match-ups)
+    stats = None
+    done = [n_trial for n_trial in trials if n_trial not in failed]
+    if done != []:
+        print("Reducing MC trial outputs...")
+        partial_dir = pjoin(H.output_dir, MC_DIR, PARTIAL_DIR)
+        try:
+            makedirs(partial_dir)
+        except OSError:
+            pass
+
+        stats = reduce_trials_parallel([pjoin(H.output_dir, MC_DIR, TRIAL_FMT.format(n_trial)) for n_trial in done],
+                                       processes=processes)
+        stats.save(pjoin(partial_dir, "partial_" + TRIAL_FMT.format(min(done)) + "_" + TRIAL_FMT.format(max(done)) +
+                         ".npz"))
+
+    return failed, stats
+
+
+def run_adaptive_mc(H, max_trials, first=1, batch_size=ADAPTIVE_BATCH, u_digits=U_DIGITS, corr_tol=CORR_TOL,
+                    processes=None, resume=False, warm_start=WARM_START, batch=1):
+    """
+    Run MC trials in batches until the parameter standard uncertainties and correlation coefficients are determined to
+    the required precision, estimated by batch means (see harm_mc_stats.mc_precision), or the maximum number of trials
+    is reached. Trial outputs are then combined, with the achieved precision recorded in the combined output file.
+
+    :type H: harm.HarmOp
+    :param H: Harmonisation operator for MC trials, with output_dir the job output directory
+
+    :type max_trials: int
+    :param max_trials: Maximum number of MC trials
+
+    :type first: int
+    :param first: Number of first MC trial
+
+    :type batch_size: int
+    :param batch_size: Number of MC trials per batch
+
+    :type u_digits: int
+    :param u_digits: Number of significant digits required of parameter standard uncertainties
+
+    :type corr_tol: float
+    :param corr_tol: Tolerance required of parameter correlation coefficients
+
+    :type processes: int
+    :param processes: Number of worker processes (default number of CPUs)
+
+    :type resume: bool
+    :param resume: if True, trials continue from the newest valid checkpoint in their output directory (if any)
+
+    :type warm_start: bool
+    :param warm_start: if True, trials start from the best estimate run solution (if its final checkpoint is available)
+
+    :type batch: int
+    :param batch: Number of trials solved simultaneously per worker task (see run_mc)
+
+    :return:
+        :precision: *dict*
+
+        Achieved precision, as returned by harm_mc_stats.mc_precision (None if fewer than two batches completed)
+    """
+
+    batches = []
+    precision = None
+    n_trial = first
+    while n_trial < first + max_trials:
+        trials = range(n_trial, min(n_trial + batch_size, first + max_trials))
+        n_trial = trials[-1] + 1
+
+        stats = run_mc(H, trials, processes=processes, resume=resume, warm_start=warm_start, batch=batch)[1]
+
+        # (batches with fewer than two completed trials do not give a covariance estimate)
+        if (stats is not None) and (stats.n > 1):
+            batches.append(stats)
+
+        if len(batches) >= 2:
+            precision = mc_precision(batches, u_digits=u_digits, corr_tol=corr_tol)
+            print("MC trials: " + str(sum([batch.n for batch in batches])) +
+                  ", max u standard error / tolerance: " + str(max(2 * precision["u_se"] / precision["u_tol"])) +
+                  ", max correlation standard error: " + str(precision["corr_se_max"]))
+
+            if (len(batches) >= MIN_BATCHES) and precision["converged"]:
+                print("MC precision targets met")
+                break
+
+    # Combine trials, recording achieved precision
+    attributes = None
+    if precision is not None:
+        attributes = {"mc_batches": len(batches),
+                      "mc_u_digits": u_digits,
+                      "mc_corr_tol": corr_tol,
+                      "mc_u_standard_error": precision["u_se"],
+                      "mc_u_tolerance": precision["u_tol"],
+                      "mc_corr_standard_error_max": precision["corr_se_max"],
+                      "mc_converged": int(precision["converged"])}
+
+    HarmOutputCombine(H.output_dir, attributes=attributes).run(processes=processes)
+
+    return precision
+
+
+def run_linear_mc(H, trials, batch_size=LINEAR_BATCH):
+    """
+    Run linearised MC trials, propagating data perturbations to first order about the best estimate solution.
+
+    The sensitivity matrix G of the parameters to the converted match-up data (variables and ks, independent and of
+    unit standard uncertainty after ConvertData.convert2ind) is evaluated once at the best estimate solution, with one
+    MINRES solve per parameter. The parameters of trial n are then a + G*e_n, where e_n are the errors full MC trial n
+    draws with gen_errors, as errors of the converted data (see harm_data_errors.gen_converted_errors), so linearised
+    trial n is the first order approximation of full MC trial n. For each batch of trials, G*E is accumulated piece by
+    piece of the converted data as the errors are drawn, so the errors of all trials are never held in memory.
+
+    :type H: harm.HarmOp
+    :param H: Harmonisation operator for MC trials, with output_dir the job output directory (output is written to
+    output_dir/mc_linear)
+
+    :type trials: list:int
+    :param trials: MC trial numbers to run
+
+    :type batch_size: int
+    :param batch_size: Number of trials propagated simultaneously
+
+    :return:
+        :a_trials: *numpy.ndarray*
+
+        Parameters from each MC trial
+    """
+
+    T = HarmTelemetry(software=H.software, software_version=H.software_version, software_tag=H.software_tag,
+                      job_id=H.job_id, matchup_dataset=H.matchup_dataset, mc_linear=True)
+
+    # Best estimate data and solution
+    print("Opening Data...")
+    with T.stage("read"):
+        HData = H.read_data()
+        state = H.read_warm_start()
+
+    if state is None:
+        raise IOError("Linearised MC requires the final checkpoint of the best estimate run")
+
+    print("Determining sensitivity of parameters to data...")
+    HA = HarmAlgo(HData, telemetry=T)
+    a, G = HA.linearise(state)
+
+    # Propagate trial perturbations
+    print("Running " + str(len(trials)) + " linearised MC trials...")
+    a_trials = zeros((len(trials), len(a)))
+    with T.stage("propagate"):
+        for i in xrange(0, len(trials), batch_size):
+            batch = trials[i:i + batch_size]
+            errors = [gen_converted_errors(HA.HData, trial_rng(H.mc_seed, n_trial)) for n_trial in batch]
+
+            # accumulate G*E over pieces of converted data, drawn in the same sequence for every trial
+            da = zeros((len(a), len(batch)))
+            for pieces in izip(*errors):
+                istart = pieces[0][0]
+                E = column_stack([e for _, e in pieces])
+                da += G[:, istart:istart + E.shape[0]].dot(E)
+
+            a_trials[i:i + len(batch), :] = a + da.T
+
+    # Write trial parameters and their statistics
+    print("Writing data to file...")
+    output_dir = pjoin(H.output_dir, LINEAR_DIR)
+    try:
+        makedirs(output_dir)
+    except OSError:
+        pass
+
+    with T.stage("write"):
+        save(pjoin(output_dir, "parameter_trials.npy"), a_trials)
+
+        HOut = HarmOutput(H.hout_path)
+        HOut.parameter_covariance_matrix = cov(a_trials, rowvar=0)
+        HOut.software = "EM"
+        HOut.additional_attributes = {"parameter_trial_mean": mean(a_trials, axis=0),
+                                      "parameter_trial_std": std(a_trials, axis=0),
+                                      "mc_trials": len(trials),
+                                      "mc_linear": 1}
+        HOut.save(output_dir, res=False)
+
+    T.save(pjoin(output_dir, "harm_mc_linear_telemetry"))
+
+    return a_trials
+
+if __name__ == "__main__":
+
+    def main():
+
+        ################################################################################################################
+        # Process configuration data
+        ################################################################################################################
+
+        # 1. Get configuration filename
+        usage = "usage: %prog [options] job-cfg hout-dir n-trials"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--processes", type="int", dest="processes", default=None,
+                          help="number of worker processes (default number of CPUs)")
+        parser.add_option("--first", type="int", dest="first", default=1, help="number of first MC trial")
+        parser.add_option("--seed", type="int", dest="seed", default=MC_SEED, help="MC master seed")
+        parser.add_option("--resume", action="store_true", dest="resume", default=False,
+                          help="continue trials from newest valid checkpoint in their output directory")
+        parser.add_option("--cold-start", action="store_false", dest="warm_start", default=WARM_START,
+                          help="run trials from beginning, not from best estimate run solution")
+        parser.add_option("--batch", type="int", dest="batch", default=1,
+                          help="number of warm started trials solved simultaneously per worker task")
+        parser.add_option("--linear", action="store_true", dest="linear", default=False,
+                          help="run linearised MC trials about best estimate run solution")
+        parser.add_option("--adaptive", action="store_true", dest="adaptive", default=False,
+                          help="run batches of trials until precision targets met, up to n-trials")
+        parser.add_option("--u-digits", type="int", dest="u_digits", default=U_DIGITS,
+                          help="adaptive MC significant digits required of parameter standard uncertainties")
+        parser.add_option("--corr-tol", type="float", dest="corr_tol", default=CORR_TOL,
+                          help="adaptive MC tolerance required of parameter correlation coefficients")
+        parser.add_option("--batch-size", type="int", dest="batch_size", default=None,
+                          help="number of trials per batch (adaptive MC) or propagated simultaneously (linearised MC)")
+        (options, args) = parser.parse_args()
+
+        if len(args) != 3:
+            parser.error("Incorrect number of input arguments")
+
+        job_cfg_fname = os.path.abspath(args[0])
+        hout_dir = os.path.abspath(args[1])
+        n_trials = int(args[2])
+
+        # 2. Read configuration data
+        conf = {}   # dictionary to store data
+
+        #  a. Read software config file
+        software_cfg_fname = "software.cfg"
+        conf['software'], conf['version'], conf['tag'], conf['software_text'] = read_software_cfg(software_cfg_fname)
+
+        # b. Read job config file
+        conf['job_id'], conf['matchup_dataset'], dataset_dir, parameter_path, output_dir, \
+            sensor_functions_path, data_reader_path, conf['job_text'] = read_job_cfg(job_cfg_fname)
+
+        # 3. Get matchup data paths from directory
+        dataset_paths = get_dataset_paths(dataset_dir)
+
+        # 4. Import required specified functions
+        sensor_functions = import_file(sensor_functions_path)
+        harm_data_reader = import_file(data_reader_path)
+
+        # 5. Get paths of best estimate harmonisation output files
+        hout_path, hres_paths = get_harm_paths(hout_dir)
+
+        ################################################################################################################
+        # Run MC trials
+        ################################################################################################################
+
+        H = HarmOp(dataset_paths=dataset_paths,
+                   parameter_path=parameter_path,
+                   output_dir=output_dir,
+                   sensor_model=sensor_functions.sensor_model,
+                   adjustment_model=sensor_functions.adjustment_model,
+                   software_cfg=conf,
+                   data_reader=harm_data_reader.HarmData,
+                   hout_path=hout_path,
+                   hres_paths=hres_paths,
+                   mc_seed=options.seed)
+
+        if options.linear:
+            run_linear_mc(H, range(options.first, options.first + n_trials),
+                          batch_size=options.batch_size or LINEAR_BATCH)
+            return 0
+
+        if options.adaptive:
+            precision = run_adaptive_mc(H, n_trials, first=options.first,
+                                        batch_size=options.batch_size or ADAPTIVE_BATCH,
+                                        u_digits=options.u_digits, corr_tol=options.corr_tol,
+                                        processes=options.processes, resume=options.resume,
+                                        warm_start=options.warm_start, batch=options.batch)
+            if (precision is None) or (not precision["converged"]):
+                print("MC precision targets not met")
+                return 1
+            return 0
+
+        failed = run_mc(H, range(options.first, options.first + n_trials), processes=options.processes,
+                        resume=options.resume, warm_start=options.warm_start, batch=options.batch)[0]
+
+        if failed != {}:
+            print("Failed MC trials: " + ", ".join([str(n) for n in sorted(failed.keys())]))
+            return 1
+
+        return 0
+
+    exit(main())
@@ -0,0 +1,361 @@
+"""
+Mergeable Monte Carlo trial statistics, for streaming and distributed aggregation of MC trial outputs
+
+Created on Sat Oct 17  2026 10:00:00
+"""
+
+'''___Python Modules___'''
+from os import rename
+
+'''___Third Party Modules___'''
+from numpy import asarray, array, zeros, outer, diag, load, savez, std, sqrt, floor, log10, triu_indices, concatenate
+
+
+class MCStats:
+    """
+    Class to accumulate mergeable statistics of named quantities over MC trials - trial count, mean and sum of squared
+    deviations from the mean (M2), or the co-moment matrix for vector quantities with cross moments (e.g. parameters).
+
+    Trials are added one at a time by Welford's update, and statistics of disjoint sets of trials are merged by the
+    pairwise update of Chan et al., so partial statistics (e.g. per worker or per node) combine in any order.
+
+    Sample Code:
+
+    .. code-block:: python
+
+        S = MCStats(cross=["parameter"])
+        S.add("001", parameter=a, k_res=k_res)
+
+        S.merge(MCStats.load("some/path/partial.npz"))
+        V = S.covariance("parameter")
+
+    :Attributes:
+        .. py:attribute:: n
+
+        *int*
+
+        Number of trials
+
+        .. py:attribute:: trials
+
+        *list:str*
+
+        Names of trials included
+
+        .. py:attribute:: cross
+
+        *list:str*
+
+        Names of quantities for which cross moments are accumulated
+
+        .. py:attribute:: mean
+
+        *dict*
+
+        Mean per quantity
+
+        .. py:attribute:: M2
+
+        *dict*
+
+        Sum of squared deviations from the mean per quantity (co-moment matrix if cross moments accumulated)
+
+    :Methods:
+        .. py:method:: add(...):
+
+            Add trial values to statistics
+
+        .. py:method:: merge(...):
+
+            Merge statistics of disjoint set of trials
+
+        .. py:method:: join(...):
+
+            Return statistics of the same trials over consecutive slices of quantities, joined
+
+        .. py:method:: variance(...):
+
+            Return variance of quantity
+
+        .. py:method:: covariance(...):
+
+            Return covariance matrix of vector quantity with cross moments
+
+        .. py:method:: save(...):
+
+            Write statistics to file
+
+        .. py:method:: load(...):
+
+            Return statistics read from file
+    """
+
+    def __init__(self, cross=None):
+        """
+        Initialise statistics
+
+        :type cross: list:str
+        :param cross: (optional) Names of vector quantities for which cross moments are accumulated
+        """
+
+        self.n = 0
+        self.trials = []
+        self.cross = []
+        if cross is not None:
+            self.cross = list(cross)
+        self.mean = {}
+        self.M2 = {}
+
+    def add(self, trial, **values):
+        """
+        Add trial values to statistics
+
+        :type trial: str
+        :param trial: Trial name
+
+        :param values: Trial value per quantity name
+        """
+
+        self.n += 1
+        self.trials.append(trial)
+
+        for name, x in values.items():
+            x = asarray(x, dtype=float)
+
+            if name not in self.mean:
+                self.mean[name] = zeros(x.shape)
+                self.M2[name] = zeros(x.shape + x.shape if name in self.cross else x.shape)
+
+            delta = x - self.mean[name]
+            self.mean[name] += delta / self.n
+
+            if name in self.cross:
+                self.M2[name] += outer(delta, x - self.mean[name])
+            else:
+                self.M2[name] += delta * (x - self.mean[name])
+
+    def merge(self, other):
+        """
+        Merge statistics of disjoint set of trials
+
+        :type other: harm_mc_stats.MCStats
+        :param other: Statistics to merge
+        """
+
+        if other.n == 0:
+            return
+
+        if set(self.trials) & set(other.trials):
+            raise ValueError("Trial sets not disjoint: statistics of some trials would be counted twice")
+
+        n_a = self.n
+        n_b = other.n
+        n = n_a + n_b
+
+        for name in other.mean.keys():
+            if name not in self.mean:
+                self.mean[name] = other.mean[name].copy()
+                self.M2[name] = other.M2[name].copy()
+                continue
+
+            delta = other.mean[name] - self.mean[name]
+            self.mean[name] += delta * n_b / n
+
+            if name in self.cross:
+                self.M2[name] += other.M2[name] + outer(delta, delta) * n_a * n_b / n
+            else:
+                self.M2[name] += other.M2[name] + delta**2 * n_a * n_b / n
+
+        self.n = n
+        self.trials += other.trials
+
+    @staticmethod
+    def join(parts):
+        """
+        Return statistics of the same trials over consecutive slices of quantities (e.g. chunks of match-ups), joined
+        along the first axis of each quantity
+
+        :type parts: list:harm_mc_stats.MCStats
+        :param parts: Statistics of each slice, in order, of the same trials (without cross moments)
+
+        :return:
+            :stats: *harm_mc_stats.MCStats*
+
+            Joined statistics
+        """
+
+        stats = MCStats()
+        if parts == []:
+            return stats
+
+        for part in parts[1:]:
+            if part.trials != parts[0].trials:
+                raise ValueError("Trial sets differ: statistics of slices of different trials cannot be joined")
+
+        stats.n = parts[0].n
+        stats.trials = list(parts[0].trials)
+        for name in parts[0].mean.keys():
+            stats.mean[name] = concatenate([part.mean[name] for part in parts])
+            stats.M2[name] = concatenate([part.M2[name] for part in parts])
+
+        return stats
+
+    def variance(self, name, ddof=1):
+        """
+        Return variance of quantity
+
+        :type name: str
+        :param name: Quantity name
+
+        :type ddof: int
+        :param ddof: Delta degrees of freedom, divisor is n - ddof (default 1)
+
+        :return:
+            :variance: *numpy.ndarray*
+
+            Variance of quantity
+        """
+
+        M2 = self.M2[name]
+        if name in self.cross:
+            M2 = diag(M2)
+
+        return M2 / (self.n - ddof)
+
+    def covariance(self, name, ddof=1):
+        """
+        Return covariance matrix of vector quantity with cross moments
+
+        :type name: str
+        :param name: Quantity name
+
+        :type ddof: int
+        :param ddof: Delta degrees of freedom, divisor is n - ddof (default 1)
+
+        :return:
+            :covariance: *numpy.ndarray*
+
+            Covariance matrix of quantity
+        """
+
+        return self.M2[name] / (self.n - ddof)
+
+    def save(self, path):
+        """
+        Write statistics to .npz file, written to temporary file then renamed into place so an existing file is
+        replaced complete or not at all
+
+        :type path: str
+        :param path: Path of file, with ".npz" extension
+        """
+
+        arrays = {"n": array(self.n),
+                  "trials": array(self.trials, dtype=str),
+                  "cross": array(self.cross, dtype=str)}
+        for name in self.mean.keys():
+            arrays["mean_" + name] = self.mean[name]
+            arrays["M2_" + name] = self.M2[name]
+
+        path_tmp = path[:-4] + ".tmp.npz"
+        with open(path_tmp, "wb") as f:
+            savez(f, **arrays)
+        rename(path_tmp, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Return statistics read from .npz file
+
+        :type path: str
+        :param path: Path of file
+
+        :return:
+            :stats: *harm_mc_stats.MCStats*
+
+            Statistics
+        """
+
+        data = load(path)
+
+        stats = MCStats(cross=[str(name) for name in data["cross"]])
+        stats.n = int(data["n"])
+        stats.trials = [str(trial) for trial in data["trials"]]
+        for key in data.files:
+            if key.startswith("mean_"):
+                stats.mean[key[5:]] = data[key]
+            elif key.startswith("M2_"):
+                stats.M2[key[3:]] = data[key]
+
+        data.close()
+
+        return stats
+
+
+def mc_precision(batches, u_digits=2, corr_tol=0.05):
+    """
+    Return Monte Carlo precision of the parameter standard uncertainties and correlation coefficients determined from
+    batches of MC trials, by the batch-means method - the standard error of each estimate is the standard deviation of
+    its per batch values divided by the square root of the number of batches.
+
+    Following the adaptive Monte Carlo procedure of GUM Supplement 1 (7.9), a standard uncertainty u = c x 10^l, with c
+    of u_digits significant digits, is stable to its numerical tolerance 0.5 x 10^l once twice its standard error is
+    within it. Correlation coefficients are stable once twice their standard error is within corr_tol.
+
+    :type batches: list:harm_mc_stats.MCStats
+    :param batches: Statistics of each batch of MC trials, with parameter cross moments (at least two batches)
+
+    :type u_digits: int
+    :param u_digits: Number of significant digits required of parameter standard uncertainties
+
+    :type corr_tol: float
+    :param corr_tol: Tolerance required of parameter correlation coefficients
+
+    :return:
+        :precision: *dict*
+
+        Dictionary with entries:
+
+        * "u_se" - standard error of each parameter standard uncertainty
+        * "u_tol" - numerical tolerance of each parameter standard uncertainty
+        * "corr_se_max" - maximum standard error of parameter correlation coefficients
+        * "converged" - True if all precision targets are met
+    """
+
+    if len(batches) < 2:
+        raise ValueError("Batch-means precision estimate requires at least two batches")
+
+    # Overall statistics
+    stats = MCStats(cross=["parameter"])
+    for batch in batches:
+        stats.merge(batch)
+    u = sqrt(stats.variance("parameter"))
+
+    # Per batch standard uncertainties and correlation coefficients
+    i_upper = triu_indices(len(u), 1)
+    u_batches = []
+    corr_batches = []
+    for batch in batches:
+        V = batch.covariance("parameter")
+        u_batch = sqrt(diag(V))
+        u_batches.append(u_batch)
+        corr_batches.append((V / outer(u_batch, u_batch))[i_upper])
+
+    u_se = std(u_batches, axis=0, ddof=1) / sqrt(len(batches))
+    corr_se = std(corr_batches, axis=0, ddof=1) / sqrt(len(batches))
+    corr_se_max = 0.
+    if corr_se.size > 0:
+        corr_se_max = corr_se.max()
+
+    # Numerical tolerances of standard uncertainties
+    u_tol = 0.5 * 10**(floor(log10(u)) - (u_digits - 1))
+
+    converged = bool((2 * u_se <= u_tol).all() and (2 * corr_se_max <= corr_tol))
+
+    return {"u_se": u_se, "u_tol": u_tol, "corr_se_max": corr_se_max, "converged": converged}
+
+if __name__ == "__main__":
+
+    def main():
+        return 0
+
+    main()
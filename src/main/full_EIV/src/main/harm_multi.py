@@ -0,0 +1,189 @@
+"""
+Multi-channel harmonisation, running the harmonisations of several channels of the same match-up dataset jointly.
+
+The match-up data of each channel is read in turn, sharing the data common to the channels - the match-up times, the
+scanline uncertainties of the averaged covariates and the W matrices built from them are read and built once, and each
+channel references the same arrays rather than a copy of them, so memory for the common data does not grow with the
+number of channels (see harm_data_reader.HarmData.read_series_variables). The harmonisation of each channel is then
+run over a local process pool, with the read-only data shared with the worker processes through fork copy-on-write.
+Each channel writes its output to the output directory of its job configuration, as if run by harm.py job.cfg.
+
+Usage:
+python harm_multi.py [--processes N] [--resume] job_1.cfg job_2.cfg ...
+"""
+
+'''___Python Modules___'''
+import os.path
+from os import makedirs
+from sys import exit
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from traceback import format_exc
+
+'''___Harmonisation Modules___'''
+from config_functions import *
+from harm import HarmOp, TOLPC, TOL, TOLA, TOLB, TOLU, GLOBALISATION, MXITER, RECYCLE
+
+'''___Constants___'''
+
+# Data shared with worker processes, set in parent process before pool is forked
+_CHANNELS = []      # (harm.HarmOp, harmonisation match-up data) per channel
+_RESUME = False
+
+
+def run_channel(i):
+    """
+    Run harmonisation of channel in worker process, writing output to channel output directory
+
+    :type i: int
+    :param i: Channel index
+
+    :return:
+        :i: *int*
+
+        Channel index
+
+        :error: *str*
+
+        Traceback of error if harmonisation failed, else None
+    """
+
+    H, HData = _CHANNELS[i]
+
+    try:
+        H.run(tolPC=TOLPC, tol=TOL, tolA=TOLA, tolB=TOLB, tolU=TOLU, show=False, globalisation=GLOBALISATION,
+              mxiter=MXITER, resume=_RESUME, recycle=RECYCLE, HData=HData)
+
+    except Exception:
+        return i, format_exc()
+
+    return i, None
+
+
+def run_channels(Hs, processes=None, resume=False):
+    """
+    Run harmonisations of channels of the same match-up dataset over a local process pool, reading data common to the
+    channels once
+
+    :type Hs: list:harm.HarmOp
+    :param Hs: Harmonisation operator per channel
+
+    :type processes: int
+    :param processes: Number of worker processes (default number of CPUs, at most number of channels)
+
+    :type resume: bool
+    :param resume: if True, channels continue from the newest valid checkpoint in their output directory (if any)
+
+    :return:
+        :failed: *dict*
+
+        Dictionary of tracebacks of failed channels, by channel job ID
+    """
+
+    global _CHANNELS, _RESUME
+
+    if processes is None:
+        processes = cpu_count()
+    processes = min(processes, len(Hs))
+
+    # Read data of each channel, sharing common data between channels (channel data then references the shared arrays
+    # it uses, the rest of the shared data is released)
+    shared = {}
+    _CHANNELS = []
+    for H in Hs:
+        print("Opening Data (" + H.job_id + ")...")
+        _CHANNELS.append((H, H.read_data(shared=shared)))
+    del shared
+
+    _RESUME = resume
+
+    print("Running " + str(len(Hs)) + " channel harmonisations on " + str(processes) + " processes...")
+
+    failed = {}
+    pool = Pool(processes=processes)
+    try:
+        for i, error in pool.imap_unordered(run_channel, range(len(Hs))):
+            if error is None:
+                print("Harmonisation " + Hs[i].job_id + " complete")
+            else:
+                print("Harmonisation " + Hs[i].job_id + " failed:\n" + error)
+                failed[Hs[i].job_id] = error
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    _CHANNELS = []
+
+    return failed
+
+if __name__ == "__main__":
+
+    def main():
+
+        ################################################################################################################
+        # Process configuration data
+        ################################################################################################################
+
+        # 1. Get configuration filenames
+        usage = "usage: %prog [options] job-cfg [job-cfg ...]"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--processes", type="int", dest="processes", default=None,
+                          help="number of worker processes (default number of CPUs)")
+        parser.add_option("--resume", action="store_true", dest="resume", default=False,
+                          help="continue channels from newest valid checkpoint in their output directory")
+        (options, args) = parser.parse_args()
+
+        if len(args) < 1:
+            parser.error("Incorrect number of input arguments")
+
+        # 2. Read configuration data
+        conf = {}   # dictionary to store data
+
+        #  a. Read software config file
+        software_cfg_fname = "software.cfg"
+        conf['software'], conf['version'], conf['tag'], conf['software_text'] = read_software_cfg(software_cfg_fname)
+
+        Hs = []
+        for job_cfg_fname in args:
+
+            # b. Read job config file
+            job_conf = dict(conf)
+            job_conf['job_id'], job_conf['matchup_dataset'], dataset_dir, parameter_path, output_dir, \
+                sensor_functions_path, data_reader_path, job_conf['job_text'] = \
+                read_job_cfg(os.path.abspath(job_cfg_fname))
+
+            # 3. Get matchup data paths from directory
+            dataset_paths = get_dataset_paths(dataset_dir)
+
+            # 4. Import required specified functions
+            sensor_functions = import_file(sensor_functions_path)
+            harm_data_reader = import_file(data_reader_path)
+
+            # 5. Make output directory if it doesn't exist
+            try:
+                makedirs(output_dir)
+            except OSError:
+                pass
+
+            Hs.append(HarmOp(dataset_paths=dataset_paths,
+                             parameter_path=parameter_path,
+                             output_dir=output_dir,
+                             sensor_model=sensor_functions.sensor_model,
+                             adjustment_model=sensor_functions.adjustment_model,
+                             software_cfg=job_conf,
+                             data_reader=harm_data_reader.HarmData))
+
+        ################################################################################################################
+        # Run harmonisations
+        ################################################################################################################
+
+        failed = run_channels(Hs, processes=options.processes, resume=options.resume)
+
+        if failed != {}:
+            print("Failed harmonisations: " + ", ".join(sorted(failed.keys())))
+            return 1
+
+        return 0
+
+    exit(main())
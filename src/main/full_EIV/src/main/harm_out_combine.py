@@ -9,16 +9,279 @@ Created on Thurs 18 May  2017 17:00:00
 
 '''___Harmonisation Modules___'''
 from config_functions import *
-from harm_data_writer import HarmOutput
+from harm_data_writer import HarmOutput, HarmResiduals
+from harm_mc_stats import MCStats
 
 '''___Python Modules___'''
 from sys import argv
-from os.path import split
+from os.path import split, basename, getmtime, getsize
 from os.path import join as pjoin
 import os
+import json
 import numpy as np
 from numpy import savetxt, append, zeros, cov, mean, std
 from glob import glob
+from multiprocessing import Pool, cpu_count
+
+'''___Constants___'''
+
+PARTIAL_DIR = "partials"                # name of directory of partial MC statistics files, within MC directory
+STATS_NAME = "mc_stats.npz"             # name of combined MC parameter statistics file, within combine directory
+RES_STATS_FMT = "res_stats_{0}.npz"     # name format of residual statistics file per match-up series, in combine dir
+STATS_KEY_NAME = "mc_stats_key.json"    # name of file of output keys of trials in combined statistics, in combine dir
+CHUNK_SIZE = 10                         # number of MC trials reduced per worker task
+RES_CHUNK = 100000                      # number of match-ups of residuals reduced per worker task
+
+
+def get_trial_paths(mc_dir):
+    """
+    Return paths of MC trial output file and residual files, residual files sorted by name so match-up series are in
+    the same order for all trials
+
+    :type mc_dir: str
+    :param mc_dir: Directory of individual MC trial output
+
+    :return:
+        :harm_out_path: *str*
+
+        Path of harmonisation output file (None if trial failed)
+
+        :harm_res_paths: *list:str*
+
+        Paths of harmonisation residual files
+    """
+
+    harm_out_path, harm_res_paths = get_harm_paths(mc_dir)
+    return harm_out_path, sorted(harm_res_paths, key=basename)
+
+
+def trial_key(mc_dir):
+    """
+    Return key of MC trial outputs, from the names, sizes and modification times of its output files, which changes if
+    the trial is re-run
+
+    :type mc_dir: str
+    :param mc_dir: Directory of individual MC trial output
+
+    :return:
+        :key: *str*
+
+        Key of MC trial outputs (None if trial failed)
+    """
+
+    harm_out_path, harm_res_paths = get_trial_paths(mc_dir)
+
+    if harm_out_path is None:
+        return None
+
+    return ";".join(basename(path) + ":" + str(getsize(path)) + ":" + repr(getmtime(path))
+                    for path in [harm_out_path] + harm_res_paths)
+
+
+def trial_mtime(mc_dir):
+    """
+    Return latest modification time of MC trial output files
+
+    :type mc_dir: str
+    :param mc_dir: Directory of individual MC trial output
+
+    :return:
+        :mtime: *float*
+
+        Latest modification time of MC trial output files
+    """
+
+    harm_out_path, harm_res_paths = get_trial_paths(mc_dir)
+    return max(getmtime(path) for path in [harm_out_path] + harm_res_paths)
+
+
+def reduce_trials(mc_dirs):
+    """
+    Return statistics of parameters of MC trials
+
+    :type mc_dirs: list:str
+    :param mc_dirs: Directories of individual MC trial outputs
+
+    :return:
+        :stats: *harm_mc_stats.MCStats*
+
+        Statistics of MC trial parameters (failed trials, without an output file, are omitted)
+    """
+
+    HOut = HarmOutput()
+    stats = MCStats(cross=["parameter"])
+
+    for mc_dir in mc_dirs:
+        harm_out_path, _ = get_trial_paths(mc_dir)
+
+        # Ignore any failed jobs
+        if harm_out_path is None:
+            continue
+
+        stats.add(trial_name(mc_dir), parameter=HOut.open_harmonisation_output_file(harm_out_path)[0])
+
+    return stats
+
+
+def reduce_trials_parallel(mc_dirs, processes=None, chunk_size=CHUNK_SIZE):
+    """
+    Return statistics of parameters of MC trials, reducing chunks of trials in parallel and merging the partial
+    statistics as they complete
+
+    :type mc_dirs: list:str
+    :param mc_dirs: Directories of individual MC trial outputs
+
+    :type processes: int
+    :param processes: Number of worker processes (default number of CPUs)
+
+    :type chunk_size: int
+    :param chunk_size: Number of MC trials reduced per worker task
+
+    :return:
+        :stats: *harm_mc_stats.MCStats*
+
+        Statistics of MC trial parameters
+    """
+
+    stats = MCStats(cross=["parameter"])
+    if mc_dirs == []:
+        return stats
+
+    if processes is None:
+        processes = cpu_count()
+
+    chunks = [mc_dirs[i:i + chunk_size] for i in xrange(0, len(mc_dirs), chunk_size)]
+
+    pool = Pool(processes=min(processes, len(chunks)))
+    try:
+        for partial in pool.imap_unordered(reduce_trials, chunks):
+            stats.merge(partial)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return stats
+
+
+def reduce_residual_chunk(task):
+    """
+    Return statistics of residuals of a chunk of match-ups of a match-up series over MC trials, reading only that chunk
+    of each trial's residual file
+
+    :type task: tuple
+    :param task: Tuple of (list of tuples of (trial name, trial residual file paths), match-up series index, index of
+    first match-up of chunk, index after last match-up of chunk)
+
+    :return:
+        :stats: *harm_mc_stats.MCStats*
+
+        Statistics of residuals of chunk of match-ups
+    """
+
+    trials, i, istart, iend = task
+    stats = MCStats()
+
+    for name, harm_res_paths in trials:
+        with HarmResiduals([harm_res_paths[i]], cache_chunks=0) as HRes:
+            values = {"k_res": HRes.series(0, "k_res", istart=istart, iend=iend, cache=False)}
+            H_res = HRes.series(0, "H_res", istart=istart, iend=iend, cache=False)
+            if H_res is not None:
+                values["H_res"] = H_res
+
+        stats.add(name, **values)
+
+    return stats
+
+
+def reduce_residuals(trials, i, n_matchups, processes=None, chunk_size=RES_CHUNK):
+    """
+    Return statistics of residuals of a match-up series over MC trials, reducing chunks of match-ups in parallel and
+    joining their statistics, so at most one chunk of residuals per trial is in memory per worker
+
+    :type trials: list:tuple
+    :param trials: Tuples of (trial name, trial residual file paths)
+
+    :type i: int
+    :param i: match-up series index
+
+    :type n_matchups: int
+    :param n_matchups: Number of match-ups in match-up series
+
+    :type processes: int
+    :param processes: Number of worker processes (default number of CPUs)
+
+    :type chunk_size: int
+    :param chunk_size: Number of match-ups reduced per worker task
+
+    :return:
+        :stats: *harm_mc_stats.MCStats*
+
+        Statistics of residuals of match-up series
+    """
+
+    if (trials == []) or (n_matchups == 0):
+        return MCStats()
+
+    if processes is None:
+        processes = cpu_count()
+
+    tasks = [(trials, i, istart, min(istart + chunk_size, n_matchups))
+             for istart in xrange(0, n_matchups, chunk_size)]
+
+    pool = Pool(processes=min(processes, len(tasks)))
+    try:
+        stats = MCStats.join(list(pool.imap(reduce_residual_chunk, tasks)))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return stats
+
+
+def normalised_residuals(HRes, res_stats_paths):
+    """
+    Generate best estimate residuals per match-up series normalised by their MC trial standard deviation, reading one
+    match-up series at a time
+
+    :type HRes: harm_data_writer.HarmResiduals
+    :param HRes: Best estimate residual data
+
+    :type res_stats_paths: list:str
+    :param res_stats_paths: Paths of MC residual statistics files per match-up series
+
+    :return:
+        :residuals: *generator*
+
+        Generator of tuple of (normalised data residuals, normalised k residuals) per match-up series
+    """
+
+    for i in xrange(len(HRes.paths)):
+        res_stats = MCStats.load(res_stats_paths[i])
+
+        k_res = HRes.series(i, "k_res", cache=False) / res_stats.variance("k_res")**0.5
+        H_res = HRes.series(i, "H_res", cache=False)
+        if H_res is not None:
+            H_res = H_res / res_stats.variance("H_res")**0.5
+
+        yield H_res, k_res
+
+
+def trial_name(mc_dir):
+    """
+    Return MC trial name, the name of its output directory
+
+    :type mc_dir: str
+    :param mc_dir: Directory of individual MC trial output
+
+    :return:
+        :name: *str*
+
+        MC trial name
+    """
+
+    return split(os.path.normpath(mc_dir))[1]
 
 
 class HarmOutputCombine(HarmOutput):
@@ -26,25 +289,40 @@ class HarmOutputCombine(HarmOutput):
     Class to statistically combine data from subdirectories of MC trials on harmonisation runs and write to
     harmonisation output files
 
+    Statistics are accumulated as mergeable partial states (see harm_mc_stats.MCStats). Partial parameter statistics
+    files in mc/partials (e.g. written by harm_mc.py per node) are merged, remaining trials are reduced in parallel, and
+    the combined statistics are stored in mc/combine, so subsequent runs only read trials added since. Residual
+    statistics are reduced per match-up series, in chunks of match-ups, and stored per match-up series. Combined
+    statistics are keyed on the trials' output files, and are recombined if any of their trials is re-run.
+
     Sample Code:
     H = HarmOutputCombine("/path/to/output/mc/directories")
     H.run()
 
     """
 
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, attributes=None):
         """
         Initilise class
 
         :param output_mc_dir: str
             path of directory containing individual MC trial output directories
+
+        :param attributes: dict
+            (optional) additional attributes to write to combined output file (e.g. achieved MC precision)
         """
 
+        HarmOutput.__init__(self)
+
         self.output_dir = output_dir
+        self.attributes = attributes
 
-    def run(self):
+    def run(self, processes=None):
         """
         Run routine to combine and save MC trial output data
+
+        :type processes: int
+        :param processes: Number of worker processes to read MC trial outputs (default number of CPUs)
         """
 
         # Initialise
@@ -62,53 +340,85 @@ class HarmOutputCombine(HarmOutput):
         # 1. Compute MC statistics
         ################################################################################################################
 
-        # a. Get individual mc trial output directories
-        mc_dirs = [mc_dir for mc_dir in glob(pjoin(output_mc_dir, "*/")) if split(split(mc_dir)[0])[1] != "combine"]
+        # a. Get individual mc trial output directories and keys of their outputs (failed trials omitted)
+        mc_dirs = {}
+        keys = {}
+        for mc_dir in glob(pjoin(output_mc_dir, "*/")):
+            name = trial_name(mc_dir)
+            if name in ("combine", PARTIAL_DIR):
+                continue
+
+            key = trial_key(mc_dir)
+            if key is not None:
+                mc_dirs[name] = mc_dir
+                keys[name] = key
+
+        # b. Read previously combined statistics, valid only if none of their trials have been re-run or removed since
+        stats_path = pjoin(output_combine_dir, STATS_NAME)
+        stats_key_path = pjoin(output_combine_dir, STATS_KEY_NAME)
+        stats = MCStats(cross=["parameter"])
+        valid = False
+        if os.path.isfile(stats_path) and os.path.isfile(stats_key_path):
+            stats = MCStats.load(stats_path)
+            with open(stats_key_path, "r") as f:
+                keys_previous = json.load(f)
+
+            valid = all(keys.get(name) == keys_previous.get(name) for name in stats.trials)
+            if not valid:
+                print "MC trial outputs changed since statistics combined, recombining all trials..."
+                stats = MCStats(cross=["parameter"])
+
+        # c. Merge partial statistics, if written since their trials' outputs
+        #    (partials overlapping trials already included are skipped, their trials are reduced individually)
+        for partial_path in sorted(glob(pjoin(output_mc_dir, PARTIAL_DIR, "*.npz"))):
+            partial = MCStats.load(partial_path)
+
+            if set(partial.trials) & set(stats.trials):
+                continue
+            if not all(name in mc_dirs for name in partial.trials):
+                continue
+            if any(trial_mtime(mc_dirs[name]) > getmtime(partial_path) for name in partial.trials):
+                continue
+
+            stats.merge(partial)
+
+        # d. Reduce any remaining trials
+        included = set(stats.trials)
+        stats.merge(reduce_trials_parallel([mc_dirs[name] for name in sorted(mc_dirs.keys()) if name not in included],
+                                           processes=processes))
+        stats.save(stats_path)
+        with open(stats_key_path, "w") as f:
+            json.dump(dict((name, keys[name]) for name in stats.trials), f)
+
+        # e. Compute parameter statistics
+        parameter_mean = stats.mean["parameter"]
+        parameter_std = stats.variance("parameter", ddof=0)**0.5
+        parameter_covariance_matrix = stats.covariance("parameter")
+
+        # f. Compute residual statistics per match-up series, reading chunks of match-ups of trials in parallel
+        # Check if best estimate and monte carlo trials have residual data
+        trials_res = [(name, get_trial_paths(mc_dirs[name])[1]) for name in stats.trials]
+        trials_res = [(name, harm_res_paths) for name, harm_res_paths in trials_res if harm_res_paths != []]
+        mc_res = (harm_res_paths_best_estimate != []) and (trials_res != [])
 
-        # Compute parameter statistics
-        a = self.get_parameters_mc(mc_dirs)  # Get parameters from individual mc trials
-        parameter_mean = mean(a, axis=0)
-        parameter_std = std(a, axis=0)
-        parameter_covariance_matrix = cov(a, rowvar=0)
+        if mc_res:
+            HRes = HarmResiduals(sorted(harm_res_paths_best_estimate, key=basename))
 
-        # b. Compute normalised residuals
-        # i. compute residual variance
+            res_stats_paths = []
+            for i in xrange(len(HRes.paths)):
+                res_stats_path = pjoin(output_combine_dir, RES_STATS_FMT.format(i))
+                res_stats_paths.append(res_stats_path)
 
-        # Check if monte carlo trials have residual data
-        mc_res = False
-        if get_harm_paths(mc_dir)[1] is not None:
-            mc_res = True
+                res_stats = MCStats()
+                if valid and os.path.isfile(res_stats_path):
+                    res_stats = MCStats.load(res_stats_path)
+                    if not set(res_stats.trials) <= set(stats.trials):
+                        res_stats = MCStats()
 
-        # Incrementally calculate variance
-        H_res_00 = []
-        if mc_res:
-            for i, mc_dir in enumerate(mc_dirs):
-                harm_res_paths_trial = get_harm_paths(mc_dir)[1]
-                n_trial = i+1
-
-                if n_trial == 1:
-                    _, k_res_e, H_res_e, _, _, _, _, _ = self.open_harmonisation_residual_files(harm_res_paths_trial)
-                    H_res_00.append(H_res_e[0,0])
-                    k_res_variance = zeros(k_res_e.shape)
-                    H_res_variance = zeros(H_res_e.shape)
-                else:
-                    _, k_res_i, H_res_i, _, _, _, _, _ = self.open_harmonisation_residual_files(harm_res_paths_trial)
-                    k_res_mu = k_res_e + (k_res_i-k_res_e)/n_trial
-                    H_res_mu = H_res_e + (H_res_i-H_res_e)/n_trial
-                    H_res_00.append(H_res_i[0, 0])
-                    k_res_v = (n_trial-2)*k_res_variance + (n_trial-1)*(k_res_e-k_res_mu)**2 + (k_res_i-k_res_mu)**2
-                    H_res_v = (n_trial-2)*H_res_variance + (n_trial-1)*(H_res_e-H_res_mu)**2 + (H_res_i-H_res_mu)**2
-
-                    k_res_e = k_res_mu
-                    H_res_e = H_res_mu
-
-                    k_res_variance = k_res_v/(n_trial-1)
-                    H_res_variance = H_res_v/(n_trial-1)
-
-            # ii. normalise best estimate residuals
-            lm, k_res, H_res, _, _, _, _, _ = self.open_harmonisation_residual_files(harm_res_paths_best_estimate)
-            k_res_normalised = k_res / k_res_variance**0.5
-            H_res_normalised = H_res / H_res_variance**0.5
+                included = set(res_stats.trials)
+                res_stats.merge(reduce_residuals([trial for trial in trials_res if trial[0] not in included], i,
+                                                 HRes.idx[i+1] - HRes.idx[i], processes=processes))
+                res_stats.save(res_stats_path)
 
         ################################################################################################################
         # 2. Get initial data from first trial output
@@ -122,47 +432,27 @@ class HarmOutputCombine(HarmOutput):
         # Update variables to MC specific values
         self.parameter_covariance_matrix = parameter_covariance_matrix
         self.software = "EM"
-        self.lm = lm.astype(int)
         self.additional_attributes = {"parameter_trial_mean": parameter_mean,
-                                      "parameter_trial_std": parameter_std}
+                                      "parameter_trial_std": parameter_std,
+                                      "mc_trials": stats.n}
+        if self.attributes is not None:
+            self.additional_attributes.update(self.attributes)
 
+        # Best estimate residuals normalised per match-up series as written
         if mc_res:
-            self.k_res = k_res_normalised
-            self.H_res = H_res_normalised
+            self.lm = HRes.lm.astype(int)
+            self.residuals = normalised_residuals(HRes, res_stats_paths)
 
         ################################################################################################################
         # 3. Write data
         ################################################################################################################
 
-        self.save(output_combine_dir, res=True)
-
-    def get_parameters_mc(self, mc_dirs):
-        """
-        Return array of parameter outputs for each MC trial
-
-        :param mc_dirs: list: str
-            List of directories of individual MC trial outputs
-
-        :return:
-            :a: numpy.ndarray
-                Parameters from each MC trial
-        """
-
-        # Get number of parameters
-        harm_out_path, harm_res_path = get_harm_paths(mc_dirs[0])
-        n_a = self.open_harmonisation_output_file(harm_out_path)[0].shape[0]
-
-        # Initialise array
-        a = zeros((len(mc_dirs), n_a))
-
-        for i, mc_dir in enumerate(mc_dirs):
-            harm_out_path, harm_res_path = get_harm_paths(mc_dir)
-
-            # Ignore any failed jobs
-            if harm_out_path is not None:
-                a[i, :] = self.open_harmonisation_output_file(harm_out_path)[0]
+        try:
+            self.save(output_combine_dir, res=mc_res)
+        finally:
+            if mc_res:
+                HRes.close()
 
-        return a[~np.all(a == 0, axis=1)]
 
 if __name__ == "__main__":
 
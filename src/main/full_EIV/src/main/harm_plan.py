@@ -0,0 +1,571 @@
+"""
+Resource planner for harmonisation jobs, to estimate the memory and time a harmonisation run requires before it is run
+
+The plan is built from the match-up series file metadata only (lm, variable dimensions, the first row of systematic
+uncertainties and, for series with averaged covariates, the match-up times the W matrices are built from), as read
+and interpreted by the job's data reader (see harm_data_reader.HarmData.read_metadata), without reading the match-up
+data. From this the block structure of the harmonisation data, the number of variables after
+conversion to independent quantities (including averaging window expansions and systematic effect variables) and the
+size of each major array of the run are determined.
+
+Sizes are converted to predicted peak resident set size and stage times with coefficients calibrated by running the
+synthetic benchmark (see harm_benchmark.py) at a range of sizes on the target machine.
+
+Usage:
+python harm_plan.py --calibrate [--sizes N,N,...] [--n-sensors N] [--calibration path/to/file.json]
+python harm.py --plan job.cfg
+"""
+
+'''___Python Modules___'''
+import json
+import os.path
+from os.path import join as pjoin
+from optparse import OptionParser
+from resource import getrusage, RUSAGE_SELF
+
+'''___Third Party Modules___'''
+from numpy import asarray, loadtxt, polyfit, dot
+
+'''___Constants___'''
+
+FLOAT_BYTES = 8     # bytes per float64 array element
+INDEX_BYTES = 4     # bytes per sparse matrix index element
+
+# Calibration
+CALIBRATION_PATH = pjoin(os.path.dirname(os.path.abspath(__file__)), "harm_plan_calibration.json")
+CALIBRATION_SIZES = [500, 1000, 2000, 4000]     # benchmark number of match-ups per match-up series
+STAGES = ["read", "flatten", "runPC", "convert2ind", "runGN", "calc_unc"]
+
+
+class HarmPlan:
+    """
+    Class to plan the memory and time requirements of a harmonisation run
+
+    Sample Code:
+
+    .. code-block:: python
+
+        P = HarmPlan(calibration=read_calibration())
+        P.from_files(dataset_paths, parameter_path, harm_data_reader.HarmData)
+        print P.report()
+
+    :Attributes:
+        .. py:attribute:: Nm
+
+        *list:int*
+
+        Number of match-ups per match-up series
+
+        .. py:attribute:: Im
+
+        *list:list*
+
+        Sensor numbers per match-up series (0 the reference sensor)
+
+        .. py:attribute:: m
+
+        *int*
+
+        Number of covariates in sensor model
+
+        .. py:attribute:: N_a
+
+        *int*
+
+        Total number of parameters
+
+        .. py:attribute:: blocks
+
+        *list:dict*
+
+        Data blocks, each with entries "n_mu", "n_sensor", "n_cov", "form", "N_var" (number of variables), "N_con"
+        (number of variables after conversion to independent quantities) and "n_w" (averaging window width)
+
+        .. py:attribute:: sample
+
+        *list:int*
+
+        Number of match-ups per match-up series in pre-conditioner sample
+
+        .. py:attribute:: N_sys
+
+        *int*
+
+        Number of systematic effect variables added in conversion to independent quantities
+
+        .. py:attribute:: calibration
+
+        *dict*
+
+        Calibration coefficients, as returned by read_calibration()
+
+    :Methods:
+        .. py:method:: from_files(...):
+
+            Determine data structure from match-up series file metadata
+
+        .. py:method:: from_data(...):
+
+            Determine data structure from harmonisation data
+
+        .. py:method:: set_structure(...):
+
+            Determine data blocks, pre-conditioner sample size and number of systematic effect variables
+
+        .. py:method:: calc_arrays(...):
+
+            Return size of each major array of run
+
+        .. py:method:: predict(...):
+
+            Return predicted peak memory and stage times of run
+
+        .. py:method:: report(...):
+
+            Return plan as text report
+    """
+
+    def __init__(self, calibration=None, recycle=0):
+        """
+        Initialise plan
+
+        :type calibration: dict
+        :param calibration: (optional) calibration coefficients, as returned by read_calibration(), if None only array
+        sizes are predicted
+
+        :type recycle: int
+        :param recycle: number of previous Gauss-Newton steps recycled to warm start Krylov solves
+        """
+
+        self.Nm = []
+        self.Im = []
+        self.m = 0
+        self.N_a = 0
+        self.N_p = 0
+        self.blocks = []
+        self.sample = []
+        self.N_sys = 0
+        self.recycle = recycle
+        self.calibration = calibration
+
+    def from_files(self, dataset_paths, parameter_path, data_reader):
+        """
+        Determine data structure from match-up series file metadata, without reading the match-up data. The covariates
+        read and the correlation form of each data block are those the job's data reader assigns, as described by its
+        metadata methods (see harm_data_reader.HarmData.read_metadata and metadata_block_form)
+
+        :type dataset_paths: list:str
+        :param dataset_paths: Paths of match-up series files
+
+        :type parameter_path: str
+        :param parameter_path: Path of initial parameter estimates file
+
+        :type data_reader: cls
+        :param data_reader: Job harmonisation data reader class, e.g. harm_data_reader_AVHRR_3.HarmData
+        """
+
+        # 1. Open match-up series metadata
+        reader = data_reader()
+        metadata = reader.read_metadata(dataset_paths)
+        lm = metadata["lm"]
+        m = metadata["m"]
+
+        # 2. Determine sensors per match-up series (as harm_data_reader.HarmData.open_data)
+        sensors = []
+        Im = []
+        for info in lm:
+            pair = [0, 0]
+            for j, sensor in enumerate(info[:2]):
+                if sensor not in sensors:
+                    sensors.append(sensor)
+                pair[j] = sensors.index(sensor)
+            Im.append(pair)
+
+        # 3. Number of parameters
+        a = loadtxt(parameter_path, delimiter=',')
+        N_p = a.shape[-1]
+
+        # 4. Block correlation forms and sizes
+        Nm = [int(info[2]) for info in lm]
+
+        def block_form(n_mu, n_sensor, n_cov):
+            col = n_cov - 1
+            if Im[n_mu - 1][1] == n_sensor:
+                col = n_cov + m - 1
+
+            return reader.metadata_block_form(metadata, n_mu, n_sensor, col)
+
+        self.set_structure(Nm, Im, m, a.size, N_p, block_form)
+
+    def from_data(self, HData):
+        """
+        Determine data structure from harmonisation data (as read, before conversion to independent quantities)
+
+        :type HData: harm_data_reader.HarmData
+        :param HData: Harmonisation data
+        """
+
+        idx = HData.idx
+        forms = {}
+        for n_mu, n_sensor, n_cov, unc in zip(idx['n_mu'], idx['n_sensor'], idx['n_cov'], HData.unc):
+            if unc.form == "ave":
+                forms[(n_mu, n_sensor, n_cov)] = ("ave", unc.uR.shape[1], unc.W.shape[1])
+            else:
+                forms[(n_mu, n_sensor, n_cov)] = (unc.form, 0, 0)
+
+        N_sensors = len(set([n for pair in idx['Im'] for n in pair])) - 1
+        self.set_structure(list(idx['Nm']), [list(pair) for pair in idx['Im']], idx['n_cov'][-1], len(HData.a),
+                           len(HData.a) / N_sensors, lambda n_mu, n_sensor, n_cov: forms[(n_mu, n_sensor, n_cov)])
+
+    def set_structure(self, Nm, Im, m, N_a, N_p, block_form):
+        """
+        Determine data blocks, pre-conditioner sample size and number of systematic effect variables
+
+        :type Nm: list:int
+        :param Nm: Number of match-ups per match-up series
+
+        :type Im: list:list
+        :param Im: Sensor numbers per match-up series
+
+        :type m: int
+        :param m: Number of covariates in sensor model
+
+        :type N_a: int
+        :param N_a: Total number of parameters
+
+        :type N_p: int
+        :param N_p: Number of parameters per sensor
+
+        :type block_form: func
+        :param block_form: Function of (n_mu, n_sensor, n_cov) returning block correlation form, averaging window
+        width and number of W matrix columns
+        """
+
+        self.Nm = Nm
+        self.Im = Im
+        self.m = m
+        self.N_a = N_a
+        self.N_p = N_p
+
+        # block order (as harm_data_reader.HarmData.open_data) - reference sensor blocks, then by covariate
+        order = [(n_mu + 1, 0, 1) for n_mu, pair in enumerate(Im) if 0 in pair]
+        for n_cov in xrange(1, m + 1):
+            order += [(n_mu + 1, n_sensor, n_cov) for n_mu, pair in enumerate(Im) for n_sensor in pair
+                      if n_sensor != 0]
+
+        self.blocks = []
+        for n_mu, n_sensor, n_cov in order:
+            form, n_w, W_cols = block_form(n_mu, n_sensor, n_cov)
+
+            N_con = Nm[n_mu - 1]
+            if form == "ave":
+                N_con = W_cols
+
+            self.blocks.append({"n_mu": n_mu, "n_sensor": n_sensor, "n_cov": n_cov, "form": form,
+                                "N_var": Nm[n_mu - 1], "N_con": N_con, "n_w": n_w})
+
+        # systematic effect variables, one per sensor per covariate with random+systematic blocks
+        N_sensors = len(set([n for pair in Im for n in pair])) - 1
+        rs_covs = set([block["n_cov"] for block in self.blocks if block["form"] == "rs"])
+        self.N_sys = N_sensors * len(rs_covs)
+
+        # pre-conditioner sample - approximately one match-up per averaging window of widest averaged covariate
+        self.sample = []
+        for n_mu, N in enumerate(Nm):
+            ave_blocks = [block for block in self.blocks if (block["n_mu"] == n_mu + 1) and (block["form"] == "ave")]
+            if ave_blocks:
+                widest = max(ave_blocks, key=lambda block: block["n_w"])
+                N = max(1, widest["N_con"] / widest["n_w"])
+            self.sample.append(N)
+
+    def calc_arrays(self):
+        """
+        Return size of each major array of run, by stage
+
+        :return:
+            :arrays: *list:tuple*
+
+            Arrays as tuple of (stage, array description, size in bytes, resident) - resident arrays are held from
+            their stage to the end of the run, otherwise they are only held during the stage
+        """
+
+        F = FLOAT_BYTES
+        m = self.m
+        N_mu = sum(self.Nm)
+        N_var = sum([block["N_var"] for block in self.blocks])
+        N_con = sum([block["N_con"] for block in self.blocks]) + self.N_sys
+        ave_blocks = [block for block in self.blocks if block["form"] == "ave"]
+        nnz = sum([block["N_var"] * block["n_w"] for block in ave_blocks])
+        nnz_max = max([0] + [block["N_var"] * block["n_w"] for block in ave_blocks])
+        n_w = max([0] + [block["n_w"] for block in ave_blocks])
+        N_s = sum(self.sample)
+        Nm_s = max(self.sample)
+        ncol = N_con + N_mu + self.N_a
+        nrow = N_con + N_mu
+
+        arrays = [("read", "match-up data arrays (H, Ur, Us)", 3 * N_mu * 2 * m * F, False),
+                  ("read", "match-up vectors (K, uK, times)", 4 * N_mu * F, True),
+                  ("read", "averaged covariate uncertainties", 4 * N_mu * n_w * F, True),
+                  ("read", "W matrices (CSR)", nnz * (F + INDEX_BYTES) + (N_mu * len(ave_blocks) * INDEX_BYTES), True),
+                  ("read", "W matrix construction arrays (largest block)", 3 * nnz_max * F, False),
+                  ("flatten", "flattened values", N_var * F, True),
+                  ("runPC", "pre-conditioner sample", N_s * (len(self.blocks) + 2) * F, False),
+                  ("runPC", "VK, LK (dense N_sample^2)", 3 * N_s**2 * F, False),
+                  ("runPC", "JK block products (dense N_series_sample^2)", 2 * Nm_s**2 * F, False),
+                  ("convert2ind", "converted values", N_con * F, True),
+                  ("convert2ind", "append chain copy", N_con * F, False),
+                  ("runGN", "variable and parameter estimates", 2 * ncol * F, True),
+                  ("runGN", "Jacobian blocks", 2 * N_mu * (m + self.N_p + 2) * F, False),
+                  ("runGN", "LSMR work vectors", (5 * ncol + 2 * nrow) * F, False),
+                  ("runGN", "recycled subspace", 2 * self.recycle * ncol * F, False),
+                  ("calc_unc", "MINRES work vectors and parameter covariance", (6 * ncol + self.N_a**2) * F, False)]
+
+        return arrays
+
+    def predict(self):
+        """
+        Return predicted peak memory and stage times of run
+
+        :return:
+            :prediction: *dict*
+
+            Dictionary with entries:
+
+            * "N_mu" - total number of match-ups
+            * "N_var" - total number of variables
+            * "N_con" - total number of variables after conversion to independent quantities
+            * "N_sample" - total number of match-ups in pre-conditioner sample
+            * "stage_bytes" - dictionary of peak array bytes per stage
+            * "peak_bytes" - peak array bytes of run
+            * "peak_rss_kb" - predicted peak resident set size (None if uncalibrated)
+            * "time" - dictionary of predicted time per stage in seconds, runGN per GN iteration (None if uncalibrated)
+        """
+
+        arrays = self.calc_arrays()
+
+        stage_bytes = {}
+        resident = 0
+        for stage in STAGES:
+            transient = sum([nbytes for s, name, nbytes, res in arrays if (s == stage) and not res])
+            resident += sum([nbytes for s, name, nbytes, res in arrays if (s == stage) and res])
+            stage_bytes[stage] = resident + transient
+
+        N_mu = sum(self.Nm)
+        N_con = sum([block["N_con"] for block in self.blocks]) + self.N_sys
+        N_s = sum(self.sample)
+        work = calc_work(self)
+
+        prediction = {"N_mu": N_mu,
+                      "N_var": sum([block["N_var"] for block in self.blocks]),
+                      "N_con": N_con,
+                      "N_sample": N_s,
+                      "stage_bytes": stage_bytes,
+                      "peak_bytes": max(stage_bytes.values()),
+                      "peak_rss_kb": None,
+                      "time": None}
+
+        c = self.calibration
+        if c is not None:
+            prediction["peak_rss_kb"] = c["rss_base_kb"] + c["rss_factor"] * prediction["peak_bytes"] / 1024.
+            prediction["time"] = {"runPC": c["runPC"] * work["runPC"],
+                                  "convert2ind": c["convert2ind"] * work["convert2ind"],
+                                  "runGN": c["runGN"] * work["runGN"]}
+
+        return prediction
+
+    def report(self):
+        """
+        Return plan as text report
+
+        :return:
+            :report: *str*
+
+            Text report
+        """
+
+        prediction = self.predict()
+
+        lines = ["Harmonisation Plan",
+                 "",
+                 "Match-up series:\t\t" + str(len(self.Nm)),
+                 "Match-ups:\t\t\t" + str(prediction["N_mu"]),
+                 "Data blocks:\t\t\t" + str(len(self.blocks)) + " (" +
+                 ", ".join([form + ": " + str(len([b for b in self.blocks if b["form"] == form]))
+                            for form in ("r", "rs", "ave")]) + ")",
+                 "Variables:\t\t\t" + str(prediction["N_var"]),
+                 "Converted variables:\t\t" + str(prediction["N_con"]) + " (systematic: " + str(self.N_sys) + ")",
+                 "Parameters:\t\t\t" + str(self.N_a),
+                 "Pre-conditioner sample:\t\t" + str(prediction["N_sample"]),
+                 "",
+                 "stage\t\tarray\t\t\t\t\t\t\tMB"]
+
+        for stage, name, nbytes, resident in self.calc_arrays():
+            lines.append("{0:<16}{1:<56}{2:.1f}".format(stage, name, nbytes / 1024.**2))
+
+        lines += ["", "stage\t\tpeak array MB"]
+        for stage in STAGES:
+            lines.append("{0:<16}{1:.1f}".format(stage, prediction["stage_bytes"][stage] / 1024.**2))
+
+        lines += ["", "Peak array memory:\t\t{0:.1f} MB".format(prediction["peak_bytes"] / 1024.**2)]
+
+        if prediction["peak_rss_kb"] is None:
+            lines.append("Uncalibrated - run harm_plan.py --calibrate to predict peak RSS and stage times")
+        else:
+            lines += ["Predicted peak RSS:\t\t{0:.1f} MB".format(prediction["peak_rss_kb"] / 1024.),
+                      "Predicted runPC time:\t\t{0:.1f} s".format(prediction["time"]["runPC"]),
+                      "Predicted convert2ind time:\t{0:.1f} s".format(prediction["time"]["convert2ind"]),
+                      "Predicted time per GN iteration:\t{0:.1f} s".format(prediction["time"]["runGN"])]
+
+        return "\n".join(lines)
+
+
+def calc_work(plan):
+    """
+    Return work measures of plan stages the calibrated time coefficients scale - cube of pre-conditioner sample size for
+    runPC (Cholesky factorisation), converted variables times data blocks for convert2ind (append chain) and operator
+    size for runGN (per Gauss-Newton iteration, scaling the cost of each LSMR iteration)
+
+    :type plan: harm_plan.HarmPlan
+    :param plan: Plan
+
+    :return:
+        :work: *dict*
+
+        Dictionary of work measure per stage
+    """
+
+    N_mu = sum(plan.Nm)
+    N_con = sum([block["N_con"] for block in plan.blocks]) + plan.N_sys
+    nnz = sum([block["N_var"] * block["n_w"] for block in plan.blocks if block["form"] == "ave"])
+
+    return {"runPC": float(sum(plan.sample))**3,
+            "convert2ind": float(N_con) * len(plan.blocks),
+            "runGN": float(N_con + N_mu + plan.N_a + nnz)}
+
+
+def calibrate(sizes=CALIBRATION_SIZES, n_sensors=3, seed=0):
+    """
+    Return calibration coefficients of plan predictions, determined by running the synthetic benchmark at a range of
+    sizes (in increasing order, as the peak resident set size of the process only increases). Time coefficients are
+    least-squares fits of time to stage work measure (see calc_work), peak RSS is a linear fit to peak array memory.
+
+    :type sizes: list:int
+    :param sizes: Number of match-ups per match-up series of each benchmark run (at least two)
+
+    :type n_sensors: int
+    :param n_sensors: Number of sensors in benchmark
+
+    :type seed: int
+    :param seed: Random number generator seed
+
+    :return:
+        :calibration: *dict*
+
+        Calibration coefficients
+    """
+
+    from harm_benchmark import generate_synthetic_data, run_benchmark
+
+    if len(sizes) < 2:
+        raise ValueError("Calibration requires at least two benchmark sizes")
+
+    work = {"runPC": [], "convert2ind": [], "runGN": []}
+    times = {"runPC": [], "convert2ind": [], "runGN": []}
+    peak_kb = []
+    rss_kb = []
+
+    for n_matchups in sorted(sizes):
+        HData = generate_synthetic_data(n_sensors, n_matchups, seed)[0]
+
+        plan = HarmPlan()
+        plan.from_data(HData)
+        w = calc_work(plan)
+        peak_kb.append(plan.predict()["peak_bytes"] / 1024.)
+
+        T = run_benchmark(HData)[0]
+        summary = T.summary()
+        rss_kb.append(getrusage(RUSAGE_SELF).ru_maxrss)
+
+        for stage in work.keys():
+            if stage not in summary:
+                continue
+            t = summary[stage]["wall"]
+            if stage == "runGN":
+                t /= max(1, summary.get("GN iteration", {"calls": 1})["calls"])
+            work[stage].append(w[stage])
+            times[stage].append(t)
+
+        print "Calibration run - n_matchups: " + str(n_matchups) + ", peak RSS: " + str(rss_kb[-1]) + " kB"
+
+    calibration = {"sizes": sorted(sizes), "n_sensors": n_sensors}
+    for stage in work.keys():
+        w = asarray(work[stage])
+        calibration[stage] = dot(w, times[stage]) / dot(w, w) if len(w) > 0 else 0.
+
+    rss_factor = polyfit(peak_kb, rss_kb, 1)[0]
+    calibration["rss_factor"] = max(1.0, rss_factor)
+    calibration["rss_base_kb"] = max(0.0, rss_kb[0] - calibration["rss_factor"] * peak_kb[0])
+
+    return calibration
+
+
+def read_calibration(path=CALIBRATION_PATH):
+    """
+    Return calibration coefficients from file
+
+    :type path: str
+    :param path: Path of calibration file
+
+    :return:
+        :calibration: *dict*
+
+        Calibration coefficients (None if no calibration file)
+    """
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_calibration(calibration, path=CALIBRATION_PATH):
+    """
+    Write calibration coefficients to file
+
+    :type calibration: dict
+    :param calibration: Calibration coefficients
+
+    :type path: str
+    :param path: Path of calibration file
+    """
+
+    with open(path, "w") as f:
+        json.dump(calibration, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+
+    def main():
+
+        usage = "usage: %prog --calibrate [options]"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--calibrate", action="store_true", dest="calibrate", default=False,
+                          help="calibrate plan predictions with synthetic benchmark on this machine")
+        parser.add_option("--sizes", dest="sizes", default=",".join([str(n) for n in CALIBRATION_SIZES]),
+                          help="comma separated benchmark numbers of match-ups per match-up series")
+        parser.add_option("--n-sensors", type="int", dest="n_sensors", default=3, help="number of benchmark sensors")
+        parser.add_option("--calibration", dest="calibration_path", default=CALIBRATION_PATH,
+                          help="path of calibration file to write")
+        (options, args) = parser.parse_args()
+
+        if not options.calibrate:
+            parser.error("Nothing to do - plan a job with harm.py --plan job.cfg")
+
+        calibration = calibrate([int(n) for n in options.sizes.split(",")], options.n_sensors)
+        write_calibration(calibration, options.calibration_path)
+
+        print "Calibration written to " + options.calibration_path
+
+        return 0
+
+    main()
@@ -0,0 +1,417 @@
+"""
+Residual product, completing the harmonisation residual files with the variables of the CDL residual dataset
+(resources/cdl/harm_FO_residuals_dataset.cdl) - the match-up times, the measurands of both sensors of the match-up series
+with their uncertainties due to sensor state variables and calibration parameters, and the uncertainties of the
+harmonisation residuals with the normalised residuals.
+
+The product is computed in fixed size chunks of match-ups, evaluating the uncertainty quadratic forms row-wise
+(e.g. u_x_i**2 = J_i V J_i^T) for the chunk only, so memory use is bounded by the chunk size rather than the size of the
+match-up series.
+
+Usage:
+python harm_residual_product.py [--chunk-size N] job.cfg harmonisation-output-dir
+
+or, to check the measurands of the residual product against those of the GN algorithm on synthetic match-up data,
+python harm_residual_product.py --check
+"""
+
+'''___Python Modules___'''
+import os.path
+from sys import exit
+from copy import deepcopy
+from optparse import OptionParser
+from time import mktime
+
+'''___Third Party Modules___'''
+from numpy import zeros, asarray, column_stack, hstack, einsum, ix_, arange, append, amax, absolute, maximum
+from netCDF4 import Dataset
+
+'''___Harmonisation Modules___'''
+from config_functions import *
+from harm_data_writer import HarmOutput, append_residual_product, CHUNK_MATCHUPS, COMPLEVEL, SHUFFLE
+from unc_functions import calc_quad_form, calc_unc
+from convert_data import ConvertData
+from GN_algo import GNAlgo
+
+'''___Constants___'''
+
+CHUNK_SIZE = CHUNK_MATCHUPS     # match-ups per computed chunk
+CHECK_RTOL = 1e-6               # relative tolerance of measurand check against GN algorithm
+
+
+class HarmResidualProduct:
+    """
+    Class to compute the residual product of harmonisation match-up series in chunks of match-ups, from the match-up
+    data as read and the harmonisation output
+
+    Sample Code:
+
+    HData = HarmData(dataset_paths, parameter_path)
+    HOut = HarmOutput(harm_output_path)
+    P = HarmResidualProduct(HData, HOut.parameter, HOut.parameter_covariance_matrix)
+    P.run(harm_res_paths)
+
+    :Attributes:
+        .. py:attribute:: HData
+
+            *harm_data_reader.HarmData*
+
+            Match-up data as read (i.e. not converted to independent variables)
+
+        .. py:attribute:: a
+
+            *numpy.ndarray*
+
+            Harmonised calibration parameters
+
+        .. py:attribute:: V
+
+            *numpy.ndarray*
+
+            Harmonised calibration parameter covariance matrix
+
+        .. py:attribute:: chunk_size
+
+            *int*
+
+            Match-ups per computed chunk
+
+    :Methods:
+        .. py:method:: run(...):
+
+            Append residual product to residual files of match-up series
+
+        .. py:method:: calc_chunk(...):
+
+            Return residual product variables for chunk of match-ups of match-up series
+
+        .. py:method:: calc_block_uncertainty(...):
+
+            Return covariate uncertainties for chunk of match-ups of data block
+
+        .. py:method:: series_paths(...):
+
+            Return residual file path of each match-up series
+    """
+
+    def __init__(self, HData, parameter, parameter_covariance_matrix, chunk_size=CHUNK_SIZE):
+        """
+        Initialise residual product object
+
+        :type HData: harm_data_reader.HarmData
+        :param HData: Match-up data as read (i.e. not converted to independent variables)
+
+        :type parameter: numpy.ndarray
+        :param parameter: Harmonised calibration parameters
+
+        :type parameter_covariance_matrix: numpy.ndarray
+        :param parameter_covariance_matrix: Harmonised calibration parameter covariance matrix
+
+        :type chunk_size: int
+        :param chunk_size: Match-ups per computed chunk
+        """
+
+        self.HData = HData
+        self.a = parameter
+        self.V = parameter_covariance_matrix
+        self.chunk_size = chunk_size
+
+        # data block of each (sensor, match-up series, covariate)
+        self.blocks = {}
+        for i, (n_sensor, n_mu, n_cov) in enumerate(zip(HData.idx['n_sensor'], HData.idx['n_mu'],
+                                                         HData.idx['n_cov'])):
+            self.blocks[(n_sensor, n_mu, n_cov)] = i
+
+    def run(self, harm_res_paths, complevel=COMPLEVEL, shuffle=SHUFFLE):
+        """
+        Append residual product to residual files of match-up series
+
+        :type harm_res_paths: list:str
+        :param harm_res_paths: Paths of harmonisation residual files
+
+        :type complevel: int
+        :param complevel: zlib compression level (0 for no compression)
+
+        :type shuffle: bool
+        :param shuffle: switch to apply HDF5 shuffle filter before compression
+        """
+
+        for i, path in enumerate(self.series_paths(harm_res_paths)):
+            if path is None:
+                print "No residual file for match-up series " + str(i + 1) + " - skipping"
+                continue
+
+            print "Writing residual product of " + os.path.basename(path) + "..."
+            append_residual_product(path, lambda istart, iend, H_res, k_res: self.calc_chunk(i, istart, iend, H_res,
+                                                                                             k_res),
+                                    chunk_matchups=self.chunk_size, complevel=complevel, shuffle=shuffle)
+
+    def series_paths(self, harm_res_paths):
+        """
+        Return residual file path of each match-up series, matched by the sensor names of the residual file attributes
+
+        :type harm_res_paths: list:str
+        :param harm_res_paths: Paths of harmonisation residual files
+
+        :return:
+            :paths: *list:str*
+
+            Residual file path per match-up series (None if series has no residual file)
+        """
+
+        paths_by_sensors = {}
+        for path in harm_res_paths:
+            rootgrp = Dataset(path)
+            paths_by_sensors[(int(rootgrp.sensor_i_name), int(rootgrp.sensor_j_name))] = path
+            rootgrp.close()
+
+        return [paths_by_sensors.get((int(lm[0]), int(lm[1]))) for lm in self.HData.idx['lm']]
+
+    def calc_block_uncertainty(self, n_sensor, n_mu, n_cov, istart, iend):
+        """
+        Return covariate uncertainties for chunk of match-ups of data block
+
+        :type n_sensor: int
+        :param n_sensor: sensor number
+
+        :type n_mu: int
+        :param n_mu: match-up series number
+
+        :type n_cov: int
+        :param n_cov: covariate number
+
+        :type istart: int
+        :param istart: index of first match-up of chunk in match-up series
+
+        :type iend: int
+        :param iend: index after last match-up of chunk in match-up series
+
+        :return:
+            :u: *numpy.ndarray*
+
+            Standard uncertainty of covariate per match-up of chunk
+        """
+
+        block_unc = self.HData.unc[self.blocks[(n_sensor, n_mu, n_cov)]]
+
+        if block_unc.form == "r":
+            return block_unc.uR[istart:iend]
+
+        if block_unc.form == "rs":
+            return (block_unc.uR[istart:iend]**2 + block_unc.uS**2)**0.5
+
+        if block_unc.form == "ave":
+            # W rows are scanline uncertainties weighted by the average, so the variance of an average is its row sum
+            W = block_unc.W[istart:iend]
+            return asarray(W.multiply(W).sum(axis=1)).ravel()**0.5
+
+    def calc_chunk(self, i, istart, iend, H_res, k_res):
+        """
+        Return residual product variables for chunk of match-ups of match-up series
+
+        :type i: int
+        :param i: match-up series index
+
+        :type istart: int
+        :param istart: index of first match-up of chunk in match-up series
+
+        :type iend: int
+        :param iend: index after last match-up of chunk in match-up series
+
+        :type H_res: numpy.ndarray
+        :param H_res: data residuals of chunk (None if not available, measurands then evaluated at the data)
+
+        :type k_res: numpy.ndarray
+        :param k_res: harmonisation residuals of chunk
+
+        :return:
+            :fields: *dict*
+
+            Residual product variable data of chunk by name (see harm_data_writer.RESIDUAL_PRODUCT_VARIABLES)
+        """
+
+        idx = self.HData.idx
+        m = idx['n_cov'][-1]                            # number of covariates per sensor
+        N_p = len(self.a) / (len(idx['sensors']) - 1)   # number of parameters per sensor
+        n_mu = i + 1
+        n_chunk = iend - istart
+
+        # best estimates of covariates of chunk
+        ib = idx['cNm'][i] + istart
+        ie = idx['cNm'][i] + iend
+        X = self.HData.values[ib:ie, :]
+        if H_res is not None:
+            X = X + H_res
+
+        fields = {}
+        u_l2 = zeros(n_chunk)   # sum of squares of uncertainties of measurand difference
+        Gs = []                 # adjustment weighted parameter derivatives of each sensor
+        ias = []                # parameter indices of each sensor
+        for j, (n_sensor, name) in enumerate(zip(idx['Im'][i], ("i", "j"))):
+
+            # First sensor or second sensor factor
+            s = -1
+            if j == 1:
+                s = 1
+
+            # > if reference sensor - measurand is first covariate
+            if n_sensor == 0:
+                R = X[:, j*m]
+                u_q = self.calc_block_uncertainty(n_sensor, n_mu, 1, istart, iend)
+                u_x = zeros(n_chunk)
+                JB = self.HData.adjustment_model(R)[1]
+
+            # > if sensor - evaluate sensor model
+            else:
+                ia = arange((n_sensor-1)*N_p, n_sensor*N_p)
+                # sensor model takes covariates covariate by covariate (as GNAlgo.unconvert_Xs)
+                R, J = self.HData.sensor_model(self.a[ia], X[:, j*m:(j+1)*m].T)
+                JX = J[:, :m]
+                Ja = J[:, m:]
+
+                # u_q**2 = sum_k (dR/dX_k u(X_k))**2
+                JU = JX * column_stack([self.calc_block_uncertainty(n_sensor, n_mu, k + 1, istart, iend)
+                                        for k in xrange(m)])
+                u_q = einsum('ij,ij->i', JU, JU)**0.5
+
+                # u_x**2 = Ja V Ja^T row-wise
+                u_x = calc_unc(Ja, self.V[ix_(ia, ia)])
+
+                JB = self.HData.adjustment_model(R)[1]
+                Gs.append(s * JB[:, None] * Ja)
+                ias.append(ia)
+
+            fields["measurand_" + name] = R
+            fields["measurand_" + name + "_uncertainty_q"] = u_q
+            fields["measurand_" + name + "_uncertainty_x"] = u_x
+
+            u_l2 += (JB * u_q)**2
+
+        # add parameter contribution, including covariance between the parameters of the two sensors
+        if Gs != []:
+            G = hstack(Gs)
+            ia = hstack(ias)
+            u_l2 += calc_quad_form(G, self.V[ix_(ia, ia)])
+
+        u_h = self.HData.unck[i].uR[istart:iend]
+
+        fields["k_res_uncertainty_l"] = u_l2**0.5
+        fields["k_res_uncertainty_h"] = u_h
+        fields["k_res_normalised"] = k_res / (u_l2 + u_h**2)**0.5
+
+        # match-up times back to seconds since 1/1/1970 (inverse of HarmData.seconds2date)
+        fields["t"] = asarray([mktime(date.timetuple()) + date.microsecond / 1e6
+                               for date in self.HData.times[ib:ie]])
+
+        return fields
+
+
+def check_measurands(HData, parameter, chunk_size=CHUNK_SIZE):
+    """
+    Return largest relative difference between the measurands of the residual product and the measurands evaluated by
+    the GN algorithm (GNAlgo.calc_R) from the converted match-up data, over all match-up series
+
+    :type HData: harm_data_reader.HarmData
+    :param HData: Match-up data as read (i.e. not converted to independent variables, not modified)
+
+    :type parameter: numpy.ndarray
+    :param parameter: Calibration parameters to evaluate measurands at
+
+    :type chunk_size: int
+    :param chunk_size: Match-ups per computed chunk
+
+    :return:
+        :rdiff: *float*
+
+        Largest relative difference of measurands
+    """
+
+    P = HarmResidualProduct(HData, parameter, zeros((len(parameter), len(parameter))), chunk_size=chunk_size)
+
+    HData_con = ConvertData().convert2ind(deepcopy(HData))
+    xyza = append(HData_con.values, parameter)
+    GN = GNAlgo()
+
+    rdiff = 0.0
+    for i, n_sensors in enumerate(HData.idx['Im']):
+        n_matchups = HData.idx['cNm'][i+1] - HData.idx['cNm'][i]
+
+        for istart in xrange(0, n_matchups, chunk_size):
+            iend = min(istart + chunk_size, n_matchups)
+            fields = P.calc_chunk(i, istart, iend, None, zeros(iend - istart))
+
+            for n_sensor, name in zip(n_sensors, ("i", "j")):
+                R_GN = GN.calc_R(xyza, HData_con.unc, HData_con.idx, HData_con.sensor_model, n_sensor, i + 1)[0]
+                R_GN = R_GN[istart:iend]
+                diff = absolute(fields["measurand_" + name] - R_GN) / maximum(absolute(R_GN), 1e-12)
+                rdiff = max(rdiff, amax(diff))
+
+    return rdiff
+
+if __name__ == "__main__":
+
+    def main():
+
+        ################################################################################################################
+        # Process configuration data
+        ################################################################################################################
+
+        # 1. Get configuration filenames
+        usage = "usage: %prog [options] job-cfg harmonisation-output-dir"
+        parser = OptionParser(usage=usage)
+        parser.add_option("--chunk-size", type="int", dest="chunk_size", default=CHUNK_SIZE,
+                          help="match-ups per computed chunk (default " + str(CHUNK_SIZE) + ")")
+        parser.add_option("--check", action="store_true", dest="check", default=False,
+                          help="check measurands against GN algorithm on synthetic match-up data and exit")
+        (options, args) = parser.parse_args()
+
+        if options.check:
+            from harm_benchmark import generate_synthetic_data
+
+            HData, a_true = generate_synthetic_data(n_sensors=2, n_matchups=50)
+            rdiff = check_measurands(HData, HData.a, chunk_size=16)
+            print "Largest relative measurand difference to GN algorithm: " + str(rdiff)
+
+            if rdiff > CHECK_RTOL:
+                print "Check failed"
+                return 1
+            print "Check passed"
+            return 0
+
+        if len(args) != 2:
+            parser.error("Incorrect number of input arguments")
+
+        job_cfg_fname = os.path.abspath(args[0])
+        output_dir = os.path.abspath(args[1])
+
+        # 2. Read job config file
+        job_id, matchup_dataset, dataset_dir, parameter_path, job_output_dir, \
+            sensor_functions_path, data_reader_path, job_text = read_job_cfg(job_cfg_fname)
+
+        # 3. Get matchup data and harmonisation output paths
+        dataset_paths = get_dataset_paths(dataset_dir)
+        harm_output_path, harm_res_paths = get_harm_paths(output_dir)
+
+        # 4. Import required specified functions
+        sensor_functions = import_file(sensor_functions_path)
+        harm_data_reader = import_file(data_reader_path)
+
+        ################################################################################################################
+        # Compute residual product
+        ################################################################################################################
+
+        print "Opening Data..."
+        HData = harm_data_reader.HarmData(dataset_paths, parameter_path,
+                                          sensor_model=sensor_functions.sensor_model,
+                                          adjustment_model=sensor_functions.adjustment_model)
+        HOut = HarmOutput(harm_output_path)
+
+        P = HarmResidualProduct(HData, HOut.parameter, HOut.parameter_covariance_matrix,
+                                chunk_size=options.chunk_size)
+        P.run(harm_res_paths)
+
+        print "Residual product complete"
+
+        return 0
+
+    exit(main())
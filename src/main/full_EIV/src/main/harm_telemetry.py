@@ -0,0 +1,262 @@
+"""
+Per-stage timing and solver telemetry for harmonisation runs
+
+Created on Tue Oct 13  2026 10:00:00
+"""
+
+'''___Python Modules___'''
+import os
+import json
+import csv
+from time import time
+from contextlib import contextmanager
+from resource import getrusage, RUSAGE_SELF
+
+'''___Constants___'''
+
+# Columns of stage table in csv run report
+CSV_FIELDS = ["stage", "niter", "start", "wall", "cpu", "rss_start_kb", "rss_end_kb", "rss_delta_kb",
+              "process_peak_rss_kb"]
+
+# Current resident set size source (Linux), pages of resident set are second field
+STATM_PATH = "/proc/self/statm"
+
+
+class HarmTelemetry:
+    """
+    Class to record wall and CPU time and resident set size per stage of a harmonisation run, along with counters of
+    solver operations (e.g. matrix-vector products, sensor model calls, LSMR/MINRES iterations), and write them to a
+    machine-readable run report.
+
+    The resident set size of a stage is sampled at its start and end (None where /proc/self/statm is unavailable),
+    the change between them being the memory the stage leaves allocated. The process peak resident set size
+    (ru_maxrss) is also recorded at the end of each stage, but as a peak over the process lifetime it only describes
+    the stage if the process peak was reached within it.
+
+    Sample Code:
+
+    .. code-block:: python
+
+        T = HarmTelemetry()
+
+        with T.stage("runPC"):
+            a_PC, S = PC.runPC()
+
+        T.count("matvec")
+
+        T.save("some/path/harm_telemetry")
+
+    :Attributes:
+        .. py:attribute:: stages
+
+        *list:dict*
+
+        Stage records, in order of completion, each with entries "stage", "niter", "start", "wall", "cpu",
+        "rss_start_kb", "rss_end_kb", "rss_delta_kb" and "process_peak_rss_kb"
+
+        .. py:attribute:: counters
+
+        *dict*
+
+        Counts of solver operations
+
+        .. py:attribute:: info
+
+        *dict*
+
+        Run metadata to include in report (e.g. software version, job id)
+
+    :Methods:
+        .. py:method:: stage(...):
+
+            Context manager to time a stage of the run
+
+        .. py:method:: start(...):
+
+            Start timing a stage of the run
+
+        .. py:method:: stop(...):
+
+            Stop timing a stage of the run and store its record
+
+        .. py:method:: count(...):
+
+            Increment counter
+
+        .. py:method:: summary(...):
+
+            Return total wall and CPU time per stage name
+
+        .. py:method:: save(...):
+
+            Write run report to JSON and CSV files
+    """
+
+    def __init__(self, **info):
+        """
+        Initialise telemetry object
+
+        :param info: Run metadata to include in report
+        """
+
+        self.stages = []
+        self.counters = {}
+        self.info = info
+        self.t0 = time()
+
+    @contextmanager
+    def stage(self, name, niter=None):
+        """
+        Context manager to time a stage of the run, stages may be nested
+
+        :type name: str
+        :param name: Stage name
+
+        :type niter: int
+        :param niter: (optional) iteration number, for stages repeated per iteration
+        """
+
+        record = self.start(name, niter)
+
+        try:
+            yield
+        finally:
+            self.stop(record)
+
+    def start(self, name, niter=None):
+        """
+        Start timing a stage of the run, for stages not conveniently wrapped by a with statement
+
+        :type name: str
+        :param name: Stage name
+
+        :type niter: int
+        :param niter: (optional) iteration number, for stages repeated per iteration
+
+        :return:
+            :record: *dict*
+
+            Stage record, to pass to stop()
+        """
+
+        return {"stage": name, "niter": niter, "start": time() - self.t0, "cpu": self._cpu(),
+                "rss_start_kb": self._rss()}
+
+    def stop(self, record):
+        """
+        Stop timing a stage of the run and store its record
+
+        :type record: dict
+        :param record: Stage record, as returned by start()
+        """
+
+        record["wall"] = time() - self.t0 - record["start"]
+        record["cpu"] = self._cpu() - record["cpu"]
+        record["rss_end_kb"] = self._rss()
+        record["rss_delta_kb"] = None
+        if (record["rss_start_kb"] is not None) and (record["rss_end_kb"] is not None):
+            record["rss_delta_kb"] = record["rss_end_kb"] - record["rss_start_kb"]
+        record["process_peak_rss_kb"] = getrusage(RUSAGE_SELF).ru_maxrss
+        self.stages.append(record)
+
+    def count(self, name, n=1):
+        """
+        Increment counter
+
+        :type name: str
+        :param name: Counter name
+
+        :type n: int
+        :param n: Increment (default 1)
+        """
+
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        Return total wall and CPU time per stage name, with largest resident set size and change in resident set size
+
+        :return:
+            :summary: *dict*
+
+            Dictionary with entry per stage name of dictionary with entries "calls", "wall", "cpu", "max_rss_kb",
+            "max_rss_delta_kb" and "process_peak_rss_kb"
+        """
+
+        summary = {}
+        for record in self.stages:
+            s = summary.setdefault(record["stage"], {"calls": 0, "wall": 0.0, "cpu": 0.0, "max_rss_kb": None,
+                                                     "max_rss_delta_kb": None, "process_peak_rss_kb": 0})
+            s["calls"] += 1
+            s["wall"] += record["wall"]
+            s["cpu"] += record["cpu"]
+            for name, value in (("max_rss_kb", record["rss_end_kb"]), ("max_rss_delta_kb", record["rss_delta_kb"])):
+                if value is not None:
+                    s[name] = value if s[name] is None else max(s[name], value)
+            s["process_peak_rss_kb"] = max(s["process_peak_rss_kb"], record["process_peak_rss_kb"])
+
+        return summary
+
+    def save(self, path):
+        """
+        Write run report to JSON file (path + ".json") of metadata, counters, per stage summary and stage records, and
+        CSV file (path + ".csv") of stage records
+
+        :type path: str
+        :param path: Path of report files, without extension
+        """
+
+        report = {"info": self.info,
+                  "wall": time() - self.t0,
+                  "cpu": self._cpu(),
+                  "process_peak_rss_kb": getrusage(RUSAGE_SELF).ru_maxrss,
+                  "counters": self.counters,
+                  "summary": self.summary(),
+                  "stages": self.stages}
+
+        with open(path + ".json", "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        with open(path + ".csv", "wb") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for record in self.stages:
+                writer.writerow(record)
+
+    def _cpu(self):
+        """
+        Return CPU time (user + system) of process
+
+        :return:
+            :cpu: *float*
+
+            CPU time in seconds
+        """
+
+        t = os.times()
+        return t[0] + t[1]
+
+    def _rss(self):
+        """
+        Return current resident set size of process
+
+        :return:
+            :rss: *int*
+
+            Resident set size in kB (None if unavailable)
+        """
+
+        try:
+            with open(STATM_PATH) as f:
+                pages = int(f.read().split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024
+
+if __name__ == "__main__":
+
+    def main():
+        return 0
+
+    main()
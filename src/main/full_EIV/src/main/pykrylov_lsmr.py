@@ -21,9 +21,10 @@ __docformat__ = 'restructuredtext'
 
 from pykrylov_generic import KrylovMethod
 
-from numpy import zeros, dot
-from numpy.linalg import norm
+from numpy import zeros, dot, concatenate, column_stack
+from numpy.linalg import norm, lstsq
 from math import sqrt
+from scipy.sparse.linalg import LinearOperator
 
 class LSMRFramework(KrylovMethod):
 
@@ -62,7 +63,63 @@ class LSMRFramework(KrylovMethod):
 
 
     def solve(self, b, damp=0.0, atol=1e-9, btol=1e-9, conlim=1e8,
-              M=None, N=None, itnlim=None, show=False, **kwargs):
+              M=None, N=None, itnlim=None, show=False, x0=None, Z=None,
+              **kwargs):
+        """
+        Iterative solver for least-squares problems, optionally warm started.
+
+        Solves the same problem as `_solve` (see below for a description of
+        the parameters and return values), with the additional parameters:
+
+            :x0: (n,) ndarray
+                Initial guess, e.g. the solution of a previous, closely
+                related, problem. lsmr is run on the correction to x0.
+            :Z: (n,k) ndarray
+                Basis of a small recycled subspace, e.g. the solutions of
+                previous, closely related, problems. The initial guess is
+                augmented by the least-squares solution over x0 + span(Z),
+                at the cost of k products with A.
+
+        If damp > 0 and a warm start is used, the damped problem is solved as
+        the equivalent undamped problem with the stacked operator [A; damp*I],
+        so the damping still applies to x (not to the correction to x0).
+        """
+
+        if (x0 is None) and (Z is None):
+            return self._solve(self.A, b, damp=damp, atol=atol, btol=btol,
+                               conlim=conlim, M=M, N=N, itnlim=itnlim,
+                               show=show, **kwargs)
+
+        A = self.A
+        b = b.squeeze()
+        m, n = A.shape
+
+        if damp > 0:
+            A = damped_operator(A, damp)
+            b = concatenate((b, zeros(n)))
+
+        if x0 is None:
+            x0 = zeros(n)
+
+        # Augment initial guess with least-squares solution over span(Z)
+        if Z is not None:
+            r0 = b - A * x0
+            AZ = column_stack([A * Z[:, j] for j in xrange(Z.shape[1])])
+            c = lstsq(AZ, r0)[0]
+            x0 = x0 + dot(Z, c)
+
+        # Solve for correction to initial guess
+        r0 = b - A * x0
+        result = self._solve(A, r0, damp=0.0, atol=atol, btol=btol,
+                             conlim=conlim, M=M, N=N, itnlim=itnlim,
+                             show=show, **kwargs)
+
+        x = x0 + result[0]
+        self.x = x
+        return (x,) + result[1:]
+
+    def _solve(self, A, b, damp=0.0, atol=1e-9, btol=1e-9, conlim=1e8,
+               M=None, N=None, itnlim=None, show=False, **kwargs):
         """
         Iterative solver for least-squares problems.
 
@@ -177,7 +234,6 @@ class LSMRFramework(KrylovMethod):
         self.dir_errors_window = []  # Direct error estimates.
         self.iterates = []
 
-        A = self.A
         b = b.squeeze()
         msg = self.msg
 
@@ -285,6 +341,7 @@ class LSMRFramework(KrylovMethod):
         if normar == 0:
             if show:
                 print msg[0]
+            self.x = x
             return x, istop, itn, normr, normar, normA, condA, normx
 
         if show:
@@ -494,6 +551,25 @@ class LSMRFramework(KrylovMethod):
         return x, istop, itn, normr, normar, normA, condA, normx
 
 
+def damped_operator(A, damp):
+    """
+    Return the operator [A; damp*I], such that the damped least-squares
+    problem min ||b - Ax||^2 + damp^2 ||x||^2 is the undamped problem
+    min ||[b; 0] - [A; damp*I] x||^2.
+    """
+
+    m, n = A.shape
+
+    def matvec(x):
+        return concatenate((A * x, damp * x))
+
+    def rmatvec(y):
+        return A.H * y[:m] + damp * y[m:]
+
+    return LinearOperator((m + n, n), matvec=matvec, rmatvec=rmatvec,
+                          dtype=float)
+
+
 def sign(a):
     if a < 0: return -1
     return 1
@@ -8,7 +8,7 @@ Functions specific to describe the particular instrument
 """
 
 '''___Python Modules___'''
-from numpy import vstack, ones, dot, column_stack
+from numpy import vstack, ones, dot, column_stack, asarray
 
 
 def sensor_model(a, X):
@@ -16,7 +16,8 @@ def sensor_model(a, X):
     Function to return Radiances and Derivative for input calibration parameters and covariates
 
     :param a: numpy.ndarray, dtype=float
-        array of sensor calibration parameters
+        array of sensor calibration parameters, or 2D array of calibration parameters per match-up (one column per
+        match-up, e.g. to evaluate several parameter estimates in one call, see GNAlgo.calc_f_batch)
     :param X: list: numpy.ndarray
         list of covariate data values in arrays
 
@@ -37,7 +38,10 @@ def sensor_model(a, X):
     # Evaluate radiance using sensor model
     Ja = vstack((ones(m), Rict * (Cs - Ce) / (Cs - Cict), (Cict - Ce) * (Cs - Ce))).T
     at = [a[0], 0.98514 + a[1], a[2]]
-    R = dot(Ja, at)
+    if asarray(a).ndim == 1:
+        R = dot(Ja, at)
+    else:
+        R = (Ja * asarray(at).T).sum(axis=1)
 
     # Evaluate derivatives
     # In the following order:
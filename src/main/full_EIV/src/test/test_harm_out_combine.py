@@ -0,0 +1,149 @@
+"""
+Smoke test of combining MC trial outputs (see harm_out_combine.HarmOutputCombine)
+
+Run from this directory with:
+
+python -m unittest test_harm_out_combine
+"""
+
+'''___Python Modules___'''
+import sys
+import os
+from os.path import join as pjoin
+from os.path import dirname, abspath
+import unittest
+import tempfile
+import shutil
+from numpy import array, eye, allclose, mean, std, cov
+from numpy.random import RandomState
+from netCDF4 import Dataset
+
+'''___Harmonisation Modules___'''
+sys.path.insert(0, pjoin(dirname(dirname(abspath(__file__))), "main"))
+from harm_data_writer import HarmOutput, HarmResiduals
+from harm_out_combine import HarmOutputCombine, get_trial_paths, STATS_NAME
+from harm_mc_stats import MCStats
+
+'''___Constants___'''
+
+N_TRIALS = 4
+LM = array([[1, 2, 30], [2, 3, 20]])
+N_PARAMETER = 6
+N_COL = 3
+
+
+def write_output(directory, seed, res=True):
+    """
+    Write harmonisation output and residual files of random values, as a harmonisation run
+
+    :type directory: str
+    :param directory: directory to write files to
+
+    :type seed: int
+    :param seed: seed of random values
+
+    :type res: bool
+    :param res: switch to write residual files
+
+    :return:
+        :HOut: *harm_data_writer.HarmOutput*
+
+        Written harmonisation output
+    """
+
+    os.makedirs(directory)
+    rs = RandomState(seed)
+    n_mu = LM[:, 2].sum()
+
+    HOut = HarmOutput()
+    HOut.parameter = rs.normal(size=N_PARAMETER)
+    HOut.parameter_sensors = array([1, 1, 2, 2, 3, 3])
+    HOut.parameter_covariance_matrix = eye(N_PARAMETER)
+    HOut.cost = 1.0
+    HOut.cost_dof = 1.0
+    HOut.cost_p_value = 0.5
+    HOut.lm = LM
+    HOut.k_res = rs.normal(size=n_mu)
+    HOut.H_res = rs.normal(size=(n_mu, N_COL))
+    HOut.software = "EV"
+    HOut.software_version = "0.0"
+    HOut.software_tag = "TTTTTTT"
+    HOut.job_id = "TEST"
+    HOut.matchup_dataset = "AVHRR_SIM_3_ALL"
+    HOut.processes = 1
+    HOut.save(directory, res=res)
+
+    return HOut
+
+
+class TestHarmOutputCombine(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_dir = pjoin(self.temp_dir, "output")
+
+        self.best_estimate = write_output(self.output_dir, 0)
+        self.trials = [write_output(pjoin(self.output_dir, "mc", "{0:03d}".format(i)), i + 1)
+                       for i in xrange(N_TRIALS)]
+
+        # failed trial, without output files
+        os.makedirs(pjoin(self.output_dir, "mc", "{0:03d}".format(N_TRIALS)))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def combine(self):
+        HarmOutputCombine(self.output_dir, attributes={"mc_precision": 0.1}).run(processes=2)
+        return get_trial_paths(pjoin(self.output_dir, "mc", "combine"))
+
+    def test_run(self):
+        harm_out_path, harm_res_paths = self.combine()
+
+        # parameter statistics
+        a = array([HOut.parameter for HOut in self.trials])
+        parameter, _, parameter_covariance_matrix, _, _, _, software, _, _, _, _ = \
+            HarmOutput().open_harmonisation_output_file(harm_out_path)
+        self.assertEqual(software, "EM")
+        self.assertTrue(allclose(parameter, self.best_estimate.parameter))
+        self.assertTrue(allclose(parameter_covariance_matrix, cov(a.T)))
+
+        rootgrp = Dataset(harm_out_path, "r")
+        self.assertTrue(allclose(rootgrp.parameter_trial_mean, mean(a, axis=0)))
+        self.assertTrue(allclose(rootgrp.parameter_trial_std, std(a, axis=0)))
+        self.assertEqual(rootgrp.mc_trials, N_TRIALS)
+        self.assertEqual(rootgrp.mc_precision, 0.1)
+        rootgrp.close()
+
+        # best estimate residuals normalised by trial standard deviation
+        k_res = array([HOut.k_res for HOut in self.trials])
+        H_res = array([HOut.H_res for HOut in self.trials])
+        with HarmResiduals(harm_res_paths) as HRes:
+            self.assertTrue((HRes.lm == LM).all())
+            k_res_combined, H_res_combined = HRes.materialise()
+
+        self.assertTrue(allclose(k_res_combined, self.best_estimate.k_res / std(k_res, axis=0, ddof=1)))
+        self.assertTrue(allclose(H_res_combined, self.best_estimate.H_res / std(H_res, axis=0, ddof=1)))
+
+    def test_run_added_trial(self):
+        self.combine()
+        self.trials.append(write_output(pjoin(self.output_dir, "mc", "{0:03d}".format(N_TRIALS + 1)), 100))
+        harm_out_path, _ = self.combine()
+
+        stats = MCStats.load(pjoin(self.output_dir, "mc", "combine", STATS_NAME))
+        self.assertEqual(stats.n, N_TRIALS + 1)
+        a = array([HOut.parameter for HOut in self.trials])
+        self.assertTrue(allclose(HarmOutput().open_harmonisation_output_file(harm_out_path)[2], cov(a.T)))
+
+    def test_run_without_residuals(self):
+        self.output_dir = pjoin(self.temp_dir, "output_no_res")
+        self.best_estimate = write_output(self.output_dir, 0, res=False)
+        self.trials = [write_output(pjoin(self.output_dir, "mc", str(i)), i + 1, res=False) for i in xrange(N_TRIALS)]
+
+        harm_out_path, harm_res_paths = self.combine()
+        self.assertEqual(harm_res_paths, [])
+        a = array([HOut.parameter for HOut in self.trials])
+        self.assertTrue(allclose(HarmOutput().open_harmonisation_output_file(harm_out_path)[2], cov(a.T)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,32 +10,61 @@ from harm_data_writer import HarmOutput
 from plotting_functions import *
 from radiance_functions import *
 from config_functions import *
+from sampling_functions import stratified_sample
 
 '''___Python Modules___'''
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
-from numpy import append, arange, ones, where, savetxt, loadtxt
+from numpy import append, arange, ones, where, savetxt, loadtxt, isnan, amin, amax, cumsum, searchsorted, concatenate, \
+    full, nan
+from netCDF4 import Dataset
 from sys import argv
 from os.path import join as pjoin
 from os.path import abspath, split, join
 from os import mkdir
 from datetime import datetime
 from numpy.random import rand
+from hashlib import md5
+from inspect import getsourcefile
+import cPickle
+import os
+from multiprocessing import Pool, cpu_count
 
 '''__Constants___'''
 
-# Number of samples to include in all match-up scatter plots (-1 => plot all match-up data
+# Number of samples to include in all match-up scatter plots (-1 => plot all match-up data), drawn without replacement
+# stratified per match-up series
 N_SAMPLE = 10000
 
+# Seed of match-up sample, so the same match-ups are sampled by each run (e.g. to compare software versions)
+SAMPLE_SEED = 0
+
 # Number of sample to include in simulated data plots
 N_SIM = 20
 
+# Number of bins per axis of 2d histograms
+HIST_BINS = 50
+
+# Maximum number of figures rendered concurrently (one per render worker process), to bound memory
+MAX_FIGURES = 8
+
+# Number of figures rendered by each render worker process before it is replaced, releasing its memory
+RENDER_TASKS_PER_CHILD = 10
+
+# Directory of computed diagnostics cache, within plot output directory
+CACHE_DIR = "cache"
+
+# Files up to this size (bytes) are hashed by content, larger files (e.g. match-up files) by name, size and
+# modification time
+HASH_MAX_SIZE = 64 * 1024**2
+
 
 class HarmDiag:
 
     def __init__(self, dataset_paths=None, parameter_path=None, harm_output_path=None, harm_res_paths=None,
-                 output_dir=None, sensor_model=None, adjustment_model=None, software_cfg=None, data_reader=None):
+                 output_dir=None, sensor_model=None, adjustment_model=None, software_cfg=None, data_reader=None,
+                 hist_ranges=None, use_cache=True, render_processes=None, sample_seed=SAMPLE_SEED):
         """
         Initialise harmonisation algorithm
 
@@ -66,6 +95,22 @@ class HarmDiag:
 
         :param data_reader: Class
             Python class to open harmonisation data. If none given default data reader used.
+
+        :param hist_ranges: dict
+            (optional) configured bin ranges of 2d histograms, as ([x_min, x_max], [y_min, y_max]) by histogram name
+            (e.g. "r_res_vs_r", see plot file names), either range may be None. Residual axes not configured are
+            ranged by a min/max pass over the residual files, other axes are ranged from the data as accumulated.
+
+        :param use_cache: bool
+            switch to reuse computed diagnostics cached in the output directory by previous runs with the same inputs
+            and outputs, and cache newly computed diagnostics (see cache_key)
+
+        :param render_processes: int
+            number of worker processes rendering plots (default number of CPUs, at most MAX_FIGURES, 1 to render in
+            this process)
+
+        :param sample_seed: int
+            seed of sample of match-ups in scatter plots (None for a different sample each run)
         """
 
         # Set required paths
@@ -74,6 +119,10 @@ class HarmDiag:
         self.harm_output_path = harm_output_path
         self.harm_res_paths = harm_res_paths
         self.outDir = output_dir
+        self.hist_ranges = hist_ranges if hist_ranges is not None else {}
+        self.use_cache = use_cache
+        self.render_processes = render_processes
+        self.sample_seed = sample_seed
 
         # Software info (currently unused)
         self.software_cfg = software_cfg
@@ -94,137 +143,50 @@ class HarmDiag:
         Generate the diagnostic plots
         """
 
-        # Initialise
-
-        # 1. Directories
-        dataset_paths = self.dataset_paths
-        parameter_path = self.parameter_path
-        harm_output_path = self.harm_output_path
-        harm_res_paths = self.harm_res_paths
-
-        # 2. Functions
-        sensor_model = self.sensor_model
-        adjustment_model = self.adjustment_model
-
         ################################################################################################################
         # 1. Open Data
         ################################################################################################################
 
         print("Opening Data...")
 
-        # Open output harmonisation data
-        HOut = HarmOutput(harm_output_path, harm_res_paths)
+        # Open output harmonisation data (residuals read match-up series by match-up series below)
+        HOut = HarmOutput(self.harm_output_path)
         HOut.software_fullname = "_".join((HOut.software, HOut.software_version, HOut.software_tag, HOut.job_id))
 
         ################################################################################################################
         # 2. Calculate residuals
         ################################################################################################################
 
-        # Open data match-up data match-up by match-up
-        print("Calculating Residuals...")
-
-        nodata = True
-
-        r_sim = {}
-        r_res_sim = {}
-        r_res_sim_err = {}
-
-        # Have to open all input parameters separately, as opening HData one file at a time
-
-        # Make dummy a for individual file opening
-        a_temp = ones(3)
-        temp_parameter_path = join(split(parameter_path)[0], "a_temp.csv")
-        savetxt(temp_parameter_path, a_temp, delimiter=",")
-
-        # Open all a
-        a = loadtxt(parameter_path, delimiter=',')
-        n_s = a.shape[0]
-        n_a = a.shape[1]
-        a = a.flatten()
-        Ia = zeros(a.shape[0])
-        i_next = 0
-
-        # Last times per sensor
-        last_times_s = asarray([datetime.utcfromtimestamp(0) for i in range(n_s)], dtype=datetime)
-        sensor_IDs = zeros(n_s)
-        i_nextID = 0
-
-
-        for dataset_path in dataset_paths:
-
-            with self.HarmData([dataset_path], temp_parameter_path, sensor_model, adjustment_model) as HData:
-
-                # Build Ia match-up by match-uo
-                for Im in HData.idx['lm']:
-                    for sensor in Im[:2]:
-                        if (sensor not in Ia) and (sensor != -1):
-                            Ia[i_next:i_next + n_a] = sensor
-                            i_next += n_a
-                # 1. All data
-
-                # Calculate radiance from data with input coefficients
-                temp_r = calc_R(HData, a=a, Ia=Ia, V=None)
-
-                # Calculate residual between this and radiance from data with
-                r_est = calc_R(HData, a=HOut.parameter, Ia=HOut.parameter_sensors, V=None)
-                temp_r_res = calc_R_res(temp_r, r_est, uR=None)
-
-                if nodata:
-                    times = HData.times
-                    last_times = array([HData.times[-1]])
-                    lm = HData.idx['lm']
-                    r = temp_r[:, :]
-                    r_res = temp_r_res[:, :]
-                    nodata = False
-
-                else:
-                    times = append(times, HData.times)
-                    last_times = append(last_times, HData.times[-1])
-                    lm = append(lm, HData.idx['lm'], axis=0)
-                    r = append(r, temp_r, axis=0)
-                    r_res = append(r_res, temp_r_res, axis=0)
-
-                # Get last times by sensor
-                for sensor_ID in HData.idx['lm'][0][:2]:
-                    if sensor_ID != -1:
-                        if sensor_ID not in sensor_IDs:
-                            sensor_IDs[i_nextID] = sensor_ID
-                            i_nextID += 1
-                        i_sensor = where(sensor_IDs == sensor_ID)[0][0]
-                        if last_times_s[i_sensor] < HData.times[-1]:
-                            last_times_s[i_sensor] = HData.times[-1]
-
-                # 2. Simulated data
-                # Calculate radiance residual between input parameters and harmonised parameters for simulated
-                # sampling of the data space
-                values_sim = sim_sensor_values(HData, n_sim=N_SIM)
-
-                for sensor in values_sim.keys():
-                    i_s_in = asarray([True if s == sensor else False for s in Ia])
-                    i_s_out = asarray([True if s == sensor else False for s in HOut.parameter_sensors])
-                    if sensor not in r_sim.keys():
-                        r_sim[sensor] = calc_R_sensor(values_sim[sensor], sensor_model=HData.sensor_model, a=a[i_s_in])
-                        r_sim_est, uR_sim = calc_R_sensor(values_sim[sensor], sensor_model=HData.sensor_model,
-                                                          a=HOut.parameter[i_s_out],
-                                                          V=HOut.parameter_covariance_matrix[outer(i_s_out, i_s_out)].
-                                                          reshape((sum(i_s_out), sum(i_s_out))))
-
-                        r_res_sim[sensor], r_res_sim_err[sensor] = calc_R_res(r_sim[sensor], r_sim_est, uR_sim)
-
-        # 3. Calculate per sensor and per match-up series statistics
-
-        # a. radiance residual, r_res, statistics
-        r_res_ave_s, r_res_sd_s = average_sensor(r_res, lm)   # per sensor
-        r_res_ave_m, r_res_sd_m = average_mu(r_res, lm)       # per match-up series
-
-        # b. match-up adjustment factor residual, k_res, statistics
-        k_res_ave_m, k_res_sd_m = average_mu(HOut.k_res, lm)  # per match-up series
-
-        # Select sample indices
-        if (N_SAMPLE == -1) or (N_SAMPLE > r_res.shape[0]):
-            i_sels = arange(sum(lm[:, 2]))
-        else:
-            i_sels = sort((sum(lm[:, 2]) * rand(N_SAMPLE)).astype(int))
+        # Computed diagnostics reused from cache if match-up data, parameters, harmonisation output and sensor
+        # functions unchanged, so re-plotting skips the numerical stage
+        cache_path = None
+        diag = None
+        if self.use_cache:
+            cache_path = pjoin(self.outDir, CACHE_DIR, "diag_" + self.cache_key() + ".pkl")
+            diag = read_diag_cache(cache_path)
+            if diag is not None:
+                print("Using cached diagnostics: " + cache_path)
+
+        if diag is None:
+            diag = self.calc_diagnostics(HOut)
+            if cache_path is not None:
+                write_diag_cache(cache_path, diag)
+
+        lm = diag["lm"]
+        last_times = diag["last_times"]
+        last_times_s = diag["last_times_s"]
+        r_res_ave_s = diag["r_res_ave_s"]
+        r_res_sd_s = diag["r_res_sd_s"]
+        r_res_ave_m = diag["r_res_ave_m"]
+        r_res_sd_m = diag["r_res_sd_m"]
+        k_res_ave_m = diag["k_res_ave_m"]
+        k_res_sd_m = diag["k_res_sd_m"]
+        hists = diag["hists"]
+        samples = diag["samples"]
+        data_res = diag["data_res"]
+        r_sim = diag["r_sim"]
+        r_res_sim = diag["r_res_sim"]
+        r_res_sim_err = diag["r_res_sim_err"]
 
         ################################################################################################################
         # 3. Make plots
@@ -236,7 +198,8 @@ class HarmDiag:
                        pjoin(self.outDir, "cov"),
                        pjoin(self.outDir, "res"),
                        pjoin(self.outDir, "series"),
-                       pjoin(self.outDir, "sensor")]
+                       pjoin(self.outDir, "sensor"),
+                       pjoin(self.outDir, "hist")]
 
         for directory in directories:
             try:
@@ -244,6 +207,10 @@ class HarmDiag:
             except OSError:
                 pass
 
+        # save accumulated histograms, to re-render without data (see plotting_functions.plot_hist2d)
+        for name, H in hists.items():
+            H.save(pjoin(self.outDir, "hist", name + ".npz"))
+
         # shared text box contents
         txt = ["Software Name: " + HOut.software_fullname, "Dataset: " + HOut.matchup_dataset]
 
@@ -274,61 +241,68 @@ class HarmDiag:
         r_res_ave_s = asarray([r_ave for last_time, r_ave in sorted(zip(last_times_s, r_res_ave_s), reverse=True)])
         r_res_sd_s = asarray([r_sd for last_time, r_sd in sorted(zip(last_times_s, r_res_sd_s), reverse=True)])
 
+        # Plots rendered as independent tasks over the computed diagnostics, in parallel (see render_plots)
+        tasks = []
+
+        def task(func, *args, **kwargs):
+            tasks.append((func, args, kwargs))
+
         # 1. Covariance Matrix Plot
-        plot_grid_heatmap(pjoin(self.outDir, "cov", "cov_heatmap.pdf"), HOut.parameter_covariance_matrix,
-                          title="Parameter Covariance Matrix",
-                          labels=albls, dividers=slbls)
+        task(plot_grid_heatmap, pjoin(self.outDir, "cov", "cov_heatmap.pdf"), HOut.parameter_covariance_matrix,
+             title="Parameter Covariance Matrix",
+             labels=albls, dividers=slbls)
 
         # 2. Plot variable residuals
         # a. radiance residual
         # i. space sampled data per sensor
-        for sensor in r_res_sim.keys():
-            plot_scatter(pjoin(self.outDir, "res", "r_res_vs_r_errbars_"+str(sensor)+".pdf"),
-                         r_res_sim[sensor], r_sim[sensor], yerr=r_res_sim_err[sensor],
-                         title="Sampled Radiance Residual - "+str(sensor), ylbl=ylbl_r_res, xlbl=xlbl_r, txt=txt, dash_ylines=[0])
+        for sensor in sorted(r_res_sim.keys()):
+            task(plot_scatter, pjoin(self.outDir, "res", "r_res_vs_r_errbars_"+str(sensor)+".pdf"),
+                 r_res_sim[sensor], r_sim[sensor], yerr=r_res_sim_err[sensor],
+                 title="Sampled Radiance Residual - "+str(sensor), ylbl=ylbl_r_res, xlbl=xlbl_r, txt=txt, dash_ylines=[0])
 
         # ii. all data
 
         title_r_res = "Radiance Residual, $\Delta R$"
-        plot_2dhist(pjoin(self.outDir, "res", "r_res_vs_r_2dhist.pdf"), r_res.flatten('F'), r.flatten('F'), bins=50,
-                    title=title_r_res, xlbl=xlbl_r, ylbl=ylbl_r_res, txt=txt, solid_ylines=[0])
-        plot_2dhist(pjoin(self.outDir, "res", "r_res_vs_time_2dhist.pdf"), r_res.flatten('F'), append(times, times), bins=50,
-                    title=title_r_res, xlbl=xlbl_t, ylbl=ylbl_r_res, txt=txt, solid_ylines=[0])
-        plot_scatter(pjoin(self.outDir, "res", "r_res_vs_r_scatter.png"), r_res[i_sels, :].flatten('F'), r[i_sels, :].flatten('F'),
-                     title=title_r_res+title_sample, ylbl=ylbl_r_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
-        plot_scatter(pjoin(self.outDir, "res", "r_res_vs_time_scatter.png"), r_res[i_sels, :].flatten('F'), append(times[i_sels], times[i_sels]),
-                     title=title_r_res+title_sample, ylbl=ylbl_r_res, xlbl=xlbl_t, txt=txt, solid_ylines=[0])
+        task(plot_hist2d, pjoin(self.outDir, "res", "r_res_vs_r_2dhist.pdf"), hists["r_res_vs_r"],
+             title=title_r_res, xlbl=xlbl_r, ylbl=ylbl_r_res, txt=txt, solid_ylines=[0])
+        task(plot_hist2d, pjoin(self.outDir, "res", "r_res_vs_time_2dhist.pdf"), hists["r_res_vs_time"],
+             title=title_r_res, xlbl=xlbl_t, ylbl=ylbl_r_res, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "res", "r_res_vs_r_scatter.png"), samples["r_res"].flatten('F'), samples["r"].flatten('F'),
+             title=title_r_res+title_sample, ylbl=ylbl_r_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "res", "r_res_vs_time_scatter.png"), samples["r_res"].flatten('F'), append(samples["times"], samples["times"]),
+             title=title_r_res+title_sample, ylbl=ylbl_r_res, xlbl=xlbl_t, txt=txt, solid_ylines=[0])
 
         # b. match-up adjustment factor residual
 
         title_k_res = "Match-up Adjustment Factor Residual, $\Delta K$"
-        plot_2dhist(pjoin(self.outDir, "res", "k_res_vs_r_2dhist.pdf"), HOut.k_res, r[:, 1], bins=50,
-                    title=title_k_res, xlbl=xlbl_r, ylbl=ylbl_k_res, txt=txt, solid_ylines=[0])
-        plot_2dhist(pjoin(self.outDir, "res", "k_res_vs_time_2dhist.pdf"), HOut.k_res, times, bins=50,
-                    title=title_k_res, xlbl=xlbl_r, ylbl=ylbl_k_res, txt=txt, solid_ylines=[0])
-        plot_scatter(pjoin(self.outDir, "res", "k_res_vs_r_scatter.png"), HOut.k_res[i_sels], r[i_sels, 1],
-                     title=title_k_res+title_sample, ylbl=ylbl_k_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
-        plot_scatter(pjoin(self.outDir, "res", "k_res_vs_time_scatter.png"), HOut.k_res[i_sels], times[i_sels],
-                     title=title_k_res+title_sample, ylbl=ylbl_k_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
+        task(plot_hist2d, pjoin(self.outDir, "res", "k_res_vs_r_2dhist.pdf"), hists["k_res_vs_r"],
+             title=title_k_res, xlbl=xlbl_r, ylbl=ylbl_k_res, txt=txt, solid_ylines=[0])
+        task(plot_hist2d, pjoin(self.outDir, "res", "k_res_vs_time_2dhist.pdf"), hists["k_res_vs_time"],
+             title=title_k_res, xlbl=xlbl_r, ylbl=ylbl_k_res, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "res", "k_res_vs_r_scatter.png"), samples["k_res"], samples["r"][:, 1],
+             title=title_k_res+title_sample, ylbl=ylbl_k_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "res", "k_res_vs_time_scatter.png"), samples["k_res"], samples["times"],
+             title=title_k_res+title_sample, ylbl=ylbl_k_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
 
         # c. variable residual (EIV only)
-        if HOut.H_res is not None:
-            m = HOut.H_res.shape[1]/2
+        if data_res:
+            H_res_sel = samples["H_res"]
+            m = H_res_sel.shape[1]/2
             for i in range(m):
                 title_xi_res = "$X_{"+str(i+1)+"}$ Residual, $\Delta X_{"+str(i+1)+"}$"
                 ylbl_xi_res = "$X_{"+str(i+1)+"}$ Residual, $\Delta X_{"+str(i+1)+"} = X_{"+str(i+1)+", EST} - X_{"+str(i+1)+", DATA}$"
-                plot_2dhist(pjoin(self.outDir, "res", "x"+str(i+1)+"_res_vs_r_2dhist.pdf"),
-                            append(HOut.H_res[:, i], HOut.H_res[:, i+m]), r.flatten('F'), bins=50,
-                            title=title_xi_res, xlbl=xlbl_r, ylbl=ylbl_xi_res, txt=txt, solid_ylines=[0])
-                plot_2dhist(pjoin(self.outDir, "res", "x"+str(i+1)+"_res_vs_time_2dhist.pdf"),
-                            append(HOut.H_res[:, i], HOut.H_res[:, i+m]), append(times, times), bins=50,
-                            title=title_xi_res, xlbl=xlbl_t, ylbl=ylbl_xi_res, txt=txt, solid_ylines=[0])
-                plot_scatter(pjoin(self.outDir, "res", "x"+str(i+1)+ "_res_vs_r_scatter.png"),
-                             append(HOut.H_res[i_sels, i], HOut.H_res[i_sels, i+m]), r[i_sels, :].flatten('F'),
-                             title=title_xi_res+title_sample, ylbl=ylbl_xi_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
-                plot_scatter(pjoin(self.outDir, "res", "x"+str(i+1)+"_res_vs_time_scatter.png"),
-                             append(HOut.H_res[i_sels, i], HOut.H_res[i_sels, i+m]), append(times[i_sels], times[i_sels]),
-                             title=title_xi_res+title_sample, ylbl=ylbl_xi_res, xlbl=xlbl_t, txt=txt, solid_ylines=[0])
+                task(plot_hist2d, pjoin(self.outDir, "res", "x"+str(i+1)+"_res_vs_r_2dhist.pdf"),
+                     hists["x"+str(i+1)+"_res_vs_r"],
+                     title=title_xi_res, xlbl=xlbl_r, ylbl=ylbl_xi_res, txt=txt, solid_ylines=[0])
+                task(plot_hist2d, pjoin(self.outDir, "res", "x"+str(i+1)+"_res_vs_time_2dhist.pdf"),
+                     hists["x"+str(i+1)+"_res_vs_time"],
+                     title=title_xi_res, xlbl=xlbl_t, ylbl=ylbl_xi_res, txt=txt, solid_ylines=[0])
+                task(plot_scatter, pjoin(self.outDir, "res", "x"+str(i+1)+ "_res_vs_r_scatter.png"),
+                     append(H_res_sel[:, i], H_res_sel[:, i+m]), samples["r"].flatten('F'),
+                     title=title_xi_res+title_sample, ylbl=ylbl_xi_res, xlbl=xlbl_r, txt=txt, solid_ylines=[0])
+                task(plot_scatter, pjoin(self.outDir, "res", "x"+str(i+1)+"_res_vs_time_scatter.png"),
+                     append(H_res_sel[:, i], H_res_sel[:, i+m]), append(samples["times"], samples["times"]),
+                     title=title_xi_res+title_sample, ylbl=ylbl_xi_res, xlbl=xlbl_t, txt=txt, solid_ylines=[0])
 
         # 3. Plot radiance residual distribution
         # Todo - Properly implement radiance residual distribution graph
@@ -336,20 +310,308 @@ class HarmDiag:
 
         # 4. Plot match-up series
         title_r_res_m = r"Average Radiance Residual, $\overline{\Delta R}$, per Match-up Series"
-        plot_scatter(pjoin(self.outDir, "series", "r_res_ave_vs_series_errbars.pdf"), r_res_ave_m, mlbls, yerr=r_res_sd_m,
-                     title=title_r_res_m, ylbl=ylbl_r_res, xlbl=xlbl_m, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "series", "r_res_ave_vs_series_errbars.pdf"), r_res_ave_m, mlbls, yerr=r_res_sd_m,
+             title=title_r_res_m, ylbl=ylbl_r_res, xlbl=xlbl_m, txt=txt, solid_ylines=[0])
 
         title_k_res_m = r"Average Match-Up Adjustment Factor Residual, $\overline{\Delta K}$, per Match-up Series"
-        plot_scatter(pjoin(self.outDir, "series", "k_res_ave_vs_series_errbars.pdf"), k_res_ave_m, mlbls, yerr=k_res_sd_m,
-                      title=title_k_res_m, ylbl=ylbl_k_res, xlbl=xlbl_m, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "series", "k_res_ave_vs_series_errbars.pdf"), k_res_ave_m, mlbls, yerr=k_res_sd_m,
+             title=title_k_res_m, ylbl=ylbl_k_res, xlbl=xlbl_m, txt=txt, solid_ylines=[0])
 
         # 5. Plot sensors
         title_r_res_s = r"Average Radiance Residual, $\overline{\Delta R}$, per Sensor"
-        plot_scatter(pjoin(self.outDir, "sensor", "r_res_ave_vs_sensor_errbars.pdf"), r_res_ave_s, slbls, yerr=r_res_sd_s,
-                     title=title_r_res_s, ylbl=ylbl_r_res, xlbl=xlbl_s, txt=txt, solid_ylines=[0])
+        task(plot_scatter, pjoin(self.outDir, "sensor", "r_res_ave_vs_sensor_errbars.pdf"), r_res_ave_s, slbls, yerr=r_res_sd_s,
+             title=title_r_res_s, ylbl=ylbl_r_res, xlbl=xlbl_s, txt=txt, solid_ylines=[0])
+
+        render_plots(tasks, processes=self.render_processes)
 
         return 0
 
+    def series_sizes(self, harm_res_paths):
+        """
+        Return number of match-ups of each match-up series, from harmonisation residual files
+
+        :param harm_res_paths: list:str
+            Paths of harmonisation residual files
+
+        :return:
+            :sizes: list:int
+                number of match-ups per match-up series
+        """
+
+        sizes = []
+        for harm_res_path in harm_res_paths:
+            rootgrp = Dataset(harm_res_path, "r")
+            sizes.append(rootgrp.variables['k_res'].shape[0])
+            rootgrp.close()
+
+        return sizes
+
+    def init_hists(self, harm_res_paths):
+        """
+        Return empty 2d histograms of diagnostic plots, with configured ranges or, for residual axes, ranges from a
+        min/max pass over the harmonisation residual files
+
+        :param harm_res_paths: list:str
+            Paths of harmonisation residual files
+
+        :return:
+            :hists: dict:plotting_functions.Hist2D
+                empty 2d histograms by name
+        """
+
+        # min/max pass over residual files - only residuals read, no radiances evaluated
+        res_names = ["k_res"]
+        res_ranges = {}
+        HOut = HarmOutput()
+        for harm_res_path in harm_res_paths:
+            _, k_res, H_res, _, _, _, _, _ = HOut.open_harmonisation_residual_files([harm_res_path])
+            columns = [("k_res", k_res)]
+            if H_res is not None:
+                m = H_res.shape[1]/2
+                columns += [("x"+str(i+1)+"_res", append(H_res[:, i], H_res[:, i+m])) for i in range(m)]
+
+            for name, values in columns:
+                if name not in res_names:
+                    res_names.append(name)
+
+                values = values[~isnan(values)]
+                if values.shape[0] > 0:
+                    v_min, v_max = amin(values), amax(values)
+                    if name in res_ranges:
+                        v_min = min(v_min, res_ranges[name][0])
+                        v_max = max(v_max, res_ranges[name][1])
+                    res_ranges[name] = [v_min, v_max]
+
+        names = ["r_res_vs_r", "r_res_vs_time"]
+        for res in res_names:
+            names += [res + "_vs_r", res + "_vs_time"]
+
+        hists = {}
+        for name in names:
+            x_range, y_range = self.hist_ranges.get(name, (None, None))
+            if (y_range is None) and (name.rsplit("_vs_", 1)[0] in res_ranges):
+                y_range = res_ranges[name.rsplit("_vs_", 1)[0]]
+                if y_range[0] == y_range[1]:
+                    y_range = None
+            hists[name] = Hist2D(bins=HIST_BINS, x_range=x_range, y_range=y_range)
+
+        return hists
+
+    def calc_diagnostics(self, HOut):
+        """
+        Return computed diagnostics - residual statistics, accumulated 2d histograms and sampled match-ups - of
+        harmonisation. Residual statistics omit nan residuals (see radiance_functions.Moments), whereas the mean and
+        standard deviation of average_sensor are nan if any residual of the sensor is nan.
+
+        :param HOut: harm_data_writer.HarmOutput
+            harmonisation output data (without residuals)
+
+        :return:
+            :diag: dict
+                computed diagnostics by name
+        """
+
+        # Initialise
+
+        # 1. Directories
+        dataset_paths = self.dataset_paths
+        parameter_path = self.parameter_path
+        harm_res_paths = self.harm_res_paths
+
+        # 2. Functions
+        sensor_model = self.sensor_model
+        adjustment_model = self.adjustment_model
+
+        # Open data match-up data match-up by match-up, accumulating only aggregated products of each chunk of data -
+        # per sensor/series moments, 2d histograms and a stratified sample of match-ups for scatter plots - so memory
+        # use is independent of the size of the dataset
+        print("Calculating Residuals...")
+
+        r_sim = {}
+        r_res_sim = {}
+        r_res_sim_err = {}
+
+        # Have to open all input parameters separately, as opening HData one file at a time
+
+        # Make dummy a for individual file opening
+        a_temp = ones(3)
+        temp_parameter_path = join(split(parameter_path)[0], "a_temp.csv")
+        savetxt(temp_parameter_path, a_temp, delimiter=",")
+
+        # Open all a
+        a = loadtxt(parameter_path, delimiter=',')
+        n_a = a.shape[1]
+        a = a.flatten()
+        Ia = zeros(a.shape[0])
+        i_next = 0
+
+        # Streamed accumulators
+        lm = []                         # match-up series description, row per series
+        last_times = []                 # last time per match-up series
+        sensors = []                    # sensors, in order of first appearance
+        last_times_s = {}               # last time per sensor
+        r_res_s = {}                    # radiance residual moments per sensor
+        r_res_m = []                    # radiance residual moments per match-up series
+        k_res_m = []                    # k residual moments per match-up series
+        hists = self.init_hists(harm_res_paths)     # 2d histograms by name
+        data_res = False
+
+        # Sample of match-ups for scatter plots, drawn in advance from the match-up series sizes
+        cNm = append(0, cumsum(self.series_sizes(harm_res_paths))).astype(int)
+        i_sels = stratified_sample(cNm, N_SAMPLE, seed=self.sample_seed)
+        sampled = []                    # sampled data per file
+        n_prev = 0                      # match-ups of previous files
+
+        for dataset_path in dataset_paths:
+
+            with self.HarmData([dataset_path], temp_parameter_path, sensor_model, adjustment_model) as HData:
+
+                # Build Ia match-up by match-uo
+                for Im in HData.idx['lm']:
+                    for sensor in Im[:2]:
+                        if (sensor not in Ia) and (sensor != -1):
+                            Ia[i_next:i_next + n_a] = sensor
+                            i_next += n_a
+                # 1. All data
+
+                # Calculate radiance from data with input coefficients
+                r = calc_R(HData, a=a, Ia=Ia, V=None)
+
+                # Calculate residual between this and radiance from data with
+                r_est = calc_R(HData, a=HOut.parameter, Ia=HOut.parameter_sensors, V=None)
+                r_res = calc_R_res(r, r_est, uR=None)
+
+                # Residuals of match-up series of file
+                k_res = zeros(r.shape[0])
+                H_res = None
+                for i, lm_i in enumerate(HData.idx['lm']):
+                    istart = HData.idx['cNm'][i]
+                    iend = HData.idx['cNm'][i+1]
+
+                    _, k_res_i, H_res_i, _, _, _, _, _ = \
+                        HOut.open_harmonisation_residual_files([harm_res_paths[len(lm)]])
+                    k_res[istart:iend] = k_res_i
+                    if H_res_i is not None:
+                        if H_res is None:
+                            H_res = zeros((r.shape[0], H_res_i.shape[1]))
+                        H_res[istart:iend, :] = H_res_i
+                        data_res = True
+
+                    # Per sensor and per match-up series statistics
+                    for j, sensor_ID in enumerate(lm_i[:2]):
+                        if sensor_ID != -1:
+                            if sensor_ID not in sensors:
+                                sensors.append(sensor_ID)
+                                last_times_s[sensor_ID] = HData.times[iend-1]
+                                r_res_s[sensor_ID] = Moments()
+                            if last_times_s[sensor_ID] < HData.times[iend-1]:
+                                last_times_s[sensor_ID] = HData.times[iend-1]
+                            r_res_s[sensor_ID].add(r_res[istart:iend, j])
+
+                    r_res_m.append(Moments())
+                    r_res_m[-1].add(r_res[istart:iend, :])
+                    k_res_m.append(Moments())
+                    k_res_m[-1].add(k_res[istart:iend])
+
+                    lm.append(lm_i)
+                    last_times.append(HData.times[iend-1])
+
+                # 2d histograms
+                times = HData.times
+                for name, X, Y in [("r_res_vs_r", r.flatten('F'), r_res.flatten('F')),
+                                   ("r_res_vs_time", append(times, times), r_res.flatten('F')),
+                                   ("k_res_vs_r", r[:, 1], k_res),
+                                   ("k_res_vs_time", times, k_res)]:
+                    hists[name].add(X, Y)
+
+                if H_res is not None:
+                    m = H_res.shape[1]/2
+                    for i in range(m):
+                        xi_res = append(H_res[:, i], H_res[:, i+m])
+                        hists["x"+str(i+1)+"_res_vs_r"].add(r.flatten('F'), xi_res)
+                        hists["x"+str(i+1)+"_res_vs_time"].add(append(times, times), xi_res)
+
+                # Sampled match-ups of file
+                i_file = i_sels[searchsorted(i_sels, n_prev):searchsorted(i_sels, n_prev + r.shape[0])] - n_prev
+                sampled.append({"r": r[i_file], "r_res": r_res[i_file], "times": times[i_file],
+                                "k_res": k_res[i_file]})
+                if H_res is not None:
+                    sampled[-1]["H_res"] = H_res[i_file]
+                n_prev += r.shape[0]
+
+                # 2. Simulated data
+                # Calculate radiance residual between input parameters and harmonised parameters for simulated
+                # sampling of the data space
+                values_sim = sim_sensor_values(HData, n_sim=N_SIM)
+
+                for sensor in values_sim.keys():
+                    i_s_in = asarray([True if s == sensor else False for s in Ia])
+                    i_s_out = asarray([True if s == sensor else False for s in HOut.parameter_sensors])
+                    if sensor not in r_sim.keys():
+                        r_sim[sensor] = calc_R_sensor(values_sim[sensor], sensor_model=HData.sensor_model, a=a[i_s_in])
+                        r_sim_est, uR_sim = calc_R_sensor(values_sim[sensor], sensor_model=HData.sensor_model,
+                                                          a=HOut.parameter[i_s_out],
+                                                          V=HOut.parameter_covariance_matrix[outer(i_s_out, i_s_out)].
+                                                          reshape((sum(i_s_out), sum(i_s_out))))
+
+                        r_res_sim[sensor], r_res_sim_err[sensor] = calc_R_res(r_sim[sensor], r_sim_est, uR_sim)
+
+        lm = asarray(lm)
+        last_times_s = [last_times_s[sensor] for sensor in sensors]
+
+        # 3. Per sensor and per match-up series statistics
+
+        # a. radiance residual, r_res, statistics
+        r_res_ave_s = asarray([r_res_s[sensor].average() for sensor in sensors])    # per sensor
+        r_res_sd_s = asarray([r_res_s[sensor].sd() for sensor in sensors])
+        r_res_ave_m = asarray([moments.average() for moments in r_res_m])          # per match-up series
+        r_res_sd_m = asarray([moments.sd() for moments in r_res_m])
+
+        # b. match-up adjustment factor residual, k_res, statistics
+        k_res_ave_m = asarray([moments.average() for moments in k_res_m])          # per match-up series
+        k_res_sd_m = asarray([moments.sd() for moments in k_res_m])
+
+        # Sampled match-ups
+        samples = {}
+        if sampled != []:
+            names = ["r", "r_res", "times", "k_res"]
+            samples = dict((name, concatenate([s[name] for s in sampled])) for name in names)
+
+            # (match-ups sampled from files without data residuals have nan data residuals)
+            if data_res:
+                n_col = [s["H_res"].shape[1] for s in sampled if "H_res" in s][0]
+                samples["H_res"] = concatenate([s.get("H_res", full((s["k_res"].shape[0], n_col), nan))
+                                                for s in sampled])
+
+        return {"lm": lm, "last_times": last_times, "last_times_s": last_times_s,
+                "r_res_ave_s": r_res_ave_s, "r_res_sd_s": r_res_sd_s, "r_res_ave_m": r_res_ave_m,
+                "r_res_sd_m": r_res_sd_m, "k_res_ave_m": k_res_ave_m, "k_res_sd_m": k_res_sd_m,
+                "hists": hists, "i_sels": i_sels, "samples": samples, "data_res": data_res,
+                "r_sim": r_sim, "r_res_sim": r_res_sim, "r_res_sim_err": r_res_sim_err}
+
+    def cache_key(self):
+        """
+        Return key of computed diagnostics, from the hashes of the match-up files, parameter file, harmonisation output
+        files and sensor function (and data reader) modules, and the diagnostic settings
+
+        :return:
+            :key: str
+                diagnostics cache key
+        """
+
+        paths = list(self.dataset_paths) + [self.parameter_path, self.harm_output_path] + list(self.harm_res_paths)
+        for func in (self.sensor_model, self.HarmData):
+            source = getsourcefile(func)
+            if source is not None:
+                paths.append(source)
+
+        key = md5()
+        for path in paths:
+            key.update(file_hash(path))
+        key.update(repr((N_SAMPLE, self.sample_seed, N_SIM, HIST_BINS, sorted(self.hist_ranges.items()))))
+
+        return key.hexdigest()
+
     def get_albls(self, parameter_sensor_names):
         """
         Return labels for each harmonisation parameter from input Ia array from HarmOutput object
@@ -436,6 +698,120 @@ class HarmDiag:
         return m_lbls
 
 
+def render_plot(task):
+    """
+    Render plot task
+
+    :param task: tuple
+        plot task, (plotting function, arguments, keyword arguments) - the first argument the path of the plot file
+
+    :return:
+        :path: str
+            path of plot file
+    """
+
+    func, args, kwargs = task
+    func(*args, **kwargs)
+
+    return args[0]
+
+
+def render_plots(tasks, processes=None):
+    """
+    Render independent plot tasks over a process pool with the Agg backend, each worker rendering one figure at a time
+
+    :param tasks: list:tuple
+        plot tasks, (plotting function, arguments, keyword arguments) - each writing to its own plot file path
+
+    :param processes: int
+        number of worker processes (default number of CPUs, at most MAX_FIGURES, 1 to render in this process)
+    """
+
+    if processes is None:
+        processes = min(cpu_count(), MAX_FIGURES)
+    processes = max(1, min(processes, len(tasks)))
+
+    if processes == 1:
+        for task in tasks:
+            render_plot(task)
+        return
+
+    pool = Pool(processes=processes, maxtasksperchild=RENDER_TASKS_PER_CHILD)
+    try:
+        for path in pool.imap_unordered(render_plot, tasks):
+            pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def file_hash(path):
+    """
+    Return hash of file, of its content if smaller than HASH_MAX_SIZE, else of its name, size and modification time
+
+    :param path: str
+        file path
+
+    :return:
+        :hash: str
+            file hash
+    """
+
+    stat = os.stat(path)
+    if stat.st_size > HASH_MAX_SIZE:
+        return md5(":".join((os.path.basename(path), str(stat.st_size), repr(stat.st_mtime)))).hexdigest()
+
+    digest = md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), ""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def read_diag_cache(cache_path):
+    """
+    Return computed diagnostics from cache file (None if not cached or unreadable)
+
+    :param cache_path: str
+        path of cache file
+
+    :return:
+        :diag: dict
+            computed diagnostics by name
+    """
+
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path, "rb") as f:
+            return cPickle.load(f)
+    except Exception:
+        return None
+
+
+def write_diag_cache(cache_path, diag):
+    """
+    Write computed diagnostics to cache file
+
+    :param cache_path: str
+        path of cache file
+
+    :param diag: dict
+        computed diagnostics by name
+    """
+
+    try:
+        os.makedirs(os.path.dirname(cache_path))
+    except OSError:
+        pass
+
+    with open(cache_path + ".tmp", "wb") as f:
+        cPickle.dump(diag, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(cache_path + ".tmp", cache_path)
+
 if __name__ == "__main__":
 
     def main():
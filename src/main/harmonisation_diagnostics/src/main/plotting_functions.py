@@ -11,7 +11,8 @@ Created on Wed May 03 2017 09:00:00
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
-from numpy import arange, where, zeros, linspace, nan, isnan, ndenumerate
+from numpy import arange, where, zeros, linspace, nan, isnan, ndenumerate, asarray, amin, amax, bincount, floor, \
+    clip, array_equal, savez, load
 from datetime import datetime
 
 # from matplotlib import rc
@@ -328,6 +329,330 @@ def plot_2dhist(savePath, Y, X, bins, xlbl, ylbl, title, txt=None, *args, **kwar
 
     return 0
 
+class Hist2D:
+    """
+    Class to accumulate 2d histogram of x-y data added chunk by chunk, so the full data is never held in memory
+
+    Bin edges are fixed where the range of an axis is given (e.g. configured, or from a first min/max pass over the
+    data), data outside the range is then ignored. Where not given, the range is initialised from the first chunk of
+    data added, and doubled as required to cover further data, merging neighbouring bins pairwise so the number of bins
+    is unchanged.
+
+    Accumulated histograms can be saved, reopened (see open_hist2d) and merged, and plotted from their counts alone
+    (see plot_hist2d), so re-rendering needs no data.
+
+    Sample Code:
+
+    H = Hist2D(bins=50, y_range=[-1., 1.])
+    for chunk in chunks:
+        H.add(chunk_x, chunk_y)
+    H.save("hist.npz")
+    plot_hist2d("hist.pdf", open_hist2d("hist.npz"), xlbl="x", ylbl="y", title="title")
+
+    :Attributes:
+        :bins: int
+            number of bins per axis (even)
+
+        :x_range: list:float
+            x bin range, [lower, upper] (None until data added, if not given)
+
+        :y_range: list:float
+            y bin range, [lower, upper] (None until data added, if not given)
+
+        :counts: numpy.ndarray
+            counts by x bin (row) and y bin (column)
+
+        :dates: bool
+            True if x data datetime, binned as seconds since epoch
+
+        :fixed: list:bool
+            True per axis (x, y) if range given
+    """
+
+    def __init__(self, bins=50, x_range=None, y_range=None):
+        """
+        Initialise empty histogram
+
+        :param bins: int
+            number of bins per axis (rounded up to even)
+
+        :param x_range: list:float
+            (optional) fixed x bin range, [lower, upper]
+
+        :param y_range: list:float
+            (optional) fixed y bin range, [lower, upper]
+        """
+
+        self.bins = bins + bins % 2
+        self.x_range = x_range
+        self.y_range = y_range
+        self.fixed = [x_range is not None, y_range is not None]
+        self.counts = zeros((self.bins, self.bins))
+        self.dates = False
+
+    def add(self, X, Y):
+        """
+        Add chunk of x-y data to histogram, ignoring nans
+
+        :param X: numpy.ndarray
+            X parameter (float or datetime)
+
+        :param Y: numpy.ndarray
+            Y parameter
+        """
+
+        # Change plotting variables to seconds since epoch if datetime (naive datetimes taken as UTC by datetime64)
+        X = asarray(X)
+        if (X.shape[0] > 0) and (type(X[0]) is datetime):
+            self.dates = True
+            X = X.astype('datetime64[us]').astype(float) / 1e6
+
+        X = asarray(X, dtype=float)
+        Y = asarray(Y, dtype=float)
+
+        # Ignore nans
+        valid = ~(isnan(X) | isnan(Y))
+        X = X[valid]
+        Y = Y[valid]
+
+        if X.shape[0] == 0:
+            return
+
+        self.x_range = self.extend(0, self.x_range, amin(X), amax(X))
+        self.y_range = self.extend(1, self.y_range, amin(Y), amax(Y))
+
+        # bin data - values on upper edge included in last bin, values outside fixed ranges ignored
+        ix = floor((X - self.x_range[0]) / (self.x_range[1] - self.x_range[0]) * self.bins)
+        iy = floor((Y - self.y_range[0]) / (self.y_range[1] - self.y_range[0]) * self.bins)
+        ix[X == self.x_range[1]] = self.bins - 1
+        iy[Y == self.y_range[1]] = self.bins - 1
+        inside = (ix >= 0) & (ix < self.bins) & (iy >= 0) & (iy < self.bins)
+
+        i_bins = (ix[inside] * self.bins + iy[inside]).astype(int)
+        self.counts += bincount(i_bins, minlength=self.bins**2).reshape((self.bins, self.bins))
+
+    def extend(self, axis, bin_range, v_min, v_max):
+        """
+        Return bin range of axis extended to cover data, merging counts into the wider bins
+
+        :param axis: int
+            axis, 0 for x or 1 for y
+
+        :param bin_range: list:float
+            current bin range of axis (None if not yet set)
+
+        :param v_min: float
+            minimum of data
+
+        :param v_max: float
+            maximum of data
+
+        :return:
+            :bin_range: list:float
+                bin range of axis covering data
+        """
+
+        if self.fixed[axis]:
+            return bin_range
+
+        if bin_range is None:
+            if v_max == v_min:
+                pad = abs(v_min) * 1e-6 if v_min != 0 else 1e-6
+                return [v_min - pad, v_max + pad]
+            return [v_min, v_max]
+
+        bin_range = list(bin_range)
+        while (v_min < bin_range[0]) or (v_max > bin_range[1]):
+
+            width = bin_range[1] - bin_range[0]
+            counts = self.counts if axis == 0 else self.counts.T
+            merged = counts.reshape((self.bins / 2, 2, self.bins)).sum(axis=1)
+
+            extended = zeros(counts.shape)
+            if v_min < bin_range[0]:
+                extended[self.bins / 2:] = merged
+                bin_range[0] -= width
+            else:
+                extended[:self.bins / 2] = merged
+                bin_range[1] += width
+
+            self.counts = extended if axis == 0 else extended.T.copy()
+
+        return bin_range
+
+    def edges(self):
+        """
+        Return bin edges
+
+        :return:
+            :x_edges: numpy.ndarray
+                x bin edges
+
+            :y_edges: numpy.ndarray
+                y bin edges
+        """
+
+        return linspace(self.x_range[0], self.x_range[1], self.bins + 1), \
+               linspace(self.y_range[0], self.y_range[1], self.bins + 1)
+
+    def merge(self, other):
+        """
+        Merge counts of other histogram of same number of bins into histogram. Bin edges must agree, after extending
+        any range not fixed to cover the other histogram (always the case for histograms with the same given ranges).
+
+        :param other: plotting_functions.Hist2D
+            histogram to merge
+        """
+
+        if other.x_range is None:
+            return
+
+        if self.bins != other.bins:
+            raise Exception("Histogram mismatch: Different number of bins")
+
+        self.x_range = self.extend(0, self.x_range, other.x_range[0], other.x_range[1])
+        self.y_range = self.extend(1, self.y_range, other.y_range[0], other.y_range[1])
+
+        x_edges, y_edges = self.edges()
+        x_edges_other, y_edges_other = other.edges()
+        if (not array_equal(x_edges, x_edges_other)) or (not array_equal(y_edges, y_edges_other)):
+            raise Exception("Histogram mismatch: Bin edges differ, accumulate with the same given ranges to merge")
+
+        self.counts += other.counts
+        self.dates = self.dates or other.dates
+
+    def save(self, path):
+        """
+        Save histogram to file, to reopen with open_hist2d
+
+        :param path: str
+            path of file to save histogram to (.npz)
+        """
+
+        savez(path, counts=self.counts, bins=self.bins, dates=self.dates, fixed=self.fixed,
+              x_range=self.x_range if self.x_range is not None else [nan, nan],
+              y_range=self.y_range if self.y_range is not None else [nan, nan])
+
+
+def open_hist2d(path):
+    """
+    Return histogram saved with Hist2D.save
+
+    :param path: str
+        path of histogram file
+
+    :return:
+        :H: plotting_functions.Hist2D
+            accumulated histogram
+    """
+
+    data = load(path)
+
+    H = Hist2D(bins=int(data["bins"]))
+    H.counts = data["counts"]
+    H.dates = bool(data["dates"])
+    H.fixed = [bool(fixed) for fixed in data["fixed"]]
+    if not isnan(data["x_range"]).any():
+        H.x_range = list(data["x_range"])
+        H.y_range = list(data["y_range"])
+
+    return H
+
+
+def plot_hist2d(savePath, H, xlbl, ylbl, title, txt=None, *args, **kwargs):
+    """
+    Generate 2d histogram (heatmap) from accumulated counts of Hist2D object and save to file, cropped to the bins
+    containing data
+
+    :param savePath: str
+        Path (including extension) of file to save plot to
+
+    :param H: plotting_functions.Hist2D/str
+        accumulated histogram, or path of saved histogram file (see Hist2D.save)
+
+    :param xlbl: str
+        x axis label
+
+    :param ylbl: str
+        y axis label
+
+    :param title: str
+        plot title
+
+    :param txt: list:str
+        list of strings to stack in textbox
+
+    """
+
+    if isinstance(H, str):
+        H = open_hist2d(H)
+
+    # initialise figure
+    fig = plt.figure(figsize=(10,8))
+    ax = fig.add_subplot(111)
+
+    # add axis labels and title
+    ax.set_xlabel(xlbl)
+    ax.set_ylabel(ylbl)
+    ax.set_title(title)
+
+    # crop to bins containing data
+    counts = H.counts
+    x_edges, y_edges = (linspace(0, 1, H.bins + 1), linspace(0, 1, H.bins + 1)) if H.x_range is None else H.edges()
+    x_used = where(counts.sum(axis=1) > 0)[0]
+    y_used = where(counts.sum(axis=0) > 0)[0]
+    if (x_used.shape[0] > 0) and (y_used.shape[0] > 0):
+        counts = counts[x_used[0]:x_used[-1]+1, y_used[0]:y_used[-1]+1]
+        x_edges = x_edges[x_used[0]:x_used[-1]+2]
+        y_edges = y_edges[y_used[0]:y_used[-1]+2]
+
+    p = ax.pcolormesh(x_edges, y_edges, counts.T, cmap="Reds")
+    ax.set_xlim([x_edges[0], x_edges[-1]])
+    ax.set_ylim([y_edges[0], y_edges[-1]])
+
+    if txt is not None:
+        s = ""
+        for string in txt:
+            s += string + "\n"
+        s = s[:-2]
+        ax.text(0.05, 0.9, s, fontsize=8, bbox=dict(edgecolor='k', facecolor='w'), transform=ax.transAxes)
+
+    # add any required horizontal or vertical lines
+    if "dash_ylines" in kwargs:
+        for y in kwargs["dash_ylines"]:
+            ax.axhline(y=y, linewidth=1, color='k', linestyle=':')
+
+    if "dash_xlines" in kwargs:
+        for x in kwargs["dash_xlines"]:
+            ax.axvline(x=x, linewidth=1, color='k', linestyle=':')
+
+    if "solid_ylines" in kwargs:
+        for y in kwargs["solid_ylines"]:
+            ax.axhline(y=y, linewidth=1, color='k')
+
+    if "solid_xlines" in kwargs:
+        for x in kwargs["solid_xlines"]:
+            ax.axvline(x=x, linewidth=1, color='k')
+
+    # Set the axis labels as dates if required
+    if H.dates:
+        epoch = datetime.utcfromtimestamp(0)
+        year_min = datetime.utcfromtimestamp(x_edges[0]).year
+        year_max = datetime.utcfromtimestamp(x_edges[-1]).year
+        years = arange(year_min, year_max+1).astype(int)
+        if years.shape[0] > 15:
+            years = linspace(year_min, year_max, num=8).astype(int)
+        seconds = [(datetime(day=1, month=1, year=year)-epoch).total_seconds() for year in years]
+        ax.set_xticks(seconds)
+        ax.set_xticklabels(years, rotation=90)
+
+    plt.colorbar(p, ax=ax)  # , ticks=[-1, 0, 1])
+    plt.tight_layout()
+    plt.savefig(savePath)
+    plt.close(fig)
+
+    return 0
+
 if __name__ == "__main__":
 
     def main():
@@ -9,21 +9,24 @@ Created on Wed May 03 2017 09:00:00
 
 '''___Harmonisation Modules___'''
 from harm_data_reader import HarmData
+from sampling_functions import stratified_sample, series_of
+from unc_functions import calc_unc
 
 '''___Python Modules___'''
-from numpy import zeros, linspace, diag, sort, cumsum, append, asarray, outer, sum, amax, amin, ones, mean, std, array, arange, nan, isnan
-from numpy.random import rand
+from numpy import zeros, linspace, diag, sort, cumsum, append, asarray, outer, sum, amax, amin, ones, mean, std, array, arange, nan, isnan, bincount
 from copy import deepcopy
 
 
-def sample_H(HData, n_sample):
+def sample_H(HData, n_sample, seed=None):
     """
-    Sample harmonisation data
+    Sample harmonisation data, without replacement stratified per match-up series
 
     :param H: harm_data_reader.HarmData
         harmonisation data object
     :param n_sample: int
-        number of samples per match-up series
+        total number of samples
+    :param seed: int
+        (optional) seed of random number generator, for reproducible samples
 
     :return:
         :HData_sample: harm_data_reader
@@ -47,7 +50,7 @@ def sample_H(HData, n_sample):
         ################################################################################################################
 
         # Select random indices to sample from data
-        i_sels = sort((HData.values.shape[0] * rand(n_sample)).astype(int))
+        i_sels = stratified_sample(HData.idx['cNm'], n_sample, seed=seed)
 
         # Perform sampling
         HData_sample.values = HData.values[i_sels, :]
@@ -60,15 +63,9 @@ def sample_H(HData, n_sample):
         # start with copy of old idx
         HData_sample.idx = deepcopy(HData.idx)
 
-        # count how many match-ups are removed from each series
+        # count how many match-ups are sampled from each series
         n_mu = len(HData.idx['Im'])
-        HData_sample.idx['Nm'] = zeros(n_mu, dtype=int)
-        for i_sel in i_sels:
-            for i in range(n_mu):
-                i_start = HData.idx['cNm'][i]
-                i_end = HData.idx['cNm'][i+1]
-                if i_start <= i_sel < i_end:
-                    HData_sample.idx['Nm'][i] += 1
+        HData_sample.idx['Nm'] = bincount(series_of(HData.idx['cNm'], i_sels), minlength=n_mu)
 
         HData_sample.idx['cNm'] = append(zeros(1), cumsum(HData_sample.idx['Nm'])).astype(int)
         HData_sample.idx['N_var'] = [int(HData_sample.idx['Nm'][n - 1]) for n in HData_sample.idx['n_mu']]
@@ -194,7 +191,7 @@ def calc_R(HData, a=None, Ia=None, V=None):
 
                 R[istart:iend, colR], J = HData.sensor_model(a[i_s], HData.values[istart: iend, colHs:colHe].T)
                 if V is not None:
-                    uR[istart:iend, colR] = (diag(J[:, m:].dot(V[outer(i_s, i_s)].reshape((sum(i_s), sum(i_s)))).dot(J[:, m:].T))) ** 0.5
+                    uR[istart:iend, colR] = calc_unc(J[:, m:], V[outer(i_s, i_s)].reshape((sum(i_s), sum(i_s))))
 
     if V is None:
         return R
@@ -222,7 +219,7 @@ def calc_R_sensor(values, sensor_model, a, V=None):
 
     R, J = sensor_model(a, values.T)
     if V is not None:
-        uR = (diag(J[:, values.shape[1]:].dot(V).dot(J[:, values.shape[1]:].T))) ** 0.5
+        uR = calc_unc(J[:, values.shape[1]:], V)
 
     if V is None:
         return R
@@ -403,6 +400,89 @@ def get_values_mu(values, lm, mu):
 
     return values_mu
 
+
+class Moments:
+    """
+    Class to accumulate the mean and standard deviation of data added chunk by chunk, mergeable with the moments of
+    other data (parallel update of Chan et al.), so statistics need not be computed on the full data
+
+    :Attributes:
+        :n: int
+            number of (non-nan) values added
+
+        :mean: float
+            mean of values added
+
+        :M2: float
+            sum of squared deviations from mean of values added
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.M2 = 0.
+
+    def add(self, values):
+        """
+        Add chunk of values, ignoring nans
+
+        :param values: numpy.ndarray
+            values to add
+        """
+
+        values = asarray(values, dtype=float).ravel()
+        values = values[~isnan(values)]
+
+        if values.shape[0] == 0:
+            return
+
+        chunk = Moments()
+        chunk.n = values.shape[0]
+        chunk.mean = mean(values)
+        chunk.M2 = sum((values - chunk.mean)**2)
+
+        self.merge(chunk)
+
+    def merge(self, other):
+        """
+        Merge moments of other data into moments
+
+        :param other: radiance_functions.Moments
+            moments of other data
+        """
+
+        if other.n == 0:
+            return
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+
+        self.mean += delta * other.n / n
+        self.M2 += other.M2 + delta**2 * self.n * other.n / n
+        self.n = n
+
+    def average(self):
+        """
+        Return mean of values added (nan if none added)
+
+        :return:
+            :mean: float
+                mean of values
+        """
+
+        return self.mean if self.n > 0 else nan
+
+    def sd(self):
+        """
+        Return standard deviation of values added, as numpy.std (nan if none added)
+
+        :return:
+            :sd: float
+                standard deviation of values
+        """
+
+        return (self.M2 / self.n)**0.5 if self.n > 0 else nan
+
 if __name__ == "__main__":
 
     def main():
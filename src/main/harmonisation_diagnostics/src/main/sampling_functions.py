@@ -0,0 +1,246 @@
+"""
+Functions to sample harmonisation match-up data - stratified per match-up series or per sensor, and reservoir sampling
+of data streamed chunk by chunk. Samples are drawn without replacement, reproducibly for a given seed.
+
+Created on Sun Oct 18 2026 09:00:00
+"""
+
+'''___Python Modules___'''
+from numpy import arange, argsort, asarray, concatenate, empty, append, cumsum, diff, floor, searchsorted, sort, \
+    zeros
+from numpy.random import RandomState
+
+
+def allocate(sizes, n_sample):
+    """
+    Return number of samples per stratum, proportional to the stratum sizes (largest remainder method)
+
+    :param sizes: numpy.ndarray
+        size of each stratum
+
+    :param n_sample: int
+        total sample size (-1 => all data)
+
+    :return:
+        :n_strata: numpy.ndarray
+            number of samples per stratum
+    """
+
+    sizes = asarray(sizes, dtype=int)
+    total = sizes.sum()
+
+    if (n_sample == -1) or (n_sample >= total):
+        return sizes.copy()
+
+    quotas = sizes * float(n_sample) / total
+    n_strata = floor(quotas).astype(int)
+
+    # distribute remaining samples to largest remainders
+    n_left = n_sample - n_strata.sum()
+    if n_left > 0:
+        n_strata[argsort(n_strata - quotas, kind="mergesort")[:n_left]] += 1
+
+    return n_strata
+
+
+def series_of(cNm, indices):
+    """
+    Return match-up series of match-up indices
+
+    :param cNm: numpy.ndarray
+        cumulative number of match-ups per match-up series, starting with 0 (as HarmData.idx['cNm'])
+
+    :param indices: numpy.ndarray
+        match-up indices
+
+    :return:
+        :series: numpy.ndarray
+            match-up series index of each match-up index
+    """
+
+    return searchsorted(cNm, indices, side='right') - 1
+
+
+def stratified_sample(cNm, n_sample, seed=None):
+    """
+    Return indices of match-ups sampled without replacement, stratified per match-up series (sample size of each series
+    proportional to its size)
+
+    :param cNm: numpy.ndarray
+        cumulative number of match-ups per match-up series, starting with 0 (as HarmData.idx['cNm'])
+
+    :param n_sample: int
+        total sample size (-1 => all match-ups)
+
+    :param seed: int
+        (optional) seed of random number generator
+
+    :return:
+        :i_sels: numpy.ndarray
+            sorted indices of sampled match-ups
+    """
+
+    cNm = asarray(cNm, dtype=int)
+    sizes = diff(cNm)
+    n_series = allocate(sizes, n_sample)
+
+    rng = RandomState(seed)
+    i_sels = [cNm[i] + sort(rng.choice(size, n, replace=False)) for i, (size, n) in enumerate(zip(sizes, n_series))
+              if n > 0]
+
+    if i_sels == []:
+        return empty(0, dtype=int)
+
+    return concatenate(i_sels)
+
+
+def stratified_sample_sensors(lm, n_sample, seed=None):
+    """
+    Return indices of match-ups sampled without replacement per sensor, from the match-up series of each sensor
+
+    :param lm: numpy.ndarray
+        array to describe match-up pairs. One row per match-up pair, column as [sensor1, sensor2, n_mu]
+
+    :param n_sample: int
+        sample size per sensor (-1 => all match-ups)
+
+    :param seed: int
+        (optional) seed of random number generator
+
+    :return:
+        :i_sels: dict:numpy.ndarray
+            sorted indices of sampled match-ups by sensor (reference sensor, -1, omitted)
+    """
+
+    lm = asarray(lm)
+    cNm = append(zeros(1), cumsum(lm[:, 2])).astype(int)
+
+    sensors = []
+    for sensor in lm[:, :2].flatten():
+        if (sensor != -1) and (sensor not in sensors):
+            sensors.append(sensor)
+
+    rng = RandomState(seed)
+    i_sels = {}
+    for sensor in sensors:
+
+        # match-ups of sensor series pooled, and sampled positions in the pool mapped back to match-up indices
+        series = [i for i, Im in enumerate(lm) if sensor in Im[:2]]
+        c_pool = append(zeros(1), cumsum(lm[series, 2])).astype(int)
+
+        n = c_pool[-1] if n_sample == -1 else min(n_sample, c_pool[-1])
+        positions = sort(rng.choice(c_pool[-1], n, replace=False))
+
+        s = series_of(c_pool, positions)
+        i_sels[sensor] = sort(cNm[series][s] + positions - c_pool[s])
+
+    return i_sels
+
+
+class ReservoirSample:
+    """
+    Class to draw a uniform random sample of fixed size from data added chunk by chunk, without holding the data
+    (reservoir sampling, Vitter's algorithm R), for data whose size is not known in advance. Sampled rows are
+    reproducible for a given seed and sequence of chunk sizes.
+
+    Sample Code:
+
+    S = ReservoirSample(10000)
+    for chunk in chunks:
+        S.add(x=chunk_x, y=chunk_y)
+    i_sels, samples = S.sample()
+
+    :Attributes:
+        :n_sample: int
+            sample size (-1 => keep all data)
+
+        :n_seen: int
+            number of rows of data added so far
+
+        :index: numpy.ndarray
+            index of each sampled row in the full stream of added data
+
+        :fields: dict:numpy.ndarray
+            sampled rows by field name
+    """
+
+    def __init__(self, n_sample, seed=None):
+        """
+        Initialise empty sample
+
+        :param n_sample: int
+            sample size (-1 => keep all data)
+
+        :param seed: int
+            (optional) seed of random number generator
+        """
+
+        self.n_sample = n_sample
+        self.n_seen = 0
+        self.index = None
+        self.fields = None
+        self.rng = RandomState(seed)
+
+    def add(self, **fields):
+        """
+        Add chunk of data to sample
+
+        :param fields: numpy.ndarray
+            chunk data by field name, one row per data point (all fields must be added with every chunk)
+        """
+
+        fields = dict((name, asarray(value)) for name, value in fields.items())
+        n = fields.values()[0].shape[0]
+        index = arange(self.n_seen, self.n_seen + n)
+
+        if self.fields is None:
+            self.index = empty(0, dtype=int)
+            self.fields = dict((name, empty((0,) + value.shape[1:], dtype=value.dtype))
+                               for name, value in fields.items())
+
+        # 1. Fill reservoir until full
+        n_fill = n
+        if self.n_sample != -1:
+            n_fill = max(0, min(n, self.n_sample - self.index.shape[0]))
+
+        if n_fill > 0:
+            self.index = concatenate((self.index, index[:n_fill]))
+            for name in self.fields.keys():
+                self.fields[name] = concatenate((self.fields[name], fields[name][:n_fill]))
+
+        # 2. Replace - row i of stream kept with probability n_sample/(i+1), in a random reservoir slot
+        if n_fill < n:
+            i = index[n_fill:]
+            slots = (self.rng.rand(i.shape[0]) * (i + 1)).astype(int)
+            keep = slots < self.n_sample
+
+            self.index[slots[keep]] = i[keep]
+            for name in self.fields.keys():
+                self.fields[name][slots[keep]] = fields[name][n_fill:][keep]
+
+        self.n_seen += n
+
+    def sample(self):
+        """
+        Return sample, in order of added data
+
+        :return:
+            :i_sels: numpy.ndarray
+                index of each sampled row in the full stream of added data
+
+            :samples: dict:numpy.ndarray
+                sampled rows by field name
+        """
+
+        if self.fields is None:
+            return empty(0, dtype=int), {}
+
+        order = argsort(self.index)
+        return self.index[order], dict((name, value[order]) for name, value in self.fields.items())
+
+if __name__ == "__main__":
+
+    def main():
+        return 0
+
+    main()
@@ -0,0 +1,73 @@
+"""
+Uncertainty propagation functions, shared between harmonisation packages
+"""
+
+'''___Third Party Modules___'''
+from numpy import asarray, empty, einsum, clip
+
+'''___Constants___'''
+
+CHUNK_SIZE = 65536  # rows of sensitivity coefficients per chunk
+
+
+def calc_quad_form(J, V, chunk_size=CHUNK_SIZE):
+    """
+    Return row-wise quadratic forms, J_i V J_i^T, of sensitivity coefficients - i.e. the diagonal of J V J^T, without
+    forming the n x n product. Computed chunk by chunk of rows, so temporaries are bounded by the chunk size.
+
+    :type J: numpy.ndarray
+    :param J: sensitivity coefficients, one row per data point (n x p)
+
+    :type V: numpy.ndarray
+    :param V: covariance matrix (p x p)
+
+    :type chunk_size: int
+    :param chunk_size: rows per chunk
+
+    :return:
+        :q: *numpy.ndarray*
+
+        Quadratic form per row of J (n)
+    """
+
+    J = asarray(J)
+    V = asarray(V)
+
+    n = J.shape[0]
+    q = empty(n)
+    for istart in xrange(0, n, chunk_size):
+        iend = min(istart + chunk_size, n)
+        q[istart:iend] = einsum('ij,jk,ik->i', J[istart:iend], V, J[istart:iend])
+
+    return q
+
+
+def calc_unc(J, V, chunk_size=CHUNK_SIZE):
+    """
+    Return standard uncertainty per data point propagated from covariance matrix V by the sensitivity coefficients J,
+    u_i = (J_i V J_i^T)**0.5 (law of propagation of uncertainty)
+
+    :type J: numpy.ndarray
+    :param J: sensitivity coefficients, one row per data point (n x p)
+
+    :type V: numpy.ndarray
+    :param V: covariance matrix (p x p)
+
+    :type chunk_size: int
+    :param chunk_size: rows per chunk
+
+    :return:
+        :u: *numpy.ndarray*
+
+        Standard uncertainty per row of J (n)
+    """
+
+    # clip round-off negatives of near-zero quadratic forms
+    return clip(calc_quad_form(J, V, chunk_size=chunk_size), 0, None)**0.5
+
+if __name__ == "__main__":
+
+    def main():
+        return 0
+
+    main()